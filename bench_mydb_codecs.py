@@ -0,0 +1,44 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from mydb import MyDB, CODECS
+
+# save and load time and file size of one list of strings under each codec
+
+def measure(directory, codec, strings, repeat):
+    path = os.path.join(directory, "strings." + codec)
+    db = MyDB(path, codec=codec, durability="none")
+    saveTimes = []
+    loadTimes = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        db.saveStrings(strings)
+        saveTimes.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        loaded = db.loadStrings()
+        loadTimes.append(time.perf_counter() - start)
+    if loaded != strings:
+        raise AssertionError("{} did not round trip".format(codec))
+    return {
+        "saveSeconds": round(min(saveTimes), 4),
+        "loadSeconds": round(min(loadTimes), 4),
+        "fileBytes": os.path.getsize(path),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark MyDB codecs")
+    parser.add_argument("--strings", type=int, default=1000000)
+    parser.add_argument("--length", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+    strings = ["{:0{}d}".format(i, args.length) for i in range(args.strings)]
+    report = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for codec in CODECS:
+            report[codec] = measure(directory, codec, strings, args.repeat)
+    print(json.dumps({"strings": args.strings, "length": args.length, "results": report}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import argparse
+import contextlib
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from urllib.parse import urlencode
+import squirrel_db
+import squirrel_server
+from squirrel_db import SquirrelDB, SquirrelConnectionPool, LRUCache, Squirrel, squirrelsVersion
+from squirrel_server import SquirrelServerHandler
+from squirrel_async_server import BufferedSquirrelHandler
+
+# in-process handler benchmark: requests go through SquirrelServerHandler
+# without a socket, the way the asyncio engine runs them, and the time of each
+# request is split into stages so it shows where the microseconds go.
+#
+#   python bench_squirrel_handler.py --backend sqlite --iterations 5000
+#   python bench_squirrel_handler.py --backend memory --scenario retrieve --cache-size 0
+
+SIZES = ("small", "medium", "large")
+DB_METHODS = ("getSquirrels", "getSquirrelsPage", "findSquirrels", "iterSquirrels", "getSquirrel",
+              "createSquirrel", "updateSquirrel", "deleteSquirrel", "applyBulk")
+# stage -> handler methods whose time is charged to it; "parseRequest" is the
+# request line and headers, everything else in a request ends up in "other"
+HANDLER_STAGES = {
+    "parseRequest": ("parse_request",),
+    "parsePath": ("parsePath",),
+    "readBody": ("getRequestData", "getRequestBody"),
+    "respond": ("send_response", "send_header", "end_headers", "writeChunk"),
+    "log": ("log_message",),
+}
+STAGES = ("parseRequest", "parsePath", "readBody", "db", "encode", "respond", "log", "other")
+
+class StageTimer:
+    # each stage is charged only its own time: a timed call made inside
+    # another (log_message inside send_response) pauses the outer stage
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.stack = []
+
+    def wrap(self, stage, function):
+        def timed(*args, **kwargs):
+            now = time.perf_counter()
+            if self.stack:
+                outer = self.stack[-1]
+                self.seconds[outer[0]] += now - outer[1]
+            self.stack.append([stage, now])
+            try:
+                return function(*args, **kwargs)
+            finally:
+                now = time.perf_counter()
+                inner = self.stack.pop()
+                self.seconds[inner[0]] += now - inner[1]
+                if self.stack:
+                    self.stack[-1][1] = now
+        return timed
+
+class MemorySquirrelDB:
+    # stands in for SquirrelDB with plain dicts, so the db stage is close to
+    # zero and the rest of the request is what is left
+    squirrels = {}
+    nextId = 1
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    @classmethod
+    def seed(cls, rows):
+        cls.squirrels = {idx: Squirrel(idx, "squirrel-{}".format(idx), SIZES[idx % 3]) for idx in range(1, rows + 1)}
+        cls.nextId = rows + 1
+
+    def getSquirrels(self):
+        return list(self.squirrels.values())
+
+    def getSquirrelsPage(self, afterId=0, limit=100):
+        return [squirrel for squirrelId, squirrel in self.squirrels.items() if squirrelId > afterId][:limit]
+
+    def findSquirrels(self, name=None, size=None, namePrefix=None, afterId=0, limit=None):
+        found = [squirrel for squirrel in self.squirrels.values()
+                 if squirrel.id > afterId and (name is None or squirrel.name == name)
+                 and (size is None or squirrel.size == size)
+                 and (namePrefix is None or squirrel.name.startswith(namePrefix))]
+        return found[:limit] if limit is not None else found
+
+    def iterSquirrels(self, chunkSize=500, **filters):
+        squirrels = self.findSquirrels(**filters)
+        for start in range(0, len(squirrels), chunkSize):
+            yield squirrels[start:start + chunkSize]
+
+    def getSquirrel(self, squirrelId):
+        try:
+            return self.squirrels.get(int(squirrelId))
+        except ValueError:
+            return None
+
+    def createSquirrel(self, name, size):
+        cls = type(self)
+        cls.squirrels[cls.nextId] = Squirrel(cls.nextId, name, size)
+        cls.nextId += 1
+        squirrelsVersion.bump()
+
+    def updateSquirrel(self, squirrelId, name, size):
+        self.squirrels[int(squirrelId)] = Squirrel(int(squirrelId), name, size)
+        squirrelsVersion.bump()
+
+    def deleteSquirrel(self, squirrelId):
+        self.squirrels.pop(int(squirrelId), None)
+        squirrelsVersion.bump()
+
+def makeDatabase(path, rows):
+    squirrel_db.migrate(path)
+    connection = sqlite3.connect(path)
+    connection.executemany("INSERT INTO squirrels (name, size) VALUES (?, ?)",
+                           [("squirrel-{}".format(idx), SIZES[idx % 3]) for idx in range(rows)])
+    connection.commit()
+    connection.close()
+
+def requestBytes(method, path, body=None):
+    head = "{} {} HTTP/1.1\r\nHost: bench\r\n".format(method, path)
+    if body is None:
+        return (head + "\r\n").encode("utf-8")
+    body = body.encode("utf-8")
+    head += "Content-Type: application/x-www-form-urlencoded\r\nContent-Length: {}\r\n\r\n".format(len(body))
+    return head.encode("utf-8") + body
+
+def makeScenarios(rows, pageSize):
+    # each builds the request for iteration i; deletes walk down from the top
+    # id so they find a squirrel for the first `rows` iterations
+    def squirrelId(i):
+        return i % rows + 1
+    def form(i):
+        return urlencode({"name": "bench-{}".format(i), "size": SIZES[i % 3]})
+    return {
+        "list": lambda i: requestBytes("GET", "/squirrels"),
+        "page": lambda i: requestBytes("GET", "/squirrels?" + urlencode({"limit": pageSize, "after_id": (i * pageSize) % rows})),
+        "filter": lambda i: requestBytes("GET", "/squirrels?" + urlencode({"size": SIZES[i % 3], "limit": pageSize})),
+        "retrieve": lambda i: requestBytes("GET", "/squirrels/{}".format(squirrelId(i))),
+        "create": lambda i: requestBytes("POST", "/squirrels", form(i)),
+        "update": lambda i: requestBytes("PUT", "/squirrels/{}".format(squirrelId(i)), form(i)),
+        "delete": lambda i: requestBytes("DELETE", "/squirrels/{}".format(rows - i % rows)),
+    }
+
+def makeHandlerClass(timer):
+    attributes = {}
+    for stage, names in HANDLER_STAGES.items():
+        for name in names:
+            attributes[name] = timer.wrap(stage, getattr(BufferedSquirrelHandler, name))
+    return type("TimedSquirrelHandler", (BufferedSquirrelHandler,), attributes)
+
+@contextlib.contextmanager
+def instrumented(timer, dbClass):
+    # the handlers look up SquirrelDB and toJSON in squirrel_server's globals,
+    # so the timed versions go there and are put back afterwards
+    timedDB = type("TimedSquirrelDB", (dbClass,),
+                   {name: timer.wrap("db", getattr(dbClass, name)) for name in DB_METHODS if hasattr(dbClass, name)})
+    timedDB.__init__ = timer.wrap("db", dbClass.__init__)
+    saved = (squirrel_server.SquirrelDB, squirrel_server.toJSON)
+    squirrel_server.SquirrelDB = timedDB
+    squirrel_server.toJSON = timer.wrap("encode", saved[1])
+    try:
+        yield
+    finally:
+        squirrel_server.SquirrelDB, squirrel_server.toJSON = saved
+
+def runScenario(build, iterations, dbClass):
+    timer = StageTimer()
+    handlerClass = makeHandlerClass(timer)
+    statuses = {}
+    total = 0.0
+    with instrumented(timer, dbClass), open(os.devnull, "w") as sink, contextlib.redirect_stderr(sink):
+        for i in range(iterations):
+            request = build(i)
+            start = time.perf_counter()
+            handler = handlerClass(request, ("127.0.0.1", 0), None)
+            total += time.perf_counter() - start
+            status = handler.getResponse()[9:12].decode("ascii")
+            statuses[status] = statuses.get(status, 0) + 1
+    timer.seconds["other"] = max(total - sum(timer.seconds.values()), 0.0)
+    stages = {stage: round(seconds / iterations * 1e6, 2) for stage, seconds in timer.seconds.items()}
+    return {
+        "requestsPerSec": round(iterations / total) if total else 0,
+        "meanMicros": round(total / iterations * 1e6, 2),
+        "stageMicros": stages,
+        "stageShare": {stage: round(seconds / total, 3) if total else 0.0 for stage, seconds in timer.seconds.items()},
+        "statuses": statuses,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="time SquirrelServerHandler stages in process, without sockets")
+    parser.add_argument("--backend", choices=["sqlite", "memory"], default="sqlite",
+                        help="sqlite: a real database file; memory: an in-memory stand-in for SquirrelDB")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--iterations", type=int, default=5000)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--cache-size", type=int, default=0,
+                        help="row and response cache entries (0: every request reaches the backend)")
+    parser.add_argument("--scenario", action="append", choices=sorted(makeScenarios(1, 1)),
+                        help="run only these scenarios (repeatable; default all)")
+    args = parser.parse_args(argv)
+    scenarios = makeScenarios(args.rows, args.page_size)
+    names = args.scenario or list(scenarios)
+    savedResponseCache = SquirrelServerHandler.responseCache
+    report = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name in names:
+            # every scenario starts from the same freshly seeded data
+            if args.backend == "memory":
+                MemorySquirrelDB.seed(args.rows)
+                dbClass = MemorySquirrelDB
+            else:
+                path = os.path.join(directory, "{}.db".format(name))
+                makeDatabase(path, args.rows)
+                squirrel_db.resetPool(SquirrelConnectionPool(path, maxSize=1, pragmas=squirrel_db.PROFILES["balanced"]))
+                dbClass = SquirrelDB
+            squirrel_db.resetCache(LRUCache(args.cache_size))
+            SquirrelServerHandler.responseCache = LRUCache(min(args.cache_size, 256))
+            report[name] = runScenario(scenarios[name], args.iterations, dbClass)
+        squirrel_db.resetPool()
+    squirrel_db.resetCache()
+    SquirrelServerHandler.responseCache = savedResponseCache
+    print(json.dumps({"backend": args.backend, "rows": args.rows, "iterations": args.iterations,
+                      "cacheSize": args.cache_size, "results": report}, indent=2))
+
+if __name__ == "__main__":
+    main()
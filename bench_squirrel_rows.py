@@ -0,0 +1,80 @@
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+from squirrel_db import dict_factory, selectSquirrels, toJSON, SQUIRREL_COLUMNS
+
+# compares the old dict rows + json.dumps against Squirrel records + toJSON for
+# one full read of the table, the work behind an uncached GET /squirrels
+
+def makeDatabase(path, rows):
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE squirrels (id INTEGER PRIMARY KEY, name TEXT, size TEXT)")
+    connection.executemany("INSERT INTO squirrels (name, size) VALUES (?, ?)",
+                           [("squirrel-{}".format(idx), ("small", "medium", "large")[idx % 3]) for idx in range(rows)])
+    connection.commit()
+    connection.close()
+
+def fetchDicts(connection):
+    connection.row_factory = dict_factory
+    return connection.execute("SELECT * FROM squirrels ORDER BY id").fetchall()
+
+def fetchRecords(connection):
+    connection.row_factory = dict_factory
+    return selectSquirrels(connection, "SELECT {} FROM squirrels ORDER BY id".format(SQUIRREL_COLUMNS)).fetchall()
+
+VARIANTS = {
+    "dict": (fetchDicts, json.dumps),
+    "record": (fetchRecords, toJSON),
+}
+
+def bytesPerRow(connection, fetch, rows):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = fetch(connection)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return (after - before) / rows
+
+def measure(path, rows, repeat):
+    connection = sqlite3.connect(path)
+    report = {}
+    for name, (fetch, encode) in VARIANTS.items():
+        fetchTimes = []
+        encodeTimes = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = fetch(connection)
+            fetched = time.perf_counter()
+            body = encode(result).encode("utf-8")
+            fetchTimes.append(fetched - start)
+            encodeTimes.append(time.perf_counter() - fetched)
+        report[name] = {
+            "fetchRowsPerSec": round(rows / min(fetchTimes)),
+            "encodeRowsPerSec": round(rows / min(encodeTimes)),
+            "totalRowsPerSec": round(rows / min(f + e for f, e in zip(fetchTimes, encodeTimes))),
+            "bytesPerRow": round(bytesPerRow(connection, fetch, rows), 1),
+            "bodyBytes": len(body),
+        }
+    connection.close()
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark squirrel row decoding and JSON encoding")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        makeDatabase(path, args.rows)
+        report = measure(path, args.rows, args.repeat)
+    print(json.dumps({"rows": args.rows, "results": report}, indent=2))
+    if report["dict"]["bodyBytes"] != report["record"]["bodyBytes"]:
+        print("warning: encoders produced different bodies")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+import squirrel_db
+
+# end-to-end load test: starts squirrel_server.py in its own process against a
+# seeded temp database, drives a weighted mix of requests from many keep-alive
+# clients, and reports throughput and latency percentiles per operation.
+#
+#   python bench_squirrel_server.py run --clients 32 --duration 10 --output base.json
+#   python bench_squirrel_server.py compare base.json new.json --threshold 10
+
+SIZES = ("small", "medium", "large")
+OPERATIONS = ("list", "retrieve", "create", "update", "delete")
+DEFAULT_MIX = "list=10,retrieve=70,create=10,update=5,delete=5"
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "squirrel_server.py")
+
+def parseMix(text):
+    mix = {}
+    for part in text.split(","):
+        name, separator, weight = part.partition("=")
+        name = name.strip()
+        if not separator or name not in OPERATIONS:
+            raise ValueError("mix entries are OPERATION=WEIGHT with OPERATION one of {}, got {!r}".format(", ".join(OPERATIONS), part))
+        mix[name] = float(weight)
+    if sum(mix.values()) <= 0:
+        raise ValueError("mix weights must add up to more than 0")
+    return mix
+
+def makeDatabase(path, rows):
+    squirrel_db.migrate(path)
+    connection = sqlite3.connect(path)
+    connection.executemany("INSERT INTO squirrels (name, size) VALUES (?, ?)",
+                           [("squirrel-{}".format(idx), SIZES[idx % 3]) for idx in range(rows)])
+    connection.commit()
+    connection.close()
+
+def freePort(host):
+    with socket.socket() as probe:
+        probe.bind((host, 0))
+        return probe.getsockname()[1]
+
+def startServer(path, host, port, serverArgs, timeout=10.0):
+    command = [sys.executable, SERVER_SCRIPT, "--db", path, "--host", host, "--port", str(port)] + serverArgs
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("squirrel_server exited with {} before listening: {}".format(process.returncode, " ".join(command)))
+        try:
+            socket.create_connection((host, port), timeout=0.1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("squirrel_server did not start listening within {}s".format(timeout))
+
+def stopServer(process):
+    process.terminate()
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+class Client(threading.Thread):
+    # one keep-alive connection issuing requests back to back until the
+    # deadline; only requests started after warmupEnd are recorded
+
+    def __init__(self, host, port, mix, rows, listLimit, seed, warmupEnd, deadline):
+        super().__init__(daemon=True)
+        self.host = host
+        self.port = port
+        self.operations = list(mix)
+        self.weights = [mix[name] for name in self.operations]
+        self.rows = rows
+        self.listLimit = listLimit
+        self.random = random.Random(seed)
+        self.warmupEnd = warmupEnd
+        self.deadline = deadline
+        self.latencies = {name: [] for name in OPERATIONS}
+        self.statuses = {name: {} for name in OPERATIONS}
+        self.connection = None
+
+    def makeRequest(self, op):
+        squirrelId = self.random.randint(1, max(self.rows, 1))
+        if op == "list":
+            query = urlencode({"limit": self.listLimit, "after_id": self.random.randint(0, max(self.rows - self.listLimit, 0))})
+            return "GET", "/squirrels?" + query, None
+        if op == "retrieve":
+            return "GET", "/squirrels/{}".format(squirrelId), None
+        body = urlencode({"name": "bench-{}".format(self.random.randint(0, 1 << 30)), "size": self.random.choice(SIZES)})
+        if op == "create":
+            return "POST", "/squirrels", body
+        if op == "update":
+            return "PUT", "/squirrels/{}".format(squirrelId), body
+        return "DELETE", "/squirrels/{}".format(squirrelId), None
+
+    def send(self, method, path, body):
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        headers = {"Content-Type": "application/x-www-form-urlencoded"} if body is not None else {}
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            return "error"
+        if response.will_close:
+            self.connection.close()
+            self.connection = None
+        return response.status
+
+    def run(self):
+        while True:
+            start = time.perf_counter()
+            if start >= self.deadline:
+                break
+            op = self.random.choices(self.operations, self.weights)[0]
+            status = self.send(*self.makeRequest(op))
+            elapsed = time.perf_counter() - start
+            if start >= self.warmupEnd:
+                self.latencies[op].append(elapsed)
+                self.statuses[op][status] = self.statuses[op].get(status, 0) + 1
+        if self.connection is not None:
+            self.connection.close()
+
+def percentile(ordered, fraction):
+    # nearest rank on an already sorted list
+    if not ordered:
+        return None
+    rank = max(int(-(-fraction * len(ordered) // 1)), 1)
+    return ordered[rank - 1]
+
+def summarize(latencies, statuses, seconds):
+    ordered = sorted(latencies)
+    errors = sum(count for status, count in statuses.items() if status == "error" or status >= 500)
+    summary = {
+        "requests": len(ordered),
+        "errors": errors,
+        "requestsPerSec": round(len(ordered) / seconds, 1) if seconds else 0.0,
+        "statuses": {str(status): count for status, count in sorted(statuses.items(), key=str)},
+    }
+    for name, fraction in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99), ("max", 1.0)):
+        value = percentile(ordered, fraction)
+        summary[name + "Ms"] = None if value is None else round(value * 1000, 3)
+    return summary
+
+def runLoad(args):
+    mix = parseMix(args.mix)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        makeDatabase(path, args.rows)
+        port = args.port or freePort(args.host)
+        process = startServer(path, args.host, port, args.server_arg)
+        try:
+            started = time.perf_counter()
+            warmupEnd = started + args.warmup
+            deadline = warmupEnd + args.duration
+            clients = [Client(args.host, port, mix, args.rows, args.list_limit, args.seed + idx, warmupEnd, deadline)
+                       for idx in range(args.clients)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+        finally:
+            stopServer(process)
+    results = {}
+    allLatencies = []
+    allStatuses = {}
+    for op in OPERATIONS:
+        latencies = [value for client in clients for value in client.latencies[op]]
+        statuses = {}
+        for client in clients:
+            for status, count in client.statuses[op].items():
+                statuses[status] = statuses.get(status, 0) + count
+                allStatuses[status] = allStatuses.get(status, 0) + count
+        if latencies:
+            results[op] = summarize(latencies, statuses, args.duration)
+            allLatencies.extend(latencies)
+    return {
+        "config": {
+            "rows": args.rows, "clients": args.clients, "duration": args.duration, "warmup": args.warmup,
+            "mix": mix, "listLimit": args.list_limit, "seed": args.seed, "serverArgs": args.server_arg,
+        },
+        "total": summarize(allLatencies, allStatuses, args.duration),
+        "results": results,
+    }
+
+def change(base, new):
+    if not base or new is None:
+        return None
+    return round((new - base) / base * 100, 1)
+
+def compareReports(base, new, threshold):
+    # a regression is throughput down, or p95/p99 up, by more than threshold
+    # percent, or any errors where the base run had none
+    comparison = {}
+    regressions = []
+    for op in ["total"] + list(OPERATIONS):
+        before = base["total"] if op == "total" else base["results"].get(op)
+        after = new["total"] if op == "total" else new["results"].get(op)
+        if before is None or after is None:
+            continue
+        row = {}
+        for metric in ("requestsPerSec", "p50Ms", "p95Ms", "p99Ms"):
+            row[metric] = {"base": before[metric], "new": after[metric], "changePercent": change(before[metric], after[metric])}
+        row["errors"] = {"base": before["errors"], "new": after["errors"]}
+        comparison[op] = row
+        throughput = row["requestsPerSec"]["changePercent"]
+        if throughput is not None and throughput < -threshold:
+            regressions.append("{}: requestsPerSec {}%".format(op, throughput))
+        for metric in ("p95Ms", "p99Ms"):
+            latency = row[metric]["changePercent"]
+            if latency is not None and latency > threshold:
+                regressions.append("{}: {} +{}%".format(op, metric, latency))
+        if after["errors"] and not before["errors"]:
+            regressions.append("{}: {} errors".format(op, after["errors"]))
+    return {"threshold": threshold, "results": comparison, "regressions": regressions}
+
+def loadReport(path):
+    with open(path) as f:
+        return json.load(f)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="load test squirrel_server and compare runs")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="load test a fresh server and print a JSON report")
+    run.add_argument("--rows", type=int, default=10000, help="squirrels seeded before the run")
+    run.add_argument("--clients", type=int, default=16, help="concurrent keep-alive clients")
+    run.add_argument("--duration", type=float, default=10.0, help="measured seconds")
+    run.add_argument("--warmup", type=float, default=1.0, help="seconds of load before measuring")
+    run.add_argument("--mix", default=DEFAULT_MIX, help="OPERATION=WEIGHT list over {}".format(", ".join(OPERATIONS)))
+    run.add_argument("--list-limit", type=int, default=100, help="page size of list requests")
+    run.add_argument("--seed", type=int, default=1)
+    run.add_argument("--host", default="127.0.0.1")
+    run.add_argument("--port", type=int, default=0, help="0 picks a free port")
+    run.add_argument("--server-arg", action="append", default=[], metavar="ARG",
+                     help="passed through to squirrel_server.py, e.g. --server-arg=--mode=prefork (repeatable)")
+    run.add_argument("--output", help="also write the report to this file")
+    compare = commands.add_parser("compare", help="compare two reports; exits 1 on a regression")
+    compare.add_argument("base")
+    compare.add_argument("new")
+    compare.add_argument("--threshold", type=float, default=10.0, help="percent change counted as a regression")
+    args = parser.parse_args(argv)
+    if args.command == "compare":
+        result = compareReports(loadReport(args.base), loadReport(args.new), args.threshold)
+        print(json.dumps(result, indent=2))
+        return 1 if result["regressions"] else 0
+    try:
+        report = runLoad(args)
+    except ValueError as error:
+        parser.error(str(error))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
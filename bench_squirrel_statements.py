@@ -0,0 +1,62 @@
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import squirrel_db
+from squirrel_db import SquirrelDB, SquirrelConnectionPool, LRUCache, dict_factory
+
+# single-row getSquirrel throughput with the row cache off, so every call
+# reaches sqlite: a fresh connection per call (how SquirrelDB started out),
+# pooled connections that re-prepare every statement, and pooled connections
+# with a warm statement cache
+
+class ConnectPerCallDB:
+
+    def __init__(self, path):
+        self.path = path
+
+    def getSquirrel(self, squirrelId):
+        connection = sqlite3.connect(self.path)
+        connection.row_factory = dict_factory
+        try:
+            return connection.execute("SELECT * FROM squirrels WHERE id = ?", [squirrelId]).fetchone()
+        finally:
+            connection.close()
+
+def makeDatabase(path, rows):
+    squirrel_db.migrate(path)
+    connection = sqlite3.connect(path)
+    connection.executemany("INSERT INTO squirrels (name, size) VALUES (?, ?)",
+                           [("squirrel-{}".format(idx), "small") for idx in range(rows)])
+    connection.commit()
+    connection.close()
+
+def measure(db, ids):
+    start = time.perf_counter()
+    for squirrelId in ids:
+        db.getSquirrel(squirrelId)
+    return round(len(ids) / (time.perf_counter() - start))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark getSquirrel with and without statement reuse")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--calls", type=int, default=50000)
+    args = parser.parse_args(argv)
+    ids = [random.randint(1, args.rows) for _ in range(args.calls)]
+    report = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        makeDatabase(path, args.rows)
+        report["connectPerCall"] = {"callsPerSec": measure(ConnectPerCallDB(path), ids[:args.calls // 10])}
+        for name, cachedStatements in (("pooledNoStatementCache", 0), ("pooledStatementCache", 256)):
+            pool = SquirrelConnectionPool(path, maxSize=1, cachedStatements=cachedStatements)
+            db = SquirrelDB(pool, LRUCache(maxSize=0))
+            report[name] = {"callsPerSec": measure(db, ids), "statements": pool.getStatementStats()}
+            pool.close()
+    print(json.dumps({"rows": args.rows, "calls": args.calls, "results": report}, indent=2))
+
+if __name__ == "__main__":
+    main()
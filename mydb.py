@@ -1,29 +1,654 @@
+import atexit
+import marshal
+import mmap
 import os.path
 import pickle
+import struct
+import sys
+import threading
+import weakref
+import zlib
+from array import array
+from contextlib import contextmanager
+from itertools import accumulate
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks on this platform; one process per file
+    fcntl = None
+
+# snapshot mode rewrites the whole list through a codec on every save; "pickle"
+# is the old name for a pickle-codec snapshot
+MODES = ("snapshot", "pickle", "log")
+# none: leave flushing to the OS, file: fsync the data file, dir: also fsync
+# the directory so a rename or a new file survives a power cut
+DURABILITY = ("none", "file", "dir")
+LOG_MAGIC = b"MYDBLOG1"
+# every record is kind, payload length and crc32 of the payload, then the payload
+RECORD_HEADER = struct.Struct(">BII")
+# a REPLACE payload is a count, that many lengths, then the strings back to back
+STRING_COUNT = struct.Struct(">I")
+APPEND = 1
+REPLACE = 2
+# a torn write can only damage the end of the file, so opening a log only
+# checksums the records in this much of its tail
+TAIL_CHECK_BYTES = 1 << 16
+
+def encodeString(s):
+    if not isinstance(s, str):
+        raise TypeError("only str values can be stored here, got {}".format(type(s).__name__))
+    return s.encode("utf-8")
+
+def encodeRecord(kind, payload):
+    return RECORD_HEADER.pack(kind, len(payload), zlib.crc32(payload)) + payload
+
+def encodeStrings(arr):
+    try:
+        text = "".join(arr)
+    except TypeError:
+        text = None
+    blob = text.encode("utf-8") if text is not None else b""
+    if text is not None and len(blob) == len(text):
+        # all ASCII: byte lengths are the string lengths, one encode does it all
+        lengths = array("I", map(len, arr))
+    else:
+        encoded = [encodeString(s) for s in arr]
+        lengths = array("I", map(len, encoded))
+        blob = b"".join(encoded)
+    if sys.byteorder == "little":
+        lengths.byteswap()
+    return STRING_COUNT.pack(len(arr)) + lengths.tobytes() + blob
+
+def decodeStrings(data, start):
+    starts, ends = stringSpans(data, start)
+    if not starts:
+        return []
+    text = str(data[starts[0]:], "utf-8")
+    if len(text) == len(data) - starts[0]:
+        # all ASCII: byte offsets are character offsets into one decoded str
+        base = starts[0]
+        return [text[begin - base:end - base] for begin, end in zip(starts, ends)]
+    return [str(data[begin:end], "utf-8") for begin, end in zip(starts, ends)]
+
+def stringSpans(data, start):
+    # payload starts and ends of the strings written by encodeStrings at start
+    count, = STRING_COUNT.unpack_from(data, start)
+    start += STRING_COUNT.size
+    lengths = array("I")
+    lengths.frombytes(data[start:start + 4 * count])
+    if sys.byteorder == "little":
+        lengths.byteswap()
+    offsets = array("Q", accumulate(lengths, initial=start + 4 * count))
+    return offsets[:-1], offsets[1:]
+
+def replaceRecord(arr):
+    return encodeRecord(REPLACE, encodeStrings(arr))
+
+def mapFile(fname):
+    # mmap cannot map an empty file
+    with open(fname, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class PickleCodec:
+
+    # files written before codecs existed are bare pickles, so this one has no
+    # header and is what any file without a known header is read as
+    name = "pickle"
+    magic = None
+
+    def dump(self, arr, f):
+        pickle.dump(arr, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self, f):
+        return pickle.load(f)
+
+class MarshalCodec:
+
+    name = "marshal"
+    magic = b"MYDBMSH1"
+
+    def dump(self, arr, f):
+        f.write(self.magic)
+        marshal.dump(arr, f)
+
+    def load(self, f):
+        # marshal.load reads a file object in small pieces; one read is far faster
+        return marshal.loads(f.read())
+
+class Utf8Codec:
+
+    # the same count, lengths, strings layout as a log REPLACE record, so a
+    # snapshot can be mapped and read lazily by view() too
+    name = "utf8"
+    magic = b"MYDBUTF1"
+
+    def dump(self, arr, f):
+        f.write(self.magic)
+        f.write(encodeStrings(arr))
+
+    def load(self, f):
+        return decodeStrings(memoryview(f.read()), 0)
+
+CODECS = {codec.name: codec for codec in (PickleCodec(), MarshalCodec(), Utf8Codec())}
+MAGIC_SIZE = 8
+
+def detectCodec(header):
+    if header == LOG_MAGIC:
+        raise ValueError("this is a log mode file")
+    for codec in CODECS.values():
+        if codec.magic is not None and header == codec.magic:
+            return codec
+    return CODECS["pickle"]
+
+def syncFile(f, durability):
+    if durability != "none":
+        f.flush()
+        os.fsync(f.fileno())
+
+def syncDirectory(fname, durability):
+    if durability != "dir":
+        return
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(fname)), os.O_RDONLY)
+    except OSError:
+        # directories cannot be opened for fsync on every platform
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def replaceFile(fname, write, durability):
+    # readers see either the old file or the complete new one, never a
+    # half-written one, whatever happens during write()
+    tmpName = "{}.{}.tmp".format(fname, os.getpid())
+    try:
+        with open(tmpName, 'wb') as f:
+            write(f)
+            syncFile(f, durability)
+        os.replace(tmpName, fname)
+    except BaseException:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+        raise
+    syncDirectory(fname, durability)
+
+class RecordLog:
+
+    # an append-only file of checksummed records: APPEND adds one string,
+    # REPLACE swaps in a whole list. Appending never rewrites what is already
+    # there, a REPLACE lands as one record so a crash cannot half-apply it, and
+    # compact() rewrites the file once superseded records outweigh live ones
+    def __init__(self, filename, durability="file", compactRatio=1.0, compactMinBytes=1 << 20):
+        self.fname = filename
+        self.durability = durability
+        self.compactRatio = compactRatio
+        self.compactMinBytes = compactMinBytes
+        self.liveBytes = 0
+        self.deadBytes = 0
+        # where the last record this instance read or wrote ends, and in which
+        # file; anything else found there was written by someone else
+        self.goodEnd = None
+        self.inode = None
+        # the offset index of the last view, grown in place by later views of
+        # the same file: (inode, end, starts, ends)
+        self.index = None
+
+    def scan(self, data, verifyFrom=0, index=True):
+        # returns the payload starts and ends of the live strings and the
+        # offset where the last intact record ends; records ending before
+        # verifyFrom are trusted without checking their crc, and with
+        # index=False only the end offset is worked out
+        starts, ends = array("Q"), array("Q")
+        if data[:len(LOG_MAGIC)] != LOG_MAGIC:
+            if LOG_MAGIC.startswith(data[:len(LOG_MAGIC)]):
+                return starts, ends, 0
+            raise ValueError("{} is not a MyDB log".format(self.fname))
+        liveStart = offset = len(LOG_MAGIC)
+        self.deadBytes = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            kind, length, crc = RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            end = start + length
+            if kind not in (APPEND, REPLACE) or end > len(data):
+                break
+            if end > verifyFrom and zlib.crc32(data[start:end]) != crc:
+                break
+            if kind == APPEND:
+                if index:
+                    starts.append(start)
+                    ends.append(end)
+            else:
+                if index:
+                    starts, ends = stringSpans(data, start)
+                self.deadBytes += offset - liveStart
+                liveStart = offset
+            offset = end
+        self.liveBytes = offset - liveStart
+        return starts, ends, offset
+
+    def read(self):
+        with open(self.fname, 'rb') as f:
+            return f.read()
+
+    def load(self):
+        data = self.read()
+        starts, ends, end = self.scan(data)
+        return [data[start:stop].decode("utf-8") for start, stop in zip(starts, ends)]
+
+    def view(self):
+        # only records added since the last view are walked, unless the file
+        # was replaced or cut back since
+        data = mapFile(self.fname)
+        inode = os.stat(self.fname).st_ino
+        verifyFrom = len(data) - TAIL_CHECK_BYTES
+        if self.index is not None and self.index[0] == inode and self.index[1] <= len(data):
+            starts, ends, end = self.extendIndex(data, verifyFrom, *self.index[1:])
+        else:
+            starts, ends, end = self.scan(data, verifyFrom)
+        self.index = (inode, end, starts, ends) if end else None
+        return StringView(data, starts, ends, len(starts))
+
+    def extendIndex(self, data, verifyFrom, offset, starts, ends):
+        # scan() from offset on, adding to starts and ends; the live/dead
+        # byte counts are left to the writes that keep them
+        while offset + RECORD_HEADER.size <= len(data):
+            kind, length, crc = RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            end = start + length
+            if kind not in (APPEND, REPLACE) or end > len(data):
+                break
+            if end > verifyFrom and zlib.crc32(data[start:end]) != crc:
+                break
+            if kind == APPEND:
+                starts.append(start)
+                ends.append(end)
+            else:
+                starts, ends = stringSpans(data, start)
+            offset = end
+        return starts, ends, offset
+
+    def recover(self):
+        # a crash mid-append leaves a torn record at the end; cut the file
+        # back to the last intact record so later appends are readable
+        data = mapFile(self.fname)
+        size = len(data)
+        try:
+            starts, ends, end = self.scan(data, size - TAIL_CHECK_BYTES, index=False)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+        if end == 0:
+            replaceFile(self.fname, lambda f: f.write(LOG_MAGIC), self.durability)
+        elif end < size:
+            with open(self.fname, 'r+b') as f:
+                f.truncate(end)
+                syncFile(f, self.durability)
+        self.goodEnd = max(end, len(LOG_MAGIC))
+        self.inode = os.stat(self.fname).st_ino
+        return size - self.goodEnd
+
+    def intactEnd(self, data, offset):
+        # where the records from offset on stop being intact
+        while offset + RECORD_HEADER.size <= len(data):
+            kind, length, crc = RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            end = start + length
+            if kind not in (APPEND, REPLACE) or end > len(data) or zlib.crc32(data[start:end]) != crc:
+                break
+            offset = end
+        return offset
+
+    def checkTail(self, f, size):
+        # another writer may have died mid-append since this one last wrote;
+        # a record appended after its torn one could never be read back, so
+        # the tear is cut off first. Only what was added since goodEnd is
+        # checked, unless the file was replaced or shrank meanwhile
+        inode = os.fstat(f.fileno()).st_ino
+        if size == self.goodEnd and inode == self.inode:
+            return size
+        data = mapFile(self.fname)
+        try:
+            if inode == self.inode and self.goodEnd is not None and self.goodEnd <= size:
+                end = self.intactEnd(data, self.goodEnd)
+            else:
+                starts, ends, end = self.scan(data, size - TAIL_CHECK_BYTES, index=False)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+        if end < size:
+            f.truncate(end)
+        if end < len(LOG_MAGIC):
+            f.write(LOG_MAGIC)
+            end = len(LOG_MAGIC)
+        return end
+
+    def write(self, record):
+        created = not os.path.isfile(self.fname)
+        with open(self.fname, 'ab') as f:
+            start = f.tell()
+            if start == 0:
+                f.write(LOG_MAGIC)
+                start = len(LOG_MAGIC)
+            else:
+                start = self.checkTail(f, start)
+            try:
+                f.write(record)
+                f.flush()
+                syncFile(f, self.durability)
+            except BaseException:
+                f.truncate(start)
+                raise
+            self.goodEnd = start + len(record)
+            self.inode = os.fstat(f.fileno()).st_ino
+        if created:
+            syncDirectory(self.fname, self.durability)
+
+    def append(self, s):
+        record = encodeRecord(APPEND, encodeString(s))
+        self.write(record)
+        self.liveBytes += len(record)
+
+    def appendMany(self, arr):
+        # one write and one fsync for the whole batch
+        records = b"".join(encodeRecord(APPEND, encodeString(s)) for s in arr)
+        self.write(records)
+        self.liveBytes += len(records)
+
+    def replace(self, arr):
+        record = replaceRecord(arr)
+        self.write(record)
+        self.deadBytes += self.liveBytes
+        self.liveBytes = len(record)
+        if self.deadBytes >= self.compactMinBytes and self.deadBytes > self.compactRatio * self.liveBytes:
+            self.compact()
+
+    def isLog(self):
+        # an empty file or a torn magic is a log that never got a record
+        with open(self.fname, 'rb') as f:
+            header = f.read(len(LOG_MAGIC))
+        return header == LOG_MAGIC or (len(header) < len(LOG_MAGIC) and LOG_MAGIC.startswith(header))
+
+    def compact(self):
+        self.rewrite(self.load())
+
+    def rewrite(self, arr):
+        # a fresh file holding arr as one REPLACE record
+        data = LOG_MAGIC + replaceRecord(arr)
+        replaceFile(self.fname, lambda f: f.write(data), self.durability)
+        self.deadBytes = 0
+        self.liveBytes = len(data) - len(LOG_MAGIC)
+        self.goodEnd = len(data)
+        self.inode = os.stat(self.fname).st_ino
+
+class StringView:
+
+    # read-only, lazy sequence over a mapped log: only the offset index lives
+    # in memory and a string is decoded when it is asked for, so reading the
+    # last few entries of a huge store touches just those pages. It shows the
+    # file as it was when the view was made: later views may grow the index
+    # arrays it shares, but only its first count entries are its own
+    def __init__(self, data, starts, ends, count=None):
+        self.data = data
+        self.starts = starts
+        self.ends = ends
+        self.count = len(starts) if count is None else count
+
+    def __len__(self):
+        return self.count
+
+    def get(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("view index out of range")
+        return self.data[self.starts[i]:self.ends[i]].decode("utf-8")
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.get(j) for j in range(*i.indices(len(self)))]
+        return self.get(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.get(i)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 class MyDB:
 
-    def __init__(self, filename):
+    def __init__(self, filename, mode="snapshot", durability="file", codec="utf8", **logOptions):
+        if mode not in MODES:
+            raise ValueError("unknown mode: {}".format(mode))
+        if durability not in DURABILITY:
+            raise ValueError("unknown durability: {}".format(durability))
+        if mode == "pickle":
+            mode, codec = "snapshot", "pickle"
+        if codec not in CODECS:
+            raise ValueError("unknown codec: {}".format(codec))
         self.fname = filename
+        self.mode = mode
+        # snapshots are read with whatever codec wrote them and saved with this
+        # one, so an older file is migrated by its next save
+        self.codec = CODECS[codec]
+        self.durability = durability
+        self.log = RecordLog(filename, durability, **logOptions) if mode == "log" else None
+        self.threadLock = threading.RLock()
+        self.lockFd = None
+        self.lockDepth = 0
         #looking for a file
         #file system is outside of the boundary
         #don't actually touch the file
         #HOW??
-        if not os.path.isfile(self.fname):
-            self.saveStrings([])
+        with self.lock():
+            if not os.path.isfile(self.fname):
+                self.saveStrings([])
+            elif self.log is not None:
+                if not self.log.isLog():
+                    # a store saved as a snapshot moves into log mode the
+                    # first time it is opened that way
+                    self.log.rewrite(self.readSnapshot())
+                self.log.recover()
+
+    @contextmanager
+    def lock(self, exclusive=True):
+        # advisory lock shared by every process using this file. It lives in a
+        # side file because saves replace the data file. flock belongs to the
+        # open file, so nested calls reuse the lock already held rather than
+        # deadlocking on it
+        with self.threadLock:
+            if self.lockDepth == 0 and fcntl is not None:
+                self.lockFd = os.open(self.fname + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(self.lockFd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                except BaseException:
+                    os.close(self.lockFd)
+                    self.lockFd = None
+                    raise
+            self.lockDepth += 1
+            try:
+                yield
+            finally:
+                self.lockDepth -= 1
+                if self.lockDepth == 0 and self.lockFd is not None:
+                    os.close(self.lockFd)
+                    self.lockFd = None
 
     def loadStrings(self):
+        with self.lock(exclusive=False):
+            if self.log is not None:
+                return self.log.load()
+            return self.readSnapshot()
+
+    def readSnapshot(self):
         with open(self.fname, 'rb') as f:
             #outside of the boundary
-            arr = pickle.load(f)
-        return arr
+            codec = detectCodec(f.read(MAGIC_SIZE))
+            if codec.magic is None:
+                f.seek(0)
+            return codec.load(f)
 
     def saveStrings(self, arr):
-        with open(self.fname, 'wb') as f:
+        with self.lock():
+            if self.log is not None:
+                self.log.replace(arr)
+                return
             #outside of the boundary
-            pickle.dump(arr, f)
+            replaceFile(self.fname, lambda f: self.codec.dump(arr, f), self.durability)
 
     def saveString(self, s):
-        arr = self.loadStrings()
-        arr.append(s)
-        self.saveStrings(arr)
+        # the lock spans the read and the write so no other process's append
+        # lands in between and gets lost
+        with self.lock():
+            if self.log is not None:
+                # O(1): only the new record is written
+                self.log.append(s)
+                return
+            arr = self.loadStrings()
+            arr.append(s)
+            self.saveStrings(arr)
+
+    def appendStrings(self, arr):
+        # saveString for many strings at the cost of one
+        with self.lock():
+            if self.log is not None:
+                self.log.appendMany(arr)
+                return
+            current = self.loadStrings()
+            current.extend(arr)
+            self.saveStrings(current)
+
+    def view(self):
+        # log files and utf8 snapshots are mapped and read lazily; the other
+        # codecs have to be read whole
+        with self.lock(exclusive=False):
+            if self.log is not None:
+                return self.log.view()
+            data = mapFile(self.fname)
+            if data[:MAGIC_SIZE] == Utf8Codec.magic:
+                starts, ends = stringSpans(data, MAGIC_SIZE)
+                return StringView(data, starts, ends)
+            if isinstance(data, mmap.mmap):
+                data.close()
+            return self.loadStrings()
+
+    def migrate(self):
+        # rewrites a snapshot with this MyDB's codec now instead of on the next save
+        if self.log is None:
+            with self.lock():
+                self.saveStrings(self.loadStrings())
+
+    def compact(self):
+        if self.log is not None:
+            with self.lock():
+                self.log.compact()
+
+# BufferedMyDBs that may still have queued strings, flushed when the
+# interpreter exits; held weakly so one nobody closed can still be collected
+openBuffers = weakref.WeakSet()
+
+def closeOpenBuffers():
+    for db in list(openBuffers):
+        db.close()
+
+atexit.register(closeOpenBuffers)
+
+class BufferedMyDB(MyDB):
+
+    # write-behind: saveString only queues the string, and the queue goes to
+    # disk as one appendStrings once maxPending strings are waiting,
+    # flushInterval seconds after the first of them arrived, on flush() or
+    # close(), or when the interpreter exits. loadStrings includes what is
+    # still queued; a crash loses it, and so does dropping an instance with
+    # flushInterval=None before it is flushed
+    def __init__(self, filename, maxPending=1000, flushInterval=1.0, **options):
+        self.maxPending = maxPending
+        self.flushInterval = flushInterval
+        self.pending = []
+        self.pendingLock = threading.RLock()
+        self.timer = None
+        self.stats = {"buffered": 0, "flushes": 0}
+        super().__init__(filename, **options)
+        openBuffers.add(self)
+
+    def saveString(self, s):
+        if self.log is not None or self.codec.name == "utf8":
+            # fail now, not later on a timer thread with the rest of the batch
+            encodeString(s)
+        with self.pendingLock:
+            self.pending.append(s)
+            self.stats["buffered"] += 1
+            if len(self.pending) >= self.maxPending:
+                self.flush()
+            elif self.timer is None and self.flushInterval is not None:
+                self.timer = threading.Timer(self.flushInterval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.pendingLock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, []
+            try:
+                super().appendStrings(batch)
+            except BaseException:
+                # keep the batch so the next flush tries it again
+                self.pending = batch + self.pending
+                raise
+            self.stats["flushes"] += 1
+
+    # pendingLock is always taken before the file lock, as flush() does;
+    # these would otherwise take the file lock first and reach pendingLock
+    # through loadStrings
+    def appendStrings(self, arr):
+        with self.pendingLock:
+            # queued strings were saved first, so they go first
+            self.flush()
+            super().appendStrings(arr)
+
+    def migrate(self):
+        with self.pendingLock:
+            super().migrate()
+
+    def loadStrings(self):
+        # holding pendingLock means a flush cannot move strings from the
+        # queue to the file halfway through
+        with self.pendingLock:
+            return super().loadStrings() + self.pending
+
+    def saveStrings(self, arr):
+        with self.pendingLock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.pending = []
+            super().saveStrings(arr)
+
+    def view(self):
+        with self.pendingLock:
+            self.flush()
+            return super().view()
+
+    def close(self):
+        self.flush()
+        openBuffers.discard(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,189 @@
+import asyncio
+import io
+from concurrent.futures import ThreadPoolExecutor
+from squirrel_server import SquirrelServerHandler
+
+class BufferedSquirrelHandler(SquirrelServerHandler):
+
+    # runs exactly one already-read request through the normal handler, so
+    # routing, parsePath and the do_GET/do_POST/do_PUT/do_DELETE dispatch are
+    # shared with the blocking engine; the response is collected in memory,
+    # except that a streamed one is handed to send() a chunk at a time
+    def __init__(self, requestBytes, client_address, server, requestNumber=1, send=None):
+        self.requestBytes = requestBytes
+        self.requestsHandled = requestNumber - 1
+        self.send = send
+        self.head = None
+        super().__init__(None, client_address, server)
+
+    def setup(self):
+        self.rfile = io.BytesIO(self.requestBytes)
+        self.wfile = io.BytesIO()
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+
+    def finish(self):
+        pass
+
+    def awaitNextRequest(self):
+        # the event loop has already read the whole request
+        return True
+
+    def writeChunk(self, data):
+        super().writeChunk(data)
+        if self.send is not None:
+            sent = self.wfile.getvalue()
+            if self.head is None:
+                self.head = sent
+            self.wfile.seek(0)
+            self.wfile.truncate()
+            self.send(sent)
+
+    def getResponse(self):
+        # what has not been sent yet
+        return self.wfile.getvalue()
+
+    def getResponseHead(self):
+        return self.head if self.head is not None else self.getResponse()
+
+def headerValue(head, wanted):
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == wanted:
+            return value.strip()
+    return None
+
+def contentLength(head):
+    value = headerValue(head, b"content-length")
+    return int(value) if value is not None else 0
+
+def requestPath(head):
+    parts = head.split(b"\r\n", 1)[0].split()
+    return parts[1].decode("latin-1") if len(parts) > 1 else ""
+
+def isChunked(head):
+    return b"chunked" in (headerValue(head, b"transfer-encoding") or b"").lower()
+
+def isSelfDelimiting(response):
+    head = response.split(b"\r\n\r\n", 1)[0]
+    statusLine = head.split(b"\r\n", 1)[0].split()
+    if len(statusLine) > 1 and statusLine[1] in (b"204", b"304"):
+        return True
+    for line in head.split(b"\r\n")[1:]:
+        line = line.lower()
+        if line.startswith(b"content-length:") or line.startswith(b"transfer-encoding: chunked"):
+            return True
+    return False
+
+class AsyncSquirrelServer:
+
+    def __init__(self, host="127.0.0.1", port=8080, dbWorkers=8, idleTimeout=SquirrelServerHandler.timeout, maxHeaderSize=65536):
+        self.host = host
+        self.port = port
+        self.idleTimeout = idleTimeout
+        self.maxHeaderSize = maxHeaderSize
+        # sqlite work only ever happens on these threads, never on the event loop
+        self.executor = ThreadPoolExecutor(max_workers=dbWorkers, thread_name_prefix="squirrel-db")
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handleConnection, self.host, self.port, limit=self.maxHeaderSize)
+        return self.server
+
+    async def serveForever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        self.executor.shutdown(wait=False)
+
+    def dispatch(self, requestBytes, clientAddress, requestNumber, send=None):
+        # a response without a length can only be ended by closing
+        handler = BufferedSquirrelHandler(requestBytes, clientAddress, self, requestNumber, send)
+        return handler.getResponse(), handler.close_connection or not isSelfDelimiting(handler.getResponseHead())
+
+    async def write(self, writer, data):
+        writer.write(data)
+        await writer.drain()
+
+    async def readRequest(self, reader):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.idleTimeout)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            return None
+        # the body is buffered whole, so nothing past the limit the handler
+        # will apply to this path is read: it gets what came so far, answers
+        # 413 and the connection closes
+        limit = SquirrelServerHandler.bodyLimit(requestPath(head))
+        if isChunked(head):
+            return head + await self.readChunked(reader, limit)
+        try:
+            length = contentLength(head)
+        except ValueError:
+            length = 0
+        if length > limit:
+            return head
+        body = await reader.readexactly(length) if length > 0 else b""
+        return head + body
+
+    async def readChunked(self, reader, limit):
+        # the chunked body as sent; the handler decodes it
+        parts = []
+        total = 0
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            parts.append(line)
+            try:
+                size = int(line.split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                return b"".join(parts)
+            total += size
+            if size <= 0 or total > limit:
+                break
+            parts.append(await reader.readexactly(size + 2))
+        if size == 0:
+            while True:
+                line = await reader.readuntil(b"\r\n")
+                parts.append(line)
+                if line == b"\r\n":
+                    break
+        return b"".join(parts)
+
+    async def handleConnection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        clientAddress = writer.get_extra_info("peername") or ("", 0)
+        requestNumber = 0
+        # called on an executor thread: each streamed chunk goes out and is
+        # drained before the next is produced, so memory stays flat
+        def send(data):
+            asyncio.run_coroutine_threadsafe(self.write(writer, data), loop).result()
+        try:
+            while True:
+                requestBytes = await self.readRequest(reader)
+                if requestBytes is None:
+                    break
+                requestNumber += 1
+                response, close = await loop.run_in_executor(self.executor, self.dispatch, requestBytes, clientAddress, requestNumber, send)
+                await self.write(writer, response)
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+def run(host="127.0.0.1", port=8080, dbWorkers=8):
+    server = AsyncSquirrelServer(host, port, dbWorkers)
+    print("squirrel_server running at {}:{}".format(host, port))
+    print("engine: asyncio, db workers: {}".format(dbWorkers))
+    try:
+        asyncio.run(server.serveForever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
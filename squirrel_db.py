@@ -1,4 +1,32 @@
+import json
+import logging
+import os
+import pathlib
+import queue
+import re
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from json.encoder import encode_basestring_ascii
+
+DB_PATH = "squirrel_db.db"
+PRAGMA_NAMES = ("journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store", "busy_timeout")
+# cache_size is negative KiB, mmap_size is bytes, busy_timeout is ms
+PROFILES = {
+    "default": {},
+    "balanced": {"journal_mode": "wal", "synchronous": "normal", "cache_size": -16384,
+                 "mmap_size": 268435456, "temp_store": "memory", "busy_timeout": 5000},
+    "durable": {"journal_mode": "wal", "synchronous": "full", "cache_size": -16384,
+                "temp_store": "memory", "busy_timeout": 5000},
+    "fast": {"journal_mode": "wal", "synchronous": "off", "cache_size": -65536,
+             "mmap_size": 1073741824, "temp_store": "memory", "busy_timeout": 5000},
+}
+SYNCHRONOUS_NAMES = {0: "off", 1: "normal", 2: "full", 3: "extra"}
+TEMP_STORE_NAMES = {0: "default", 1: "file", 2: "memory"}
+LIST_KEY = "squirrels"
+MISSING = object()
 
 def dict_factory(cursor, row):
     d = {}
@@ -6,36 +34,976 @@ def dict_factory(cursor, row):
         d[col[0]] = row[idx]
     return d
 
-class SquirrelDB:
+class Squirrel:
+    # one row of the squirrels table; slots instead of a per-row dict keeps a
+    # cached list several times smaller, and row["id"] still works for code
+    # written against dict rows
+    __slots__ = ("id", "name", "size")
+
+    def __init__(self, id, name, size):
+        self.id = id
+        self.name = name
+        self.size = size
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __eq__(self, other):
+        if isinstance(other, Squirrel):
+            return (self.id, self.name, self.size) == (other.id, other.name, other.size)
+        if isinstance(other, dict):
+            return self.toDict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "Squirrel(id={!r}, name={!r}, size={!r})".format(self.id, self.name, self.size)
+
+    def toDict(self):
+        return {"id": self.id, "name": self.name, "size": self.size}
+
+    def toJSON(self):
+        # same text json.dumps(self.toDict()) produces, without building the dict
+        return '{"id": ' + encodeValue(self.id) + ', "name": ' + encodeValue(self.name) + ', "size": ' + encodeValue(self.size) + '}'
+
+# the column order squirrel_factory unpacks; queries for whole squirrels select
+# exactly these so the factory never has to look at cursor.description
+SQUIRREL_COLUMNS = "id, name, size"
+# fixed statements, built once so every call hands sqlite3 the exact same text
+# and hits the per-connection statement cache
+SELECT_ALL_SQL = "SELECT {} FROM squirrels ORDER BY id".format(SQUIRREL_COLUMNS)
+SELECT_PAGE_SQL = "SELECT {} FROM squirrels WHERE id > ? ORDER BY id LIMIT ?".format(SQUIRREL_COLUMNS)
+SELECT_ONE_SQL = "SELECT {} FROM squirrels WHERE id = ?".format(SQUIRREL_COLUMNS)
+INSERT_SQL = "INSERT INTO squirrels (name, size) VALUES (?, ?)"
+UPDATE_SQL = "UPDATE squirrels SET name = ?, size = ? WHERE id = ?"
+DELETE_SQL = "DELETE FROM squirrels WHERE id = ?"
+# prepared on every new pooled connection; parameters that match nothing, so
+# warming costs an index probe each. Writes are left to warm on first use,
+# preparing them here would mean opening a write transaction
+PREWARM_STATEMENTS = (
+    (SELECT_ONE_SQL, (-1,)),
+    (SELECT_PAGE_SQL, (-1, 0)),
+    ("SELECT 1", ()),
+)
+
+def squirrel_factory(cursor, row):
+    return Squirrel(*row)
+
+def encodeValue(value):
+    if type(value) is str:
+        return encode_basestring_ascii(value)
+    if type(value) is int:
+        return int.__repr__(value)
+    if value is None:
+        return "null"
+    return json.dumps(value)
+
+def toJSON(value):
+    # json.dumps for everything the API returns, with Squirrel records written
+    # directly; lists are joined the way json.dumps joins them
+    if type(value) is Squirrel:
+        return value.toJSON()
+    if type(value) is list:
+        return "[" + ", ".join(item.toJSON() if type(item) is Squirrel else json.dumps(item) for item in value) + "]"
+    return json.dumps(value)
+
+slowQueryLog = logging.getLogger("squirrel_db.slow")
+traceLog = logging.getLogger("squirrel_db.trace")
+
+def traceStatement(sql):
+    # a ready-made trace callback: every statement sqlite runs, at INFO
+    traceLog.info("%s", sql)
+
+class StatementCountingConnection(sqlite3.Connection):
+
+    # sqlite3 keeps an LRU of prepared statements per connection, keyed by the
+    # SQL text, but says nothing about how well it works; this mirrors that
+    # LRU at the same size to count hits and misses
+    def __init__(self, *args, cached_statements=128, **kwargs):
+        super().__init__(*args, cached_statements=cached_statements, **kwargs)
+        self.cachedStatements = cached_statements
+        self.seenStatements = OrderedDict()
+        self.statementStats = {"hits": 0, "misses": 0, "slowQueries": 0}
+        # seconds; None leaves statements untimed
+        self.slowQuerySeconds = None
+
+    def noteStatement(self, sql):
+        if sql in self.seenStatements:
+            self.seenStatements.move_to_end(sql)
+            self.statementStats["hits"] += 1
+            return
+        self.statementStats["misses"] += 1
+        if self.cachedStatements > 0:
+            self.seenStatements[sql] = True
+            if len(self.seenStatements) > self.cachedStatements:
+                self.seenStatements.popitem(last=False)
+
+    def noteSlowQuery(self, sql, parameters, seconds):
+        self.statementStats["slowQueries"] += 1
+        if parameters is None:
+            parameters = "(executemany)"
+        else:
+            parameters = repr(parameters)
+            if len(parameters) > 200:
+                parameters = parameters[:200] + "..."
+        slowQueryLog.warning("slow query: %.1f ms: %s %s", seconds * 1000, " ".join(sql.split()), parameters)
+
+    def cursor(self, factory=None):
+        if factory is None:
+            factory = StatementCountingCursor if self.slowQuerySeconds is None else SlowQueryCursor
+        return super().cursor(factory)
+
+    # sqlite3.Connection.execute makes a plain cursor, so with a slow query
+    # threshold statements go through a SlowQueryCursor instead
+    def execute(self, sql, parameters=()):
+        if self.slowQuerySeconds is not None:
+            return self.cursor().execute(sql, parameters)
+        self.noteStatement(sql)
+        return super().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        if self.slowQuerySeconds is not None:
+            return self.cursor().executemany(sql, parameters)
+        self.noteStatement(sql)
+        return super().executemany(sql, parameters)
+
+class StatementCountingCursor(sqlite3.Cursor):
+
+    def execute(self, sql, parameters=()):
+        self.connection.noteStatement(sql)
+        return super().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        self.connection.noteStatement(sql)
+        return super().executemany(sql, parameters)
+
+class SlowQueryCursor(StatementCountingCursor):
+
+    # sqlite runs a SELECT a step at a time as rows are fetched, so a
+    # statement's time is its execute plus every fetch after it; it is logged
+    # once, as soon as that total passes the connection's threshold
+    sql = None
+
+    def startStatement(self, sql, parameters):
+        self.sql = sql
+        self.parameters = parameters
+        self.elapsed = 0.0
+        self.logged = False
+
+    def timeStep(self, function, *args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            if self.sql is not None:
+                self.elapsed += time.perf_counter() - start
+                if not self.logged and self.elapsed >= self.connection.slowQuerySeconds:
+                    self.logged = True
+                    self.connection.noteSlowQuery(self.sql, self.parameters, self.elapsed)
+
+    def execute(self, sql, parameters=()):
+        self.startStatement(sql, parameters)
+        return self.timeStep(super().execute, sql, parameters)
+
+    def executemany(self, sql, parameters):
+        self.startStatement(sql, None)
+        return self.timeStep(super().executemany, sql, parameters)
+
+    def fetchone(self):
+        return self.timeStep(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self.timeStep(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self.timeStep(super().fetchall)
+
+    def __next__(self):
+        return self.timeStep(super().__next__)
+
+class PoolTimeout(Exception):
+    pass
+
+def checkPragmas(pragmas):
+    # PRAGMA values cannot be bound as parameters, so only plain numbers and
+    # words get anywhere near the SQL text
+    for name, value in pragmas.items():
+        if name not in PRAGMA_NAMES:
+            raise ValueError("unsupported pragma: {}".format(name))
+        if not re.fullmatch(r"-?\d+|[A-Za-z]+", str(value)):
+            raise ValueError("bad value for {}: {!r}".format(name, value))
+    return pragmas
+
+def applyPragmas(connection, pragmas):
+    # journal_mode lives in the database file and is set once at startup by
+    # applyProfile, not on every pooled connection
+    for name, value in pragmas.items():
+        if name != "journal_mode":
+            connection.execute("PRAGMA {} = {}".format(name, value))
+
+def readPragmas(connection):
+    cursor = connection.cursor()
+    cursor.row_factory = None
+    settings = {}
+    for name in PRAGMA_NAMES:
+        settings[name] = cursor.execute("PRAGMA {}".format(name)).fetchone()[0]
+    settings["synchronous"] = SYNCHRONOUS_NAMES.get(settings["synchronous"], settings["synchronous"])
+    settings["temp_store"] = TEMP_STORE_NAMES.get(settings["temp_store"], settings["temp_store"])
+    return settings
+
+class SquirrelConnectionPool:
+
+    def __init__(self, path=DB_PATH, maxSize=8, timeout=5.0, healthCheckInterval=30.0, pragmas=None, cachedStatements=256, prewarm=True, readOnly=False,
+                 slowQueryMs=None, traceCallback=None, progressHandler=None, progressInterval=1000):
+        self.path = path
+        self.readOnly = readOnly
+        # statements slower than slowQueryMs are logged; the callbacks go
+        # straight to sqlite3's set_trace_callback and set_progress_handler
+        self.slowQueryMs = slowQueryMs
+        self.traceCallback = traceCallback
+        self.progressHandler = progressHandler
+        self.progressInterval = progressInterval
+        self.pragmas = checkPragmas(dict(pragmas or {}))
+        self.cachedStatements = cachedStatements
+        self.prewarm = prewarm
+        self.connections = set()
+        self.retiredStatementStats = {"hits": 0, "misses": 0, "slowQueries": 0}
+        self.maxSize = maxSize
+        self.timeout = timeout
+        self.healthCheckInterval = healthCheckInterval
+        self.idle = []
+        self.size = 0
+        self.closed = False
+        self.local = threading.local()
+        self.condition = threading.Condition()
+        self.stats = {"acquires": 0, "hits": 0, "reuses": 0, "waits": 0, "opens": 0, "discards": 0, "timeouts": 0}
+
+    def connect(self):
+        # connections move between threads as they are handed out, so sqlite's
+        # same-thread check has to be off; the pool guarantees one user at a time
+        if self.readOnly:
+            # sqlite itself refuses writes on these, so a routing mistake
+            # fails loudly instead of racing the writer
+            target, uri = pathlib.Path(self.path).absolute().as_uri() + "?mode=ro", True
+        else:
+            target, uri = self.path, False
+        connection = sqlite3.connect(target, check_same_thread=False, cached_statements=self.cachedStatements,
+                                     factory=StatementCountingConnection, uri=uri)
+        applyPragmas(connection, self.pragmas)
+        connection.row_factory = dict_factory
+        if self.slowQueryMs is not None:
+            connection.slowQuerySeconds = self.slowQueryMs / 1000.0
+        if self.traceCallback is not None:
+            connection.set_trace_callback(self.traceCallback)
+        if self.progressHandler is not None:
+            connection.set_progress_handler(self.progressHandler, self.progressInterval)
+        if self.prewarm:
+            try:
+                for sql, data in PREWARM_STATEMENTS:
+                    connection.execute(sql, data).close()
+            except sqlite3.OperationalError:
+                # no squirrels table yet; the statements warm on first use instead
+                pass
+        with self.condition:
+            self.connections.add(connection)
+        return connection
+
+    def isHealthy(self, connection):
+        try:
+            connection.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        connection, idleSince = self.checkout()
+        if connection is None:
+            connection = self.open()
+        elif time.monotonic() - idleSince >= self.healthCheckInterval and not self.isHealthy(connection):
+            with self.condition:
+                self.stats["discards"] += 1
+            self.closeQuietly(connection)
+            connection = self.open()
+        self.local.connection = connection
+        return connection
+
+    def checkout(self):
+        deadline = time.monotonic() + self.timeout
+        with self.condition:
+            if self.closed:
+                raise PoolTimeout("connection pool is closed")
+            self.stats["acquires"] += 1
+            waited = False
+            while True:
+                if self.idle:
+                    self.stats["hits"] += 1
+                    return self.takeIdle()
+                if self.size < self.maxSize:
+                    # reserve the slot now, open the connection outside the lock
+                    self.size += 1
+                    return None, None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats["timeouts"] += 1
+                    raise PoolTimeout("no connection available after {}s".format(self.timeout))
+                if not waited:
+                    self.stats["waits"] += 1
+                    waited = True
+                self.condition.wait(remaining)
+
+    def takeIdle(self):
+        # prefer the connection this thread used last so its page cache stays warm
+        preferred = getattr(self.local, "connection", None)
+        for idx, (connection, idleSince) in enumerate(self.idle):
+            if connection is preferred:
+                self.stats["reuses"] += 1
+                return self.idle.pop(idx)
+        return self.idle.pop()
+
+    def open(self):
+        try:
+            connection = self.connect()
+        except BaseException:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.stats["opens"] += 1
+        return connection
+
+    def release(self, connection):
+        broken = False
+        if connection.in_transaction:
+            try:
+                connection.rollback()
+            except sqlite3.Error:
+                broken = True
+        with self.condition:
+            if self.closed or broken:
+                self.size -= 1
+                self.closeQuietly(connection)
+            else:
+                self.idle.append((connection, time.monotonic()))
+            self.condition.notify()
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.size -= len(idle)
+            self.condition.notify_all()
+        for connection, idleSince in idle:
+            self.closeQuietly(connection)
+
+    def closeQuietly(self, connection):
+        with self.condition:
+            if connection in self.connections:
+                self.connections.discard(connection)
+                for name, value in connection.statementStats.items():
+                    self.retiredStatementStats[name] += value
+        try:
+            connection.close()
+        except sqlite3.Error:
+            pass
+
+    def getStatementStats(self):
+        # read without stopping the connections' owners, so counts can be a
+        # call or two behind
+        with self.condition:
+            stats = dict(self.retiredStatementStats)
+            for connection in self.connections:
+                for name, value in connection.statementStats.items():
+                    stats[name] += value
+        total = stats["hits"] + stats["misses"]
+        stats["hitRate"] = stats["hits"] / total if total else 0.0
+        stats["cachedStatements"] = self.cachedStatements
+        return stats
+
+    def getStats(self):
+        with self.condition:
+            stats = dict(self.stats)
+            stats["size"] = self.size
+            stats["idle"] = len(self.idle)
+            stats["maxSize"] = self.maxSize
+        return stats
+
+defaultPool = None
+defaultReadPool = None
+defaultPoolLock = threading.Lock()
+# readers=0 serves reads and writes from one pool of poolSize connections;
+# readers=N gives writes a single connection and reads N read-only ones
+settings = {"path": DB_PATH, "pragmas": {}, "poolSize": 8, "cachedStatements": 256, "readers": 0,
+            "slowQueryMs": None, "traceCallback": None, "progressHandler": None, "progressInterval": 1000}
+
+def poolOptions():
+    return {name: settings[name] for name in ("pragmas", "cachedStatements", "slowQueryMs", "traceCallback",
+                                              "progressHandler", "progressInterval")}
+
+def getPool():
+    # the pool writes go through
+    global defaultPool
+    if defaultPool is None:
+        with defaultPoolLock:
+            if defaultPool is None:
+                # one writer connection: writes queue in the pool rather than
+                # on sqlite's busy handler
+                size = 1 if settings["readers"] else settings["poolSize"]
+                defaultPool = SquirrelConnectionPool(settings["path"], size, **poolOptions())
+    return defaultPool
 
+def getReadPool():
+    global defaultReadPool
+    if not settings["readers"]:
+        return getPool()
+    if defaultReadPool is None:
+        with defaultPoolLock:
+            if defaultReadPool is None:
+                defaultReadPool = SquirrelConnectionPool(settings["path"], settings["readers"], readOnly=True, **poolOptions())
+    return defaultReadPool
+
+def configure(path=None, profile="default", pragmas=None, poolSize=None, cachedStatements=None, readers=None,
+              slowQueryMs=None, traceCallback=None, progressHandler=None, progressInterval=None):
+    if profile not in PROFILES:
+        raise ValueError("unknown profile: {}".format(profile))
+    merged = dict(PROFILES[profile])
+    merged.update(pragmas or {})
+    settings["pragmas"] = checkPragmas(merged)
+    if path is not None:
+        settings["path"] = path
+    if poolSize is not None:
+        settings["poolSize"] = poolSize
+    if cachedStatements is not None:
+        settings["cachedStatements"] = cachedStatements
+    if readers is not None:
+        settings["readers"] = readers
+    for name, value in (("slowQueryMs", slowQueryMs), ("traceCallback", traceCallback),
+                        ("progressHandler", progressHandler), ("progressInterval", progressInterval)):
+        if value is not None:
+            settings[name] = value
+    # connections and cached rows may belong to another database now
+    resetPool()
+    if defaultCache is not None:
+        defaultCache.clear()
+
+def applyProfile():
+    # run once at startup: sets the persistent journal_mode, then reports
+    # what sqlite actually uses, which can differ from what was asked for
+    # (mmap_size is capped at compile time, WAL needs a local filesystem)
+    connection = sqlite3.connect(settings["path"])
+    try:
+        if "journal_mode" in settings["pragmas"]:
+            connection.execute("PRAGMA journal_mode = {}".format(settings["pragmas"]["journal_mode"])).fetchone()
+        applyPragmas(connection, settings["pragmas"])
+        effective = readPragmas(connection)
+    finally:
+        connection.close()
+    mismatches = {}
+    for name, value in settings["pragmas"].items():
+        if str(effective[name]).lower() != str(value).lower():
+            mismatches[name] = (value, effective[name])
+    return effective, mismatches
+
+# schema versions, stored in PRAGMA user_version. Each step runs in its own
+# transaction together with the version bump, so a crash leaves the database
+# at the previous version and the step is simply run again. Steps are
+# written to also upgrade databases created before versioning existed.
+MIGRATIONS = (
+    (1, ("CREATE TABLE IF NOT EXISTS squirrels (id INTEGER PRIMARY KEY, name TEXT, size TEXT)",)),
+    # the filters findSquirrels offers; index entries with the same name or
+    # size are kept in rowid order, so equality filters come back sorted by id
+    (2, ("CREATE INDEX IF NOT EXISTS squirrels_name ON squirrels (name)",
+         "CREATE INDEX IF NOT EXISTS squirrels_size ON squirrels (size)")),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def schemaVersion(connection):
+    cursor = connection.cursor()
+    cursor.row_factory = None
+    return cursor.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(path=None):
+    # run once at startup, not per connection. BEGIN IMMEDIATE plus reading
+    # the version inside the transaction lets several processes start at
+    # once: whoever gets the write lock first upgrades, the rest find it done
+    connection = sqlite3.connect(path or settings["path"], isolation_level=None)
+    try:
+        startVersion = version = schemaVersion(connection)
+        if version > SCHEMA_VERSION:
+            raise RuntimeError("database schema version {} is newer than this code ({})".format(version, SCHEMA_VERSION))
+        for target, statements in MIGRATIONS:
+            if target <= version:
+                continue
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                version = schemaVersion(connection)
+                if target > version:
+                    for statement in statements:
+                        connection.execute(statement)
+                    connection.execute("PRAGMA user_version = {}".format(target))
+                    version = target
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+    finally:
+        connection.close()
+    return startVersion, version
+
+def resetPool(pool=None, readPool=None):
+    global defaultPool, defaultReadPool
+    with defaultPoolLock:
+        old = (defaultPool, defaultReadPool)
+        defaultPool, defaultReadPool = pool, readPool
+    for oldPool in old:
+        if oldPool is not None:
+            oldPool.close()
+
+class LRUCache:
+
+    # maxSize=0 turns the cache off: nothing is stored and every get misses
+    def __init__(self, maxSize=1024, ttl=30.0):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return MISSING
+            expiresAt, value = entry
+            if time.monotonic() >= expiresAt:
+                del self.entries[key]
+                self.stats["expirations"] += 1
+                self.stats["misses"] += 1
+                return MISSING
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return value
+
+    def put(self, key, value, generation=None):
+        with self.lock:
+            # a write invalidated something after this value was read, so it
+            # may already be stale; skip it rather than cache old data
+            if self.maxSize <= 0 or (generation is not None and generation != self.generation):
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate(self, *keys):
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                if self.entries.pop(key, None) is not None:
+                    self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["size"] = len(self.entries)
+            stats["maxSize"] = self.maxSize
+        return stats
+
+defaultCache = None
+defaultCacheLock = threading.Lock()
+
+def getCache():
+    global defaultCache
+    if defaultCache is None:
+        with defaultCacheLock:
+            if defaultCache is None:
+                defaultCache = LRUCache()
+    return defaultCache
+
+def resetCache(cache=None):
+    global defaultCache
+    with defaultCacheLock:
+        defaultCache = cache
+
+class TableVersion:
+
+    # bumped after every committed write through SquirrelDB; the epoch keeps
+    # a restarted process from reusing version numbers it handed out before
     def __init__(self):
-        self.connection = sqlite3.connect("squirrel_db.db")
-        self.connection.row_factory = dict_factory
-        self.cursor = self.connection.cursor()
+        self.epoch = os.urandom(4).hex()
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def bump(self):
+        with self.lock:
+            self.value += 1
+
+    def current(self):
+        return "{}-{}".format(self.epoch, self.value)
+
+squirrelsVersion = TableVersion()
+
+class PendingWrite:
+
+    def __init__(self, sql, data):
+        self.sql = sql
+        self.data = data
+        self.rowcount = None
+        self.error = None
+        self.done = threading.Event()
+
+class GroupCommitWriter:
+
+    # single-row writes from many handler threads are queued to one writer
+    # thread, which runs whatever has gathered (up to maxBatch, waiting at
+    # most `window` seconds for more) in one transaction with one commit.
+    # Each write gets its own savepoint, so a failing statement only fails
+    # the caller that sent it
+    def __init__(self, pool=None, window=0.0, maxBatch=128):
+        # no pool means the default one, looked up per batch so a pool
+        # replaced after a fork is picked up
+        self.pool = pool
+        self.window = window
+        self.maxBatch = maxBatch
+        self.pending = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stats = {"writes": 0, "batches": 0, "largestBatch": 0, "failures": 0}
+
+    def start(self):
+        # started on first use, so a writer configured before a fork gets
+        # its thread in the worker process that actually uses it
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="squirrel-group-commit", daemon=True)
+                self.thread.start()
+
+    def submit(self, sql, data):
+        if self.thread is None or not self.thread.is_alive():
+            self.start()
+        write = PendingWrite(sql, data)
+        self.pending.put(write)
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write.rowcount
+
+    def stop(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.pending.put(None)
+            thread.join()
+
+    def run(self):
+        while True:
+            write = self.pending.get()
+            if write is None:
+                return
+            batch = [write]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.maxBatch:
+                try:
+                    if self.window > 0:
+                        write = self.pending.get(timeout=max(deadline - time.monotonic(), 0))
+                    else:
+                        write = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+                if write is None:
+                    self.pending.put(None)
+                    break
+                batch.append(write)
+            self.commitBatch(batch)
+
+    def commitBatch(self, batch):
+        pool = self.pool if self.pool is not None else getPool()
+        try:
+            with pool.connection() as connection:
+                connection.execute("BEGIN IMMEDIATE")
+                for write in batch:
+                    connection.execute("SAVEPOINT pending_write")
+                    try:
+                        write.rowcount = connection.execute(write.sql, write.data).rowcount
+                    except sqlite3.Error as error:
+                        write.error = error
+                        connection.execute("ROLLBACK TO pending_write")
+                    connection.execute("RELEASE pending_write")
+                connection.commit()
+        except Exception as error:
+            for write in batch:
+                if write.error is None:
+                    write.error = error
+        finally:
+            with self.lock:
+                self.stats["writes"] += len(batch)
+                self.stats["batches"] += 1
+                self.stats["largestBatch"] = max(self.stats["largestBatch"], len(batch))
+                self.stats["failures"] += sum(1 for write in batch if write.error is not None)
+            for write in batch:
+                write.done.set()
+
+    def getStats(self):
+        with self.lock:
+            return dict(self.stats)
+
+defaultWriter = None
+defaultWriterLock = threading.Lock()
+
+def getWriter():
+    return defaultWriter
+
+def resetWriter(writer=None):
+    global defaultWriter
+    with defaultWriterLock:
+        old, defaultWriter = defaultWriter, writer
+    if old is not None:
+        old.stop()
+
+def normalizeId(squirrelId):
+    # "1" from a URL and 1 from python name the same row; 1.5 names none,
+    # so it must not be truncated onto row 1
+    if isinstance(squirrelId, float) and not squirrelId.is_integer():
+        return squirrelId
+    try:
+        return int(squirrelId)
+    except (TypeError, ValueError):
+        return squirrelId
+
+def cacheKey(squirrelId):
+    return ("squirrel", normalizeId(squirrelId))
+
+def prefixUpperBound(prefix):
+    # the smallest string greater than every string starting with prefix, so
+    # a prefix match is a range on the name index; LIKE only uses an index
+    # under case_sensitive_like. None means the range has no upper end
+    while prefix:
+        last = ord(prefix[-1]) + 1
+        if 0xD800 <= last <= 0xDFFF:
+            last = 0xE000
+        if last <= 0x10FFFF:
+            return prefix[:-1] + chr(last)
+        prefix = prefix[:-1]
+    return None
+
+def squirrelsQuery(name=None, size=None, namePrefix=None, afterId=0, limit=None):
+    # with only a range on name to go on, sqlite would rather walk the whole
+    # table in id order than sort; the unary + keeps it off the rowid so the
+    # name index is used and only the matches get sorted
+    clauses = ["+id > ?" if namePrefix is not None and name is None else "id > ?"]
+    data = [afterId]
+    if name is not None:
+        clauses.append("name = ?")
+        data.append(name)
+    if namePrefix is not None:
+        clauses.append("name >= ?")
+        data.append(namePrefix)
+        upper = prefixUpperBound(namePrefix)
+        if upper is not None:
+            clauses.append("name < ?")
+            data.append(upper)
+    if size is not None:
+        clauses.append("size = ?")
+        data.append(size)
+    sql = "SELECT {} FROM squirrels WHERE {} ORDER BY id".format(SQUIRREL_COLUMNS, " AND ".join(clauses))
+    if limit is not None:
+        sql += " LIMIT ?"
+        data.append(limit)
+    return sql, data
+
+def selectSquirrels(connection, sql, data=()):
+    # pooled connections hand back dicts for ad-hoc queries; whole squirrels
+    # come back as Squirrel records
+    cursor = connection.cursor()
+    cursor.row_factory = squirrel_factory
+    return cursor.execute(sql, data)
+
+class SquirrelDB:
+
+    def __init__(self, pool=None, cache=None, writer=None, readPool=None):
+        # reads go to readPool and writes to pool; given only a pool, it
+        # serves both
+        if pool is None:
+            pool = getPool()
+            if readPool is None:
+                readPool = getReadPool()
+        if readPool is None:
+            readPool = pool
+        if cache is None:
+            cache = getCache()
+        if writer is None:
+            writer = getWriter()
+        self.pool = pool
+        self.readPool = readPool
+        self.cache = cache
+        self.writer = writer
 
     def getSquirrels(self):
-        self.cursor.execute("SELECT * FROM squirrels ORDER BY id")
-        return self.cursor.fetchall()
+        squirrels = self.cache.get(LIST_KEY)
+        if squirrels is not MISSING:
+            return squirrels
+        generation = self.cache.generation
+        with self.readPool.connection() as connection:
+            squirrels = selectSquirrels(connection, SELECT_ALL_SQL).fetchall()
+        self.cache.put(LIST_KEY, squirrels, generation)
+        return squirrels
+
+    def getSquirrelsPage(self, afterId=0, limit=100):
+        # keyset pagination: the id index jumps straight to the page, so deep
+        # pages cost the same as the first one, unlike OFFSET
+        with self.readPool.connection() as connection:
+            return selectSquirrels(connection, SELECT_PAGE_SQL, (afterId, limit)).fetchall()
+
+    def findSquirrels(self, name=None, size=None, namePrefix=None, afterId=0, limit=None):
+        sql, data = squirrelsQuery(name, size, namePrefix, afterId, limit)
+        with self.readPool.connection() as connection:
+            return selectSquirrels(connection, sql, data).fetchall()
+
+    def iterSquirrels(self, chunkSize=500, **filters):
+        # one keyset page per chunk rather than one long-lived cursor, so the
+        # pooled connection goes back between chunks and a slow client on the
+        # other end of a stream never pins it
+        afterId = 0
+        while True:
+            if filters:
+                squirrels = self.findSquirrels(afterId=afterId, limit=chunkSize, **filters)
+            else:
+                squirrels = self.getSquirrelsPage(afterId, chunkSize)
+            if squirrels:
+                yield squirrels
+            if len(squirrels) < chunkSize:
+                return
+            afterId = squirrels[-1]["id"]
 
     def getSquirrel(self, squirrelId):
-        data = [squirrelId]
-        self.cursor.execute("SELECT * FROM squirrels WHERE id = ?", data)
-        return self.cursor.fetchone()
+        key = cacheKey(squirrelId)
+        squirrel = self.cache.get(key)
+        if squirrel is not MISSING:
+            return squirrel
+        generation = self.cache.generation
+        with self.readPool.connection() as connection:
+            squirrel = selectSquirrels(connection, SELECT_ONE_SQL, (squirrelId,)).fetchone()
+        if squirrel is not None:
+            self.cache.put(key, squirrel, generation)
+        return squirrel
+
+    def createSquirrels(self, rows):
+        return self.applyBulk([("create", name, size) for name, size in rows])
+
+    def updateSquirrels(self, rows):
+        return self.applyBulk([("update", squirrelId, name, size) for squirrelId, name, size in rows])
+
+    def deleteSquirrels(self, squirrelIds):
+        return self.applyBulk([("delete", squirrelId) for squirrelId in squirrelIds])
+
+    def applyBulk(self, operations):
+        # every operation runs in one transaction and one commit; consecutive
+        # operations of the same kind go to sqlite as a single executemany.
+        # Results line up with operations: the new id for a create, and
+        # whether the squirrel existed for an update or delete
+        results = []
+        touched = [LIST_KEY]
+        with self.pool.connection() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            start = 0
+            while start < len(operations):
+                op = operations[start][0]
+                end = start
+                while end < len(operations) and operations[end][0] == op:
+                    end += 1
+                run = operations[start:end]
+                if op == "create":
+                    results.extend(self.bulkCreate(connection, run))
+                elif op == "update":
+                    results.extend(self.bulkUpdate(connection, run))
+                    touched.extend(cacheKey(operation[1]) for operation in run)
+                elif op == "delete":
+                    results.extend(self.bulkDelete(connection, run))
+                    touched.extend(cacheKey(operation[1]) for operation in run)
+                else:
+                    raise ValueError("unknown bulk operation: {}".format(op))
+                start = end
+            connection.commit()
+        if operations:
+            self.invalidated(*touched)
+        return results
+
+    def bulkCreate(self, connection, run):
+        # the write lock is held, so every row above the current max id is ours
+        maxId = connection.execute("SELECT COALESCE(MAX(id), 0) AS maxId FROM squirrels").fetchone()["maxId"]
+        connection.executemany(INSERT_SQL, [operation[1:] for operation in run])
+        return [row["id"] for row in connection.execute("SELECT id FROM squirrels WHERE id > ? ORDER BY id", [maxId])]
+
+    def existingIds(self, connection, squirrelIds):
+        existing = set()
+        squirrelIds = list(squirrelIds)
+        for start in range(0, len(squirrelIds), 500):
+            chunk = squirrelIds[start:start + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            rows = connection.execute("SELECT id FROM squirrels WHERE id IN ({})".format(placeholders), chunk)
+            existing.update(row["id"] for row in rows)
+        return existing
+
+    def bulkUpdate(self, connection, run):
+        existing = self.existingIds(connection, [operation[1] for operation in run])
+        connection.executemany(UPDATE_SQL, [(name, size, squirrelId) for op, squirrelId, name, size in run])
+        return [normalizeId(operation[1]) in existing for operation in run]
+
+    def bulkDelete(self, connection, run):
+        existing = self.existingIds(connection, [operation[1] for operation in run])
+        connection.executemany(DELETE_SQL, [operation[1:] for operation in run])
+        results = []
+        for operation in run:
+            squirrelId = normalizeId(operation[1])
+            results.append(squirrelId in existing)
+            # deleting the same id twice only finds it the first time
+            existing.discard(squirrelId)
+        return results
+
+    def invalidated(self, *keys):
+        # cache first: a read between the two would otherwise see the new
+        # ETag with the old cached rows, and keep them under that ETag
+        self.cache.invalidate(*keys)
+        squirrelsVersion.bump()
+
+    def write(self, sql, data):
+        if self.writer is not None:
+            return self.writer.submit(sql, data)
+        with self.pool.connection() as connection:
+            rowcount = connection.execute(sql, data).rowcount
+            connection.commit()
+        return rowcount
 
     def createSquirrel(self, name, size):
-        data = [name, size]
-        self.cursor.execute("INSERT INTO squirrels (name, size) VALUES (?, ?)", data)
-        self.connection.commit()
+        self.write(INSERT_SQL, (name, size))
+        self.invalidated(LIST_KEY)
         return None
 
     def updateSquirrel(self, squirrelId, name, size):
-        data = [name, size, squirrelId]
-        self.cursor.execute("UPDATE squirrels SET name = ?, size = ? WHERE id = ?", data)
-        self.connection.commit()
+        self.write(UPDATE_SQL, (name, size, squirrelId))
+        self.invalidated(LIST_KEY, cacheKey(squirrelId))
         return None
 
     def deleteSquirrel(self, squirrelId):
-        data = [squirrelId]
-        self.cursor.execute("DELETE FROM squirrels WHERE id = ?", data)
-        self.connection.commit()
+        self.write(DELETE_SQL, (squirrelId,))
+        self.invalidated(LIST_KEY, cacheKey(squirrelId))
         return None
@@ -0,0 +1,303 @@
+import atexit
+import cProfile
+import inspect
+import io
+import marshal
+import os
+import pstats
+import queue
+import re
+import sys
+import threading
+import time
+from bisect import bisect_left
+
+# request latency histogram bounds, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+STAGES = ("db", "encode")
+
+def labelText(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append('{}="{}"'.format(name, value))
+    return "{" + ",".join(pairs) + "}"
+
+def metricName(name):
+    # getStats() keys are camelCase; prometheus names are snake_case
+    return re.sub(r"([A-Z])", r"_\1", name).lower()
+
+def renderStats(prefix, stats, labels=None):
+    # one gauge per numeric value of a getStats() dict
+    lines = []
+    for name, value in stats.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        fullName = "{}_{}".format(prefix, metricName(name))
+        lines.append("# TYPE {} gauge".format(fullName))
+        lines.append("{}{} {}".format(fullName, labelText(labels), value))
+    return lines
+
+class RequestMetrics:
+
+    # one lock around plain dicts: a record is a few dict updates, far below
+    # the cost of the request it describes
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.latency = {}
+        self.stageSeconds = {}
+        self.bytesWritten = {}
+
+    def record(self, method, route, status, seconds, stages, bytesWritten):
+        bucket = bisect_left(self.buckets, seconds)
+        with self.lock:
+            key = (method, route, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.latency.get((method, route))
+            if histogram is None:
+                histogram = self.latency[(method, route)] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+            for stage, stageSeconds in stages.items():
+                self.stageSeconds[(route, stage)] = self.stageSeconds.get((route, stage), 0.0) + stageSeconds
+            self.bytesWritten[route] = self.bytesWritten.get(route, 0) + bytesWritten
+
+    def render(self):
+        with self.lock:
+            requests = dict(self.requests)
+            latency = {key: (list(counts), total, count) for key, (counts, total, count) in self.latency.items()}
+            stageSeconds = dict(self.stageSeconds)
+            bytesWritten = dict(self.bytesWritten)
+        lines = [
+            "# HELP squirrel_http_requests_total Requests answered, by method, route and status.",
+            "# TYPE squirrel_http_requests_total counter",
+        ]
+        for (method, route, status), count in sorted(requests.items()):
+            lines.append("squirrel_http_requests_total{} {}".format(labelText({"method": method, "route": route, "status": status}), count))
+        lines.append("# HELP squirrel_http_request_duration_seconds Time from the request line to the end of the response.")
+        lines.append("# TYPE squirrel_http_request_duration_seconds histogram")
+        for (method, route), (counts, total, count) in sorted(latency.items()):
+            cumulative = 0
+            for bound, bucketCount in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucketCount
+                labels = labelText({"method": method, "route": route, "le": bound})
+                lines.append("squirrel_http_request_duration_seconds_bucket{} {}".format(labels, cumulative))
+            labels = labelText({"method": method, "route": route})
+            lines.append("squirrel_http_request_duration_seconds_sum{} {:.6f}".format(labels, total))
+            lines.append("squirrel_http_request_duration_seconds_count{} {}".format(labels, count))
+        lines.append("# HELP squirrel_http_stage_seconds_total Request time spent in the database and in JSON encoding.")
+        lines.append("# TYPE squirrel_http_stage_seconds_total counter")
+        for (route, stage), seconds in sorted(stageSeconds.items()):
+            lines.append("squirrel_http_stage_seconds_total{} {:.6f}".format(labelText({"route": route, "stage": stage}), seconds))
+        lines.append("# HELP squirrel_http_response_bytes_total Bytes written in responses, headers included.")
+        lines.append("# TYPE squirrel_http_response_bytes_total counter")
+        for route, count in sorted(bytesWritten.items()):
+            lines.append("squirrel_http_response_bytes_total{} {}".format(labelText({"route": route}), count))
+        return lines
+
+class CountingWriter:
+    # wraps a handler's wfile and counts what goes through it
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return self.wfile.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.wfile, name)
+
+class DeferredWriter:
+    # holds back the last write until the next write or flush, so a response
+    # larger than wfile's buffer still has its end waiting for the final flush
+    # of handle_one_request; flush() lets streamed chunks out as before
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.held = None
+
+    def write(self, data):
+        if self.held is not None:
+            self.wfile.write(self.held)
+        self.held = bytes(data)
+        return len(data)
+
+    def flush(self):
+        if self.held is not None:
+            held, self.held = self.held, None
+            self.wfile.write(held)
+        self.wfile.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.wfile, name)
+
+class TimedDB:
+    # stands in front of a SquirrelDB and adds the time of every call, and of
+    # every step through a returned generator, to timings["db"]
+
+    def __init__(self, db, timings):
+        self.db = db
+        self.timings = timings
+
+    def __getattr__(self, name):
+        attribute = getattr(self.db, name)
+        if not callable(attribute):
+            return attribute
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = attribute(*args, **kwargs)
+            finally:
+                self.timings["db"] += time.perf_counter() - start
+            if inspect.isgenerator(result):
+                return self.timedSteps(result)
+            return result
+        return timed
+
+    def timedSteps(self, generator):
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+            finally:
+                self.timings["db"] += time.perf_counter() - start
+            yield item
+
+class AsyncLog:
+
+    # access log lines go through a bounded queue to one writer thread, so a
+    # request never waits on stderr; when the queue is full lines are dropped
+    # and counted rather than slowing requests down
+    def __init__(self, stream=None, maxPending=10000):
+        self.stream = stream
+        self.maxPending = maxPending
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.pid = None
+        self.queue = None
+        self.thread = None
+        atexit.register(self.close)
+
+    def start(self):
+        # also after a fork: the child has the queue but not the thread
+        with self.lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue(self.maxPending)
+                self.thread = threading.Thread(target=self.run, args=(self.queue,), name="access-log", daemon=True)
+                self.thread.start()
+                self.pid = os.getpid()
+
+    def write(self, line):
+        lines = self.queue
+        if lines is None or self.pid != os.getpid():
+            self.start()
+            lines = self.queue
+        try:
+            lines.put_nowait(line)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def run(self, lines):
+        while True:
+            batch = [lines.get()]
+            while batch[-1] is not None:
+                try:
+                    batch.append(lines.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is None
+            if stopping:
+                batch.pop()
+            if batch:
+                stream = self.stream or sys.stderr
+                stream.write("".join(batch))
+                stream.flush()
+            if stopping:
+                return
+
+    def close(self):
+        # writes out whatever is queued; the log restarts on the next write
+        with self.lock:
+            thread, lines = self.thread, self.queue
+            ours = self.pid == os.getpid()
+            self.pid = self.thread = self.queue = None
+        if thread is not None and ours and thread.is_alive():
+            try:
+                lines.put(None, timeout=5)
+            except queue.Full:
+                return
+            thread.join(5)
+
+    def getStats(self):
+        lines = self.queue
+        return {"pending": lines.qsize() if lines is not None else 0, "dropped": self.dropped}
+
+class RequestProfiler:
+
+    # cProfile for one request in every `every`; the samples add up into one
+    # pstats.Stats until reset. Only one request is profiled at a time, since
+    # a profiler only sees its own thread (and python 3.12 allows only one)
+    def __init__(self, every=100):
+        self.every = every
+        self.lock = threading.Lock()
+        self.running = threading.Lock()
+        self.seen = 0
+        self.samples = 0
+        self.stats = None
+
+    def start(self):
+        with self.lock:
+            self.seen += 1
+            if self.seen % self.every:
+                return None
+        if not self.running.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # some other profiler is active in this process
+            self.running.release()
+            return None
+        return profile
+
+    def stop(self, profile):
+        profile.disable()
+        self.running.release()
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.samples += 1
+
+    def report(self, sort="cumulative", limit=40):
+        with self.lock:
+            if self.stats is None:
+                return "no requests profiled yet ({} seen, sampling 1 in {})\n".format(self.seen, self.every)
+            out = io.StringIO()
+            self.stats.stream = out
+            out.write("{} requests profiled of {} seen\n".format(self.samples, self.seen))
+            self.stats.sort_stats(sort).print_stats(limit)
+            return out.getvalue()
+
+    def dump(self):
+        # the marshal format of pstats.Stats.dump_stats, for snakeviz and friends
+        with self.lock:
+            return marshal.dumps(self.stats.stats if self.stats is not None else {})
+
+    def reset(self):
+        with self.lock:
+            self.stats = None
+            self.samples = 0
+            self.seen = 0
@@ -1,12 +1,102 @@
+import argparse
+import functools
 import json
+import logging
+import os
+import pstats
+import queue
+import signal
+import threading
+import time
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import parse_qs
-from squirrel_db import SquirrelDB
+from urllib.parse import parse_qs, urlencode, urlsplit
+import squirrel_db
+from squirrel_db import SquirrelDB, LRUCache, GroupCommitWriter, MISSING, toJSON
+from squirrel_metrics import RequestMetrics, RequestProfiler, CountingWriter, DeferredWriter, TimedDB, AsyncLog, STAGES, renderStats
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# findSquirrels keyword -> GET /squirrels query parameter
+FILTER_PARAMS = {"name": "name", "size": "size", "namePrefix": "name_prefix"}
+# sqlite integers are signed 64-bit; anything wider overflows in the driver
+SQLITE_INT_MIN = -2 ** 63
+SQLITE_INT_MAX = 2 ** 63 - 1
+# request body JSON decoders; both take bytes and raise ValueError on bad input
+JSON_DECODERS = {"json": json.loads}
+if orjson is not None:
+    JSON_DECODERS["orjson"] = orjson.loads
+DEFAULT_JSON_DECODER = "orjson" if orjson is not None else "json"
+
+def handlesRequest(method):
+    # wraps the do_* methods. A body no route read is skipped so it cannot be
+    # taken for the next request, whatever the method. The end of the response
+    # is still held back when the method returns (see setup), so the profile
+    # and metrics are closed off here, before handle_one_request flushes it: a
+    # client that has its response also sees it counted
+    @functools.wraps(method)
+    def dispatch(self):
+        try:
+            method(self)
+            self.discardRequestBody()
+        finally:
+            self.finishRequest()
+    return dispatch
+
+class RequestError(Exception):
+
+    # a request refused before it reaches the database; status and message go
+    # straight back to the client
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
 
 class SquirrelServerHandler(BaseHTTPRequestHandler):
 
+    # persistent connections: every response carries its length, pipelined
+    # requests are read back to back from the buffered rfile, and each
+    # response leaves in a single write once the handler returns
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    # a connection is dropped after this many seconds without a byte; pooled
+    # servers drop idle keep-alive connections sooner, see awaitNextRequest
+    timeout = 15
+    maxRequestsPerConnection = 100
+    requestsHandled = 0
+    # encoded GET bodies, keyed by path and only valid for the table version
+    # they were built from; off (with ETags) when workers cannot share it
+    responseCache = LRUCache(maxSize=256)
+    useETags = True
+    maxPageSize = 1000
+    maxBulkOperations = 100000
+    # request bodies over these sizes get a 413 without being read
+    maxBodySize = 64 * 1024
+    maxBulkBodySize = 32 * 1024 * 1024
+    readChunkSize = 64 * 1024
+    decodeJSON = staticmethod(JSON_DECODERS[DEFAULT_JSON_DECODER])
+    streamChunkSize = 500
+    chunked = False
+    # a RequestMetrics turns on per-request timing and GET /_metrics; None
+    # leaves one attribute check per request
+    metrics = None
+    timings = None
+    requestStart = None
+    responseStatus = None
+    # a RequestProfiler profiles a sample of requests, served at GET /_profile
+    profiler = None
+    profiling = None
+    # access log lines go to stderr as http.server writes them, or to an
+    # AsyncLog; logRequests=False keeps only the error lines
+    accessLog = None
+    logRequests = True
+
     # HTTP METHODS
 
+    @handlesRequest
     def do_GET(self):
         resourceName, resourceId = self.parsePath()
         if resourceName == "squirrels":
@@ -14,29 +104,44 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
                 self.handleSquirrelsRetrieve(resourceId)
             else:
                 self.handleSquirrelsIndex()
+        elif resourceName == "_metrics" and not resourceId and self.metrics is not None:
+            self.handleMetrics()
+        elif resourceName == "_profile" and not resourceId and self.profiler is not None:
+            self.handleProfile()
         else:
             self.handle404()
 
+    @handlesRequest
     def do_POST(self):
         resourceName, resourceId = self.parsePath()
-        if resourceName == "squirrels":
-            if resourceId:
-                self.handle404()
+        try:
+            if resourceName == "squirrels":
+                if resourceId == "_bulk":
+                    self.handleSquirrelsBulk()
+                elif resourceId:
+                    self.handle404()
+                else:
+                    self.handleSquirrelsCreate()
             else:
-                self.handleSquirrelsCreate()
-        else:
-            self.handle404()
+                self.handle404()
+        except RequestError as error:
+            self.handleRequestError(error)
 
+    @handlesRequest
     def do_PUT(self):
         resourceName, resourceId = self.parsePath()
-        if resourceName == "squirrels":
-            if resourceId:
-                self.handleSquirrelsUpdate(resourceId)
+        try:
+            if resourceName == "squirrels":
+                if resourceId:
+                    self.handleSquirrelsUpdate(resourceId)
+                else:
+                    self.handle404()
             else:
                 self.handle404()
-        else:
-            self.handle404()
+        except RequestError as error:
+            self.handleRequestError(error)
 
+    @handlesRequest
     def do_DELETE(self):
         resourceName, resourceId = self.parsePath()
         if resourceName == "squirrels":
@@ -47,19 +152,369 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
         else:
             self.handle404()
 
+    # CONNECTION
+
+    def parse_request(self):
+        self.requestsHandled += 1
+        self.bodyRead = False
+        if self.metrics is not None:
+            self.startTimings()
+        if self.profiler is not None:
+            self.profiling = self.profiler.start()
+        return super().parse_request()
+
+    def setup(self):
+        super().setup()
+        if self.metrics is not None or self.profiler is not None:
+            self.wfile = DeferredWriter(self.wfile)
+
+    def handle_one_request(self):
+        if self.requestsHandled and not self.awaitNextRequest():
+            self.close_connection = True
+            return
+        try:
+            super().handle_one_request()
+        finally:
+            # requests refused before reaching a do_* method
+            self.finishRequest()
+
+    def awaitNextRequest(self):
+        # a pooled worker waits only server.idleTimeout for the next request
+        # on a kept-alive connection, and not at all while more connections
+        # are queued than there are idle workers to take them; a request
+        # already under way still gets the full timeout. Pipelined requests
+        # are already in rfile's buffer
+        idleTimeout = getattr(self.server, "idleTimeout", None)
+        if idleTimeout is None:
+            return True
+        self.connection.settimeout(0 if self.server.isBacklogged() else idleTimeout)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def finishRequest(self):
+        if self.profiling is not None:
+            self.profiler.stop(self.profiling)
+            self.profiling = None
+        if self.requestStart is not None:
+            self.recordRequest()
+
+    def send_response(self, code, message=None):
+        self.responseStatus = code
+        super().send_response(code, message)
+
+    def log_request(self, code="-", size="-"):
+        if self.logRequests:
+            super().log_request(code, size)
+
+    def log_message(self, format, *args):
+        if self.accessLog is None:
+            super().log_message(format, *args)
+            return
+        message = (format % args).translate(self._control_char_table)
+        self.accessLog.write("%s - - [%s] %s\n" % (self.address_string(), self.log_date_time_string(), message))
+
+    def discardRequestBody(self, limit=65536):
+        # a body nobody read would be parsed as the next pipelined request;
+        # small ones are skipped, anything bigger costs the connection
+        if self.bodyRead or self.close_connection:
+            return
+        self.bodyRead = True
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if self.isChunked():
+            self.close_connection = True
+        elif 0 <= length <= limit:
+            self.rfile.read(length)
+        else:
+            self.close_connection = True
+
+    def end_headers(self):
+        if not self.close_connection:
+            if self.requestsHandled >= self.maxRequestsPerConnection or not getattr(self.server, "keepAlive", True):
+                self.send_header("Connection", "close")
+            elif self.request_version == "HTTP/1.0":
+                self.send_header("Connection", "keep-alive")
+        super().end_headers()
+
+    # INSTRUMENTATION
+
+    def startTimings(self):
+        # the clock starts once the request line is in, so time spent idle
+        # between keep-alive requests is not counted
+        self.requestStart = time.perf_counter()
+        self.responseStatus = None
+        self.timings = dict.fromkeys(STAGES, 0.0)
+        if not isinstance(self.wfile, CountingWriter):
+            self.wfile = CountingWriter(self.wfile)
+        self.bytesBefore = self.wfile.count
+
+    def recordRequest(self):
+        seconds = time.perf_counter() - self.requestStart
+        self.requestStart = None
+        self.metrics.record(self.routeMethod(), self.routeName(), str(self.responseStatus or "none"), seconds,
+                            self.timings, self.wfile.count - self.bytesBefore)
+        self.timings = None
+
+    def routeMethod(self):
+        # anything a client sends as a method would otherwise become a label
+        method = getattr(self, "command", None)
+        return method if method in ("GET", "POST", "PUT", "DELETE", "HEAD") else "other"
+
+    def routeName(self):
+        path = getattr(self, "path", "")
+        parsed = self.parsePath() if path else False
+        if not parsed:
+            return "other"
+        resourceName, resourceId = parsed
+        if resourceName == "squirrels":
+            if not resourceId:
+                return "/squirrels"
+            return "/squirrels/_bulk" if resourceId == "_bulk" else "/squirrels/{id}"
+        if resourceName in ("_metrics", "_profile") and not resourceId:
+            return "/" + resourceName
+        return "other"
+
+    def database(self):
+        db = SquirrelDB()
+        if self.timings is None:
+            return db
+        return TimedDB(db, self.timings)
+
+    def timed(self, stage, function, *args):
+        if self.timings is None:
+            return function(*args)
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.timings[stage] += time.perf_counter() - start
+
     # HELPERS
 
+    def isChunked(self):
+        return "chunked" in self.headers.get("Transfer-Encoding", "").lower()
+
+    @classmethod
+    def bodyLimit(cls, path):
+        # by path rather than parsePath so the asyncio engine can ask before
+        # it has a handler
+        parts = path.split("?", 1)[0].split("/")
+        return cls.maxBulkBodySize if parts[1:3] == ["squirrels", "_bulk"] else cls.maxBodySize
+
+    def handle_expect_100(self):
+        # tell a client waiting on 100 Continue that its body is too big
+        # before it sends any of it
+        length = self.headers.get("Content-Length", "")
+        limit = self.bodyLimit(self.path)
+        if length.isdigit() and int(length) > limit:
+            self.handleRequestError(RequestError(413, "body larger than {} bytes".format(limit)))
+            return False
+        return super().handle_expect_100()
+
+    def getRequestBody(self, limit=None):
+        # the body as bytes, read a bounded piece at a time: a declared length
+        # over the limit is refused before any of it is read, and a chunked
+        # body as soon as it passes the limit
+        if limit is None:
+            limit = self.maxBodySize
+        if self.isChunked():
+            body = self.readChunkedBody(limit)
+        else:
+            length = self.headers.get("Content-Length")
+            if length is None:
+                raise RequestError(411, "Content-Length or Transfer-Encoding: chunked required")
+            if not length.strip().isdigit():
+                raise RequestError(400, "bad Content-Length")
+            length = int(length)
+            if length > limit:
+                raise RequestError(413, "body larger than {} bytes".format(limit))
+            body = self.readExactly(length)
+        self.bodyRead = True
+        return body
+
+    def readExactly(self, length):
+        parts = []
+        while length > 0:
+            data = self.rfile.read(min(length, self.readChunkSize))
+            if not data:
+                raise RequestError(400, "body ended early")
+            parts.append(data)
+            length -= len(data)
+        return b"".join(parts)
+
+    def readChunkedBody(self, limit):
+        parts = []
+        total = 0
+        while True:
+            line = self.rfile.readline(1024)
+            try:
+                size = int(line.split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                raise RequestError(400, "bad chunk size")
+            if size < 0:
+                raise RequestError(400, "bad chunk size")
+            if size == 0:
+                break
+            total += size
+            if total > limit:
+                raise RequestError(413, "body larger than {} bytes".format(limit))
+            parts.append(self.readExactly(size))
+            if self.rfile.readline(3) not in (b"\r\n", b"\n"):
+                raise RequestError(400, "bad chunk ending")
+        # trailers, if any, up to the blank line
+        while self.rfile.readline(65537) not in (b"\r\n", b"\n", b""):
+            pass
+        return b"".join(parts)
+
+    def getContentType(self):
+        return self.headers.get("Content-Type", "").split(";", 1)[0].strip().lower()
+
     def getRequestData(self):
-        length = int(self.headers["Content-Length"])
-        body = self.rfile.read(length).decode("utf-8")
-        data = parse_qs(body)
+        # a JSON object for application/json; otherwise a form, the format
+        # clients used before JSON bodies were accepted
+        body = self.getRequestBody()
+        if self.getContentType() == "application/json":
+            try:
+                data = self.decodeJSON(body)
+            except ValueError as error:
+                raise RequestError(400, "malformed JSON: {}".format(error))
+            if not isinstance(data, dict):
+                raise RequestError(400, "body must be a JSON object")
+            return data
+        try:
+            data = parse_qs(body.decode("utf-8"))
+        except UnicodeDecodeError:
+            raise RequestError(400, "body is not utf-8")
         for key in data:
             data[key] = data[key][0]
         return data
 
+    def getSquirrelFields(self):
+        data = self.getRequestData()
+        try:
+            return self.requireScalar(data, "name"), self.requireScalar(data, "size")
+        except ValueError as error:
+            raise RequestError(400, str(error))
+
+    def currentETag(self):
+        return '"squirrels-{}"'.format(squirrel_db.squirrelsVersion.current())
+
+    def isNotModified(self, etag, exists=True):
+        # "*" matches any current representation, so only one that exists
+        ifNoneMatch = self.headers.get("If-None-Match")
+        if not ifNoneMatch:
+            return False
+        tags = [tag.strip() for tag in ifNoneMatch.split(",")]
+        return ("*" in tags and exists) or etag in tags
+
+    def getCachedResponse(self, etag):
+        cached = self.responseCache.get(self.path)
+        if cached is not MISSING and cached[0] == etag:
+            return cached[1:]
+        return None
+
+    def getQuery(self):
+        query = parse_qs(urlsplit(self.path).query)
+        for key in query:
+            query[key] = query[key][0]
+        return query
+
+    def parsePage(self, query):
+        try:
+            limit = int(query.get("limit", self.maxPageSize))
+            afterId = int(query.get("after_id", 0))
+        except ValueError:
+            return None
+        # sqlite would overflow on an after_id wider than 64 bits
+        if limit <= 0 or limit > SQLITE_INT_MAX or not SQLITE_INT_MIN <= afterId <= SQLITE_INT_MAX:
+            return None
+        return (afterId, min(limit, self.maxPageSize))
+
+    def nextPageLink(self, squirrelsList, limit, filters=None):
+        if len(squirrelsList) < limit:
+            return None
+        params = {FILTER_PARAMS[name]: value for name, value in (filters or {}).items()}
+        params.update(limit=limit, after_id=squirrelsList[-1]["id"])
+        return '</squirrels?{}>; rel="next"'.format(urlencode(params))
+
+    def getFilters(self, query):
+        return {name: query[param] for name, param in FILTER_PARAMS.items() if param in query}
+
+    def getStreamFormat(self, query):
+        stream = query.get("stream")
+        if stream == "ndjson" or (stream is None and "application/x-ndjson" in self.headers.get("Accept", "")):
+            return "ndjson"
+        if stream in ("1", "true", "json"):
+            return "json"
+        return None
+
+    def writeChunk(self, data):
+        if self.chunked:
+            self.wfile.write(b"%X\r\n%s\r\n" % (len(data), data))
+        else:
+            self.wfile.write(data)
+        self.wfile.flush()
+
+    def getBulkItems(self):
+        # a JSON array of operations, or one JSON operation per line
+        body = self.getRequestBody(self.maxBulkBodySize).strip()
+        contentType = self.getContentType()
+        if contentType == "application/json" or (contentType != "application/x-ndjson" and body.startswith(b"[")):
+            items = self.decodeJSON(body)
+            if not isinstance(items, list):
+                raise ValueError("body must be a JSON array")
+        else:
+            items = [self.decodeJSON(line) for line in body.splitlines() if line.strip()]
+        if len(items) > self.maxBulkOperations:
+            raise ValueError("at most {} operations per request".format(self.maxBulkOperations))
+        return items
+
+    def parseBulkOperation(self, item):
+        if not isinstance(item, dict):
+            raise ValueError("operation must be an object")
+        op = item.get("op")
+        if op == "create":
+            return ("create", self.requireScalar(item, "name"), self.requireScalar(item, "size"))
+        if op == "update":
+            return ("update", self.requireId(item), self.requireScalar(item, "name"), self.requireScalar(item, "size"))
+        if op == "delete":
+            return ("delete", self.requireId(item))
+        raise ValueError("op must be create, update or delete")
+
+    def requireField(self, item, field):
+        if item.get(field) is None:
+            raise ValueError("missing " + field)
+        return item[field]
+
+    def requireScalar(self, item, field):
+        # a JSON object or array, or an integer wider than 64 bits, would
+        # only fail once sqlite sees it; true and false are not numbers here
+        value = self.requireField(item, field)
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            raise ValueError(field + " must be a string or a number")
+        if isinstance(value, int) and not SQLITE_INT_MIN <= value <= SQLITE_INT_MAX:
+            raise ValueError(field + " is out of range")
+        return value
+
+    def requireId(self, item):
+        # ids are sqlite integers: 1.5 would match no row yet report success,
+        # and a wider one would fail the whole batch
+        value = self.requireScalar(item, "id")
+        if isinstance(value, str) and value.isascii() and value.isdigit():
+            value = int(value)
+        if not isinstance(value, int) or not SQLITE_INT_MIN <= value <= SQLITE_INT_MAX:
+            raise ValueError("id must be a 64-bit integer")
+        return value
+
     def parsePath(self):
         if self.path.startswith("/"):
-            parts = self.path[1:].split("/")
+            parts = self.path[1:].split("?", 1)[0].split("/")
             resourceName = parts[0]
             resourceId = None
             if len(parts) > 1:
@@ -70,38 +525,207 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
     # ACTIONS - MOCK ALL OF THESE, REPLACE AND TEST
 
     def handleSquirrelsIndex(self):
-        db = SquirrelDB()
-        squirrelsList = db.getSquirrels()
+        query = self.getQuery()
+        streamFormat = self.getStreamFormat(query)
+        filters = self.getFilters(query)
+        if streamFormat:
+            self.handleSquirrelsStream(streamFormat, filters)
+            return
+        page = None
+        if "limit" in query or "after_id" in query:
+            page = self.parsePage(query)
+            if page is None:
+                self.handle400("limit must be a positive integer and after_id an integer")
+                return
+        # the version is read before the data, so a body can only ever be
+        # newer than its ETag claims, never older
+        etag = self.currentETag()
+        if self.useETags and self.isNotModified(etag):
+            self.handle304(etag)
+            return
+        cached = self.getCachedResponse(etag)
+        if cached is None:
+            db = self.database()
+            if filters:
+                squirrelsList = db.findSquirrels(afterId=page[0] if page else 0, limit=page[1] if page else None, **filters)
+                nextLink = self.nextPageLink(squirrelsList, page[1], filters) if page else None
+            elif page:
+                squirrelsList = db.getSquirrelsPage(*page)
+                nextLink = self.nextPageLink(squirrelsList, page[1])
+            else:
+                squirrelsList = db.getSquirrels()
+                nextLink = None
+            cached = (self.timed("encode", toJSON, squirrelsList).encode("utf-8"), nextLink)
+            self.responseCache.put(self.path, (etag,) + cached)
+        body, nextLink = cached
         self.send_response(200)
         self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if self.useETags:
+            self.send_header("ETag", etag)
+        if nextLink:
+            self.send_header("Link", nextLink)
         self.end_headers()
-        self.wfile.write(bytes(json.dumps(squirrelsList), "utf-8"))
+        self.wfile.write(body)
 
-    def handleSquirrelsRetrieve(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
-        if squirrel:
-            self.send_response(200)
+    def handleSquirrelsStream(self, streamFormat, filters=None):
+        # rows are fetched and written a chunk at a time, so memory stays flat
+        # however large the table is; HTTP/1.0 clients read until close
+        db = self.database()
+        self.chunked = self.request_version == "HTTP/1.1"
+        self.send_response(200)
+        if streamFormat == "ndjson":
+            self.send_header("Content-Type", "application/x-ndjson")
+        else:
             self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.wfile.write(bytes(json.dumps(squirrel), "utf-8"))
+        if self.chunked:
+            self.send_header("Transfer-Encoding", "chunked")
         else:
-            #test this
-            self.handle404()
+            self.close_connection = True
+        self.end_headers()
+        if streamFormat == "json":
+            self.writeChunk(b"[")
+        separator = ""
+        for squirrelsList in db.iterSquirrels(self.streamChunkSize, **(filters or {})):
+            data = self.timed("encode", self.encodeChunk, squirrelsList, streamFormat, separator)
+            separator = ", "
+            self.writeChunk(data)
+        if streamFormat == "json":
+            self.writeChunk(b"]")
+        if self.chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+    def encodeChunk(self, squirrelsList, streamFormat, separator):
+        if streamFormat == "ndjson":
+            return "".join(toJSON(squirrel) + "\n" for squirrel in squirrelsList).encode("utf-8")
+        return (separator + ", ".join(toJSON(squirrel) for squirrel in squirrelsList)).encode("utf-8")
+
+    def handleMetrics(self):
+        lines = self.metrics.render()
+        lines.extend(renderStats("squirrel_db_pool", squirrel_db.getPool().getStats(), {"pool": "write"}))
+        lines.extend(renderStats("squirrel_db_statements", squirrel_db.getPool().getStatementStats(), {"pool": "write"}))
+        readPool = squirrel_db.getReadPool()
+        if readPool is not squirrel_db.getPool():
+            lines.extend(renderStats("squirrel_db_pool", readPool.getStats(), {"pool": "read"}))
+            lines.extend(renderStats("squirrel_db_statements", readPool.getStatementStats(), {"pool": "read"}))
+        lines.extend(renderStats("squirrel_cache", squirrel_db.getCache().getStats(), {"cache": "rows"}))
+        lines.extend(renderStats("squirrel_cache", self.responseCache.getStats(), {"cache": "responses"}))
+        writer = squirrel_db.getWriter()
+        if writer is not None:
+            lines.extend(renderStats("squirrel_group_commit", writer.getStats()))
+        if self.accessLog is not None:
+            lines.extend(renderStats("squirrel_access_log", self.accessLog.getStats()))
+        body = ("\n".join(lines) + "\n").encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handleProfile(self):
+        # ?sort= and ?limit= shape the report, ?format=pstats returns the raw
+        # stats for pstats or snakeviz, and ?reset=1 starts the samples over
+        query = self.getQuery()
+        if query.get("format") == "pstats":
+            body = self.profiler.dump()
+            contentType = "application/octet-stream"
+        else:
+            sort = query.get("sort", "cumulative")
+            if sort not in pstats.Stats.sort_arg_dict_default:
+                self.handle400("unknown sort: {}".format(sort))
+                return
+            try:
+                limit = int(query.get("limit", 40))
+            except ValueError:
+                self.handle400("limit must be a number")
+                return
+            body = self.profiler.report(sort, limit).encode("utf-8")
+            contentType = "text/plain; charset=utf-8"
+        if query.get("reset") == "1":
+            self.profiler.reset()
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handleSquirrelsRetrieve(self, squirrelId):
+        etag = self.currentETag()
+        if self.useETags and self.isNotModified(etag, exists=False):
+            self.handle304(etag)
+            return
+        cached = self.getCachedResponse(etag)
+        if cached is None:
+            db = self.database()
+            squirrel = db.getSquirrel(squirrelId)
+            if not squirrel:
+                #test this
+                self.handle404()
+                return
+            cached = (self.timed("encode", toJSON, squirrel).encode("utf-8"), None)
+            self.responseCache.put(self.path, (etag,) + cached)
+        if self.useETags and self.isNotModified(etag):
+            self.handle304(etag)
+            return
+        body = cached[0]
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if self.useETags:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
 
     def handleSquirrelsCreate(self):
-        db = SquirrelDB()
-        body = self.getRequestData()
-        db.createSquirrel(body["name"], body["size"])
+        db = self.database()
+        name, size = self.getSquirrelFields()
+        db.createSquirrel(name, size)
         self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def handleSquirrelsBulk(self):
+        try:
+            items = self.getBulkItems()
+        except ValueError as error:
+            self.handle400(str(error))
+            return
+        results = []
+        operations = []
+        for index, item in enumerate(items):
+            try:
+                operations.append(self.parseBulkOperation(item))
+                results.append(None)
+            except ValueError as error:
+                results.append({"index": index, "status": 400, "error": str(error)})
+        db = self.database()
+        outcomes = iter(db.applyBulk(operations))
+        operations = iter(operations)
+        for index, result in enumerate(results):
+            if result is not None:
+                continue
+            operation = next(operations)
+            outcome = next(outcomes)
+            if operation[0] == "create":
+                results[index] = {"index": index, "status": 201, "id": outcome}
+            elif outcome:
+                results[index] = {"index": index, "status": 204, "id": operation[1]}
+            else:
+                results[index] = {"index": index, "status": 404, "id": operation[1]}
+        body = self.timed("encode", json.dumps, results).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
+        self.wfile.write(body)
 
     def handleSquirrelsUpdate(self, squirrelId):
-        db = SquirrelDB()
+        db = self.database()
         squirrel = db.getSquirrel(squirrelId)
         if squirrel:
-            body = self.getRequestData()
-            db.updateSquirrel(squirrelId, body["name"], body["size"])
+            name, size = self.getSquirrelFields()
+            db.updateSquirrel(squirrelId, name, size)
+            # a 204 never has a body and must not carry a Content-Length
             self.send_response(204)
             self.end_headers()
         else:
@@ -109,7 +733,7 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
             self.handle404()
 
     def handleSquirrelsDelete(self, squirrelId):
-        db = SquirrelDB()
+        db = self.database()
         squirrel = db.getSquirrel(squirrelId)
         if squirrel:
             db.deleteSquirrel(squirrelId)
@@ -119,18 +743,293 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
             #test this
             self.handle404()
 
+    def handle304(self, etag):
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.end_headers()
+
+    def handle400(self, message):
+        body = bytes("400 Bad Request: " + message, "utf-8")
+        self.send_response(400)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handleRequestError(self, error):
+        body = "{} {}: {}".format(error.status, self.responses[error.status][0], error.message).encode("utf-8")
+        self.send_response(error.status)
+        # a body refused unread cannot be skipped, so the connection goes
+        if not self.bodyRead:
+            self.send_header("Connection", "close")
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def handle404(self):
+        self.discardRequestBody()
+        body = bytes("404 Not Found", "utf-8")
         self.send_response(404)
         self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        self.wfile.write(bytes("404 Not Found", "utf-8"))
+        self.wfile.write(body)
 
-def run():
-    print("squirrel_server running at 127.0.0.1:8080")
-    listen = ("127.0.0.1", 8080)
-    server = HTTPServer(listen, SquirrelServerHandler)
-    server.serve_forever()
+class ThreadPoolHTTPServer(HTTPServer):
 
-if __name__ == '__main__':
-    run()
+    # accepted connections wait in a bounded queue for one of a fixed set of
+    # worker threads; once the queue is full new clients get a 503 instead of
+    # piling up unbounded threads the way ThreadingHTTPServer would
+    def __init__(self, address, handlerClass, workers=8, queueSize=64, idleTimeout=1.0):
+        super().__init__(address, handlerClass)
+        self.workerCount = workers
+        # an idle keep-alive connection holds a worker, so it gets far less
+        # time than the handler's timeout before it is closed
+        self.idleTimeout = idleTimeout
+        self.pending = queue.Queue(queueSize)
+        self.workers = []
+        self.idleWorkers = 0
+        self.idleLock = threading.Lock()
+
+    def startWorkers(self):
+        while len(self.workers) < self.workerCount:
+            worker = threading.Thread(target=self.work, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.startWorkers()
+        super().serve_forever(poll_interval)
+
+    def process_request(self, request, client_address):
+        try:
+            self.pending.put_nowait((request, client_address))
+        except queue.Full:
+            self.reject(request)
+
+    def reject(self, request):
+        try:
+            request.sendall(b"HTTP/1.0 503 Service Unavailable\r\nContent-Length: 0\r\nRetry-After: 1\r\n\r\n")
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def isBacklogged(self):
+        # connections are waiting that no idle worker is about to take
+        return self.pending.qsize() > self.idleWorkers
 
+    def work(self):
+        while True:
+            with self.idleLock:
+                self.idleWorkers += 1
+            item = self.pending.get()
+            with self.idleLock:
+                self.idleWorkers -= 1
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for worker in self.workers:
+            self.pending.put(None)
+        self.workers = []
+
+class SingleHTTPServer(HTTPServer):
+
+    # one thread answers every client, so a kept-alive connection would hold
+    # it for the handler's whole timeout; every response closes instead
+    keepAlive = False
+
+def makeServer(host="127.0.0.1", port=8080, mode="threaded", workers=8, queueSize=64, threads=4, idleTimeout=1.0):
+    listen = (host, port)
+    if mode == "single":
+        return SingleHTTPServer(listen, SquirrelServerHandler)
+    if mode == "threaded":
+        return ThreadPoolHTTPServer(listen, SquirrelServerHandler, workers, queueSize, idleTimeout)
+    if mode == "prefork":
+        if not hasattr(os, "fork"):
+            raise ValueError("prefork mode needs os.fork, which this platform does not have")
+        return ThreadPoolHTTPServer(listen, SquirrelServerHandler, threads, queueSize, idleTimeout)
+    raise ValueError("unknown mode: {}".format(mode))
+
+def stopServing(signum, frame):
+    raise KeyboardInterrupt
+
+def serveForked(server, workers):
+    # every child inherits the bound socket and accept()s on it directly;
+    # connections opened before the fork must never be used by the children
+    squirrel_db.resetPool()
+    # a write in one worker cannot invalidate another worker's cache or
+    # bump its table version, so neither caches nor ETags are safe here
+    squirrel_db.resetCache(LRUCache(maxSize=0))
+    SquirrelServerHandler.responseCache = LRUCache(maxSize=0)
+    SquirrelServerHandler.useETags = False
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, lambda signum, frame: os._exit(0))
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+    signal.signal(signal.SIGTERM, stopServing)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    finally:
+        server.server_close()
+
+def configureDatabase(cacheSize=1024, cacheTTL=30.0, groupCommit=False, groupCommitWindow=0.0, groupCommitBatch=128):
+    squirrel_db.resetCache(LRUCache(cacheSize, cacheTTL))
+    SquirrelServerHandler.responseCache = LRUCache(min(cacheSize, 256), cacheTTL)
+    if groupCommit:
+        squirrel_db.resetWriter(GroupCommitWriter(None, groupCommitWindow, groupCommitBatch))
+    else:
+        squirrel_db.resetWriter()
+
+def configureInstrumentation(metrics=False, accessLog="sync", profileEvery=0):
+    # accessLog is "sync" (stderr, as http.server does), "async" (a writer
+    # thread) or "off" (error lines only); profileEvery=N profiles one
+    # request in N, 0 none
+    if accessLog not in ("sync", "async", "off"):
+        raise ValueError("unknown access log mode: {}".format(accessLog))
+    SquirrelServerHandler.metrics = RequestMetrics() if metrics else None
+    SquirrelServerHandler.profiler = RequestProfiler(profileEvery) if profileEvery else None
+    old = SquirrelServerHandler.accessLog
+    SquirrelServerHandler.accessLog = AsyncLog() if accessLog == "async" else None
+    SquirrelServerHandler.logRequests = accessLog != "off"
+    if old is not None:
+        old.close()
+
+def configureRequestBodies(jsonDecoder=None, maxBodySize=None, maxBulkBodySize=None):
+    # jsonDecoder is a JSON_DECODERS name; sizes are in bytes
+    if jsonDecoder is not None:
+        if jsonDecoder not in JSON_DECODERS:
+            raise ValueError("unknown JSON decoder: {} (available: {})".format(jsonDecoder, ", ".join(sorted(JSON_DECODERS))))
+        SquirrelServerHandler.decodeJSON = staticmethod(JSON_DECODERS[jsonDecoder])
+    if maxBodySize is not None:
+        SquirrelServerHandler.maxBodySize = maxBodySize
+    if maxBulkBodySize is not None:
+        SquirrelServerHandler.maxBulkBodySize = maxBulkBodySize
+
+def reportDatabaseSettings():
+    effective, mismatches = squirrel_db.applyProfile()
+    print("database: {}".format(squirrel_db.settings["path"]))
+    print("sqlite: " + ", ".join("{}={}".format(name, value) for name, value in effective.items()))
+    for name, (wanted, actual) in mismatches.items():
+        print("warning: asked for {}={} but sqlite is using {}".format(name, wanted, actual))
+
+def migrateDatabase():
+    before, after = squirrel_db.migrate()
+    if before != after:
+        print("schema: upgraded from version {} to {}".format(before, after))
+    else:
+        print("schema: version {}".format(after))
+
+def run(host="127.0.0.1", port=8080, mode="threaded", workers=8, queueSize=64, threads=4, engine="http", idleTimeout=1.0):
+    reportDatabaseSettings()
+    migrateDatabase()
+    if engine == "asyncio":
+        import squirrel_async_server
+        squirrel_async_server.run(host, port, workers)
+        return
+    server = makeServer(host, port, mode, workers, queueSize, threads, idleTimeout)
+    print("squirrel_server running at {}:{}".format(host, port))
+    print("mode: {}, workers: {}".format(mode, workers))
+    if mode == "prefork":
+        serveForked(server, workers)
+    else:
+        server.serve_forever()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Squirrel REST server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--engine", choices=["http", "asyncio"], default="http",
+                        help="http: blocking http.server engine; asyncio: event loop with sqlite on a thread executor")
+    parser.add_argument("--mode", choices=["single", "threaded", "prefork"], default="threaded",
+                        help="single: one request at a time; threaded: worker thread pool; prefork: worker processes sharing the socket")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="worker threads (threaded), worker processes (prefork) or db executor threads (asyncio)")
+    parser.add_argument("--queue-size", type=int, default=64,
+                        help="connections allowed to wait for a worker before clients get 503")
+    parser.add_argument("--idle-timeout", type=float, default=1.0,
+                        help="seconds a worker waits for the next request on a kept-alive connection (threaded and prefork)")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="worker threads inside each prefork process")
+    parser.add_argument("--db", default=os.environ.get("SQUIRREL_DB", squirrel_db.DB_PATH),
+                        help="sqlite database file (default: $SQUIRREL_DB or squirrel_db.db)")
+    parser.add_argument("--profile", choices=sorted(squirrel_db.PROFILES), default="balanced",
+                        help="sqlite tuning: balanced (WAL, synchronous=normal, mmap), durable (WAL, synchronous=full), fast (synchronous=off), default (sqlite defaults)")
+    parser.add_argument("--pragma", action="append", default=[], metavar="NAME=VALUE",
+                        help="override one profile setting, e.g. --pragma cache_size=-65536 (repeatable)")
+    parser.add_argument("--cached-statements", type=int, default=256,
+                        help="prepared statements each sqlite connection keeps for reuse")
+    parser.add_argument("--readers", type=int, default=0,
+                        help="read-only connections for reads, with writes serialized on one writer connection (0: one shared pool)")
+    parser.add_argument("--cache-size", type=int, default=1024,
+                        help="squirrels kept in the read cache, 0 turns it off (always off in prefork mode)")
+    parser.add_argument("--cache-ttl", type=float, default=30.0,
+                        help="seconds a cached squirrel may be served before it is read again")
+    parser.add_argument("--group-commit", action="store_true",
+                        help="commit concurrent single-row writes together from one writer thread")
+    parser.add_argument("--group-commit-window", type=float, default=0.0,
+                        help="milliseconds the writer waits for more writes before committing (0: only what is already queued)")
+    parser.add_argument("--group-commit-batch", type=int, default=128,
+                        help="most writes committed together")
+    parser.add_argument("--metrics", action="store_true",
+                        help="time every request and serve the numbers at GET /_metrics")
+    parser.add_argument("--access-log", choices=["sync", "async", "off"], default="sync",
+                        help="per-request log lines: written to stderr inline, handed to a writer thread, or not at all")
+    parser.add_argument("--profile-requests", type=int, default=0, metavar="N",
+                        help="cProfile one request in N and serve the totals at GET /_profile (0: off)")
+    parser.add_argument("--slow-query-ms", type=float, default=None,
+                        help="log sqlite statements that take longer than this, with their parameters")
+    parser.add_argument("--trace-sql", action="store_true",
+                        help="log every statement sqlite runs")
+    parser.add_argument("--json-decoder", choices=sorted(JSON_DECODERS), default=DEFAULT_JSON_DECODER,
+                        help="decoder for JSON request bodies (orjson when installed)")
+    parser.add_argument("--max-body-size", type=int, default=SquirrelServerHandler.maxBodySize, metavar="BYTES",
+                        help="larger create/update bodies get a 413 without being read")
+    parser.add_argument("--max-bulk-body-size", type=int, default=SquirrelServerHandler.maxBulkBodySize, metavar="BYTES",
+                        help="the same for POST /squirrels/_bulk")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.trace_sql else logging.WARNING, format="%(asctime)s %(name)s: %(message)s")
+    pragmas = {}
+    for pragma in args.pragma:
+        name, separator, value = pragma.partition("=")
+        if not separator:
+            parser.error("--pragma takes NAME=VALUE, got {!r}".format(pragma))
+        pragmas[name.strip()] = value.strip()
+    # one connection per worker thread, plus one for the group commit writer
+    try:
+        squirrel_db.configure(args.db, args.profile, pragmas, max(args.workers, args.threads) + 1, args.cached_statements,
+                              args.readers, args.slow_query_ms, squirrel_db.traceStatement if args.trace_sql else None)
+    except ValueError as error:
+        parser.error(str(error))
+    configureDatabase(args.cache_size, args.cache_ttl, args.group_commit, args.group_commit_window / 1000.0, args.group_commit_batch)
+    configureInstrumentation(args.metrics, args.access_log, args.profile_requests)
+    configureRequestBodies(args.json_decoder, args.max_body_size, args.max_bulk_body_size)
+    run(args.host, args.port, args.mode, args.workers, args.queue_size, args.threads, args.engine, args.idle_timeout)
+
+if __name__ == '__main__':
+    # configure the importable module rather than __main__, or the asyncio
+    # engine's own import would serve a second, unconfigured handler class
+    import squirrel_server
+    squirrel_server.main()
@@ -1,11 +1,30 @@
 import pytest
+import gc
 import os.path
+import multiprocessing
 import pickle
+import threading
+import time
+import weakref
 from unittest.mock import mock_open
-from mydb import MyDB
+import mydb
+from mydb import MyDB, BufferedMyDB
 
 def describe_MyDB():
 
+    #the lock file is outside of the boundary too
+    @pytest.fixture(autouse=True)
+    def mock_lock(mocker):
+        return mocker.patch.object(MyDB, "lock")
+
+    @pytest.fixture(autouse=True)
+    def mock_replace(mocker):
+        return mocker.patch("os.replace")
+
+    @pytest.fixture(autouse=True)
+    def mock_fsync(mocker):
+        return mocker.patch("os.fsync")
+
     @pytest.fixture
     def mock_os_path(mocker):
         return mocker.patch("os.path.isfile")
@@ -26,10 +45,34 @@ def describe_MyDB():
     def sample_filename():
         return "test_database.pkl"
 
+    @pytest.fixture
+    def temp_filename(sample_filename):
+        return "{}.{}.tmp".format(sample_filename, os.getpid())
+
     @pytest.fixture
     def sample_strings():
         return ["hello", "world", "test"]
 
+    def describe_lock_method():
+
+        def test_saves_hold_the_exclusive_lock(mocker, mock_lock, sample_filename):
+            mocker.patch("os.path.isfile", return_value = True)
+            mocker.patch("builtins.open", mock_open())
+            mocker.patch("pickle.dump")
+
+            MyDB(sample_filename, codec = "pickle").saveStrings([])
+
+            assert mock_lock.call_args_list[-1] == mocker.call()
+
+        def test_loads_take_the_shared_lock(mocker, mock_lock, sample_filename):
+            mocker.patch("os.path.isfile", return_value = True)
+            mocker.patch("builtins.open", mock_open())
+            mocker.patch("pickle.load", return_value = [])
+
+            MyDB(sample_filename).loadStrings()
+
+            assert mock_lock.call_args_list[-1] == mocker.call(exclusive = False)
+
     def describe_init_method():
         def test_init_when_file_exists(mocker, mock_os_path, sample_filename):
             mock_os_path.return_value = True
@@ -83,30 +126,31 @@ def describe_MyDB():
 
     def describe_save_strings_method():
 
-        def test_save_strings_opens_file_correctly(mocker, mock_open_file, mock_pickle_dump, sample_filename, sample_strings):
+        def test_save_strings_opens_file_correctly(mocker, mock_open_file, mock_pickle_dump, mock_replace, sample_filename, temp_filename, sample_strings):
             mock_os_path = mocker.patch("os.path.isfile", return_value = True)
 
-            db = MyDB(sample_filename)
+            db = MyDB(sample_filename, codec = "pickle")
 
             db.saveStrings(sample_strings)
 
-            mock_open_file.assert_called_with(sample_filename, "wb")
+            mock_open_file.assert_called_with(temp_filename, "wb")
             mock_pickle_dump.assert_called_once()
+            mock_replace.assert_called_once_with(temp_filename, sample_filename)
 
-        def test_save_strings_with_context_manager(mocker, sample_filename, sample_strings):
+        def test_save_strings_with_context_manager(mocker, temp_filename, sample_filename, sample_strings):
             mock_os_path = mocker.patch("os.path.isfile", return_value = True)
             mock_file_handle = mock_open()
             mock_open_func = mocker.patch("builtins.open", mock_file_handle)
             mock_pickle_dump = mocker.patch("pickle.dump")
 
-            db = MyDB(sample_filename)
+            db = MyDB(sample_filename, codec = "pickle")
 
             db.saveStrings(sample_strings)
 
-            mock_open_func.assert_called_with(sample_filename, "wb")
+            mock_open_func.assert_called_with(temp_filename, "wb")
             mock_file_handle().__enter__.assert_called_once()
             mock_file_handle().__exit__.assert_called_once()
-            mock_pickle_dump.assert_called_once_with(sample_strings, mock_file_handle().__enter__())
+            mock_pickle_dump.assert_called_once_with(sample_strings, mock_file_handle().__enter__(), protocol = pickle.HIGHEST_PROTOCOL)
 
         def test_save_strings_calls_pickle_dump_with_correct_args(mocker, sample_filename, sample_strings):
             mock_os_path = mocker.patch("os.path.isfile", return_value = True)
@@ -114,7 +158,7 @@ def describe_MyDB():
             mocker.patch("builtins.open", mock_file_handle)
             mock_pickle_dump = mocker.patch("pickle.dump")
 
-            db = MyDB(sample_filename)
+            db = MyDB(sample_filename, codec = "pickle")
 
             db.saveStrings(sample_strings)
 
@@ -122,6 +166,41 @@ def describe_MyDB():
             assert call_args[0][0] == sample_strings
             assert call_args[0][1] == mock_file_handle().__enter__()
 
+        def test_save_strings_fsyncs_before_the_rename(mocker, mock_fsync, mock_replace, sample_filename):
+            mocker.patch("os.path.isfile", return_value = True)
+            mocker.patch("builtins.open", mock_open())
+            mocker.patch("pickle.dump")
+            calls = mocker.Mock()
+            calls.attach_mock(mock_fsync, "fsync")
+            calls.attach_mock(mock_replace, "replace")
+
+            MyDB(sample_filename, codec = "pickle").saveStrings([])
+
+            assert [name for name, args, kwargs in calls.mock_calls] == ["fsync", "replace"]
+
+        def test_save_strings_skips_fsync_without_durability(mocker, mock_fsync, mock_replace, sample_filename):
+            mocker.patch("os.path.isfile", return_value = True)
+            mocker.patch("builtins.open", mock_open())
+            mocker.patch("pickle.dump")
+
+            MyDB(sample_filename, codec = "pickle", durability = "none").saveStrings([])
+
+            mock_fsync.assert_not_called()
+            mock_replace.assert_called_once()
+
+        def test_save_strings_removes_the_temp_file_when_dump_fails(mocker, mock_replace, sample_filename, temp_filename):
+            mocker.patch("os.path.isfile", return_value = True)
+            mocker.patch("builtins.open", mock_open())
+            mocker.patch("pickle.dump", side_effect = pickle.PicklingError)
+            mocker.patch("os.path.exists", return_value = True)
+            mock_remove = mocker.patch("os.remove")
+
+            with pytest.raises(pickle.PicklingError):
+                MyDB(sample_filename, codec = "pickle").saveStrings([])
+
+            mock_remove.assert_called_once_with(temp_filename)
+            mock_replace.assert_not_called()
+
     def describe_save_string_method():
 
         def test_save_string_loads_existing_data(mocker, sample_filename):
@@ -165,3 +244,376 @@ def describe_MyDB():
 
             mock_load_strings.assert_called_once()
             mock_save_strings.assert_called_once_with([new_string])
+
+def describe_log_mode():
+
+    @pytest.fixture
+    def log_path(tmp_path):
+        return str(tmp_path / "strings.log")
+
+    def test_appends_and_loads_strings(log_path):
+        db = MyDB(log_path, mode="log")
+
+        db.saveString("hello")
+        db.saveString("wörld")
+
+        assert MyDB(log_path, mode="log").loadStrings() == ["hello", "wörld"]
+
+    def test_append_only_writes_the_new_record(log_path):
+        db = MyDB(log_path, mode="log")
+        db.saveStrings(["a" * 1000] * 10)
+        size = os.path.getsize(log_path)
+
+        db.saveString("b")
+
+        assert os.path.getsize(log_path) == size + 9 + 1
+
+    def test_save_strings_replaces_the_list(log_path):
+        db = MyDB(log_path, mode="log")
+        db.saveString("old")
+
+        db.saveStrings(["new1", "new2"])
+        db.saveString("new3")
+
+        assert db.loadStrings() == ["new1", "new2", "new3"]
+
+    def test_recovers_from_a_torn_tail_record(log_path):
+        db = MyDB(log_path, mode="log")
+        db.saveString("kept")
+        db.saveString("torn")
+        with open(log_path, "r+b") as f:
+            f.truncate(os.path.getsize(log_path) - 2)
+
+        db = MyDB(log_path, mode="log")
+        db.saveString("after")
+
+        assert db.loadStrings() == ["kept", "after"]
+
+    def test_cuts_off_a_tear_left_by_another_writer(log_path):
+        db = MyDB(log_path, mode="log")
+        other = MyDB(log_path, mode="log")
+        other.saveString("one")
+        other.saveString("torn")
+        with open(log_path, "r+b") as f:
+            f.truncate(os.path.getsize(log_path) - 2)
+
+        db.saveString("two")
+        db.saveString("three")
+
+        assert MyDB(log_path, mode="log").loadStrings() == ["one", "two", "three"]
+
+    def test_stops_at_a_record_with_a_bad_checksum(log_path):
+        db = MyDB(log_path, mode="log")
+        db.saveString("good")
+        db.saveString("flip")
+        with open(log_path, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"X")
+
+        assert db.loadStrings() == ["good"]
+
+    def test_compacts_once_superseded_records_outweigh_live_ones(log_path):
+        db = MyDB(log_path, mode="log", compactMinBytes=0)
+        db.saveStrings(["x" * 100] * 10)
+        db.saveString("y")
+
+        db.saveStrings(["z"])
+
+        assert db.loadStrings() == ["z"]
+        assert os.path.getsize(log_path) == 8 + 9 + 4 + 4 + 1
+
+    @pytest.mark.parametrize("codec", ["pickle", "marshal", "utf8"])
+    def test_moves_a_snapshot_into_the_log(log_path, codec):
+        MyDB(log_path, codec=codec).saveStrings(["one", "two"])
+
+        db = MyDB(log_path, mode="log")
+        db.saveString("three")
+
+        assert MyDB(log_path, mode="log").loadStrings() == ["one", "two", "three"]
+        with open(log_path, "rb") as f:
+            assert f.read(8) == b"MYDBLOG1"
+
+    def test_rejects_non_string_values(log_path):
+        db = MyDB(log_path, mode="log")
+        with pytest.raises(TypeError):
+            db.saveString(1)
+        assert db.loadStrings() == []
+
+    def test_rejects_unknown_modes(log_path):
+        with pytest.raises(ValueError):
+            MyDB(log_path, mode="csv")
+
+def describe_view():
+
+    @pytest.fixture
+    def log_db(tmp_path):
+        db = MyDB(str(tmp_path / "strings.log"), mode="log")
+        db.saveStrings(["s{}".format(i) for i in range(5)])
+        db.saveString("s5")
+        return db
+
+    def test_reads_entries_lazily_by_index(log_db):
+        with log_db.view() as view:
+            assert len(view) == 6
+            assert view.get(0) == "s0"
+            assert view[-1] == "s5"
+            assert view[-3:] == ["s3", "s4", "s5"]
+            assert view[::2] == ["s0", "s2", "s4"]
+            assert list(view) == log_db.loadStrings()
+
+    def test_raises_index_error_past_the_end(log_db):
+        with log_db.view() as view:
+            with pytest.raises(IndexError):
+                view[6]
+
+    def test_keeps_showing_the_file_as_it_was(log_db):
+        with log_db.view() as view:
+            log_db.saveString("s6")
+            log_db.compact()
+
+            assert len(view) == 6
+            assert view[-1] == "s5"
+
+    def test_reads_only_new_records_on_the_next_view(mocker, log_db):
+        first = log_db.view()
+        log_db.saveString("s6")
+        scan = mocker.spy(log_db.log, "scan")
+
+        with log_db.view() as view:
+            assert view[-2:] == ["s5", "s6"]
+        scan.assert_not_called()
+        assert len(first) == 6 and first[-1] == "s5"
+        first.close()
+
+    def test_starts_over_after_a_compaction(mocker, log_db):
+        log_db.view().close()
+        log_db.saveStrings(["t0"])
+        log_db.compact()
+        scan = mocker.spy(log_db.log, "scan")
+
+        with log_db.view() as view:
+            assert view[:] == ["t0"]
+        scan.assert_called_once()
+
+    def test_ignores_a_torn_tail(log_db):
+        with open(log_db.fname, "r+b") as f:
+            f.truncate(os.path.getsize(log_db.fname) - 1)
+
+        with log_db.view() as view:
+            assert view[:] == ["s0", "s1", "s2", "s3", "s4"]
+
+    def test_maps_utf8_snapshots_lazily_too(tmp_path):
+        db = MyDB(str(tmp_path / "strings.db"))
+        db.saveStrings(["a", "b", "c"])
+
+        with db.view() as view:
+            assert len(view) == 3
+            assert view[-2:] == ["b", "c"]
+
+    def test_is_the_loaded_list_for_other_codecs(tmp_path):
+        db = MyDB(str(tmp_path / "strings.pkl"), codec="pickle")
+        db.saveStrings(["a", "b"])
+
+        assert db.view() == ["a", "b"]
+
+def describe_codecs():
+
+    @pytest.mark.parametrize("codec", ["pickle", "marshal", "utf8"])
+    def test_round_trips_strings(tmp_path, codec):
+        db = MyDB(str(tmp_path / "strings.db"), codec=codec)
+        strings = ["", "plain", "ünïcödé", "\U0001f43f" * 3, "x" * 70000]
+
+        db.saveStrings(strings)
+        db.saveString("last")
+
+        assert MyDB(db.fname, codec=codec).loadStrings() == strings + ["last"]
+
+    def test_new_files_are_not_pickles(tmp_path):
+        path = str(tmp_path / "strings.db")
+        MyDB(path).saveStrings(["a"])
+
+        with open(path, "rb") as f:
+            assert f.read(8) == b"MYDBUTF1"
+
+    def test_reads_a_legacy_pickle_and_migrates_it_on_save(tmp_path):
+        path = str(tmp_path / "strings.pkl")
+        with open(path, "wb") as f:
+            pickle.dump(["old"], f)
+
+        db = MyDB(path, codec="marshal")
+        assert db.loadStrings() == ["old"]
+
+        db.saveString("new")
+
+        with open(path, "rb") as f:
+            assert f.read(8) == b"MYDBMSH1"
+        assert MyDB(path).loadStrings() == ["old", "new"]
+
+    def test_migrate_rewrites_with_the_configured_codec(tmp_path):
+        path = str(tmp_path / "strings.db")
+        MyDB(path, codec="pickle").saveStrings(["a"])
+
+        MyDB(path).migrate()
+
+        with open(path, "rb") as f:
+            assert f.read(8) == b"MYDBUTF1"
+
+    def test_refuses_to_read_a_log_file_as_a_snapshot(tmp_path):
+        path = str(tmp_path / "strings.log")
+        MyDB(path, mode="log").saveString("a")
+
+        with pytest.raises(ValueError):
+            MyDB(path).loadStrings()
+
+    def test_rejects_unknown_codecs(tmp_path):
+        with pytest.raises(ValueError):
+            MyDB(str(tmp_path / "strings.db"), codec="yaml")
+
+def append_strings(path, prefix):
+    db = MyDB(path)
+    for i in range(20):
+        db.saveString("{}{}".format(prefix, i))
+
+def describe_locking():
+
+    def test_serializes_appends_from_several_processes(tmp_path):
+        path = str(tmp_path / "strings.pkl")
+        MyDB(path)
+
+        children = [multiprocessing.Process(target=append_strings, args=(path, prefix)) for prefix in "abc"]
+        for child in children:
+            child.start()
+        for child in children:
+            child.join()
+
+        assert len(MyDB(path).loadStrings()) == 60
+
+    def test_nested_calls_reuse_the_held_lock(tmp_path):
+        db = MyDB(str(tmp_path / "strings.pkl"))
+
+        with db.lock():
+            db.saveString("inside")
+
+        assert db.loadStrings() == ["inside"]
+        assert db.lockFd is None
+
+    def test_rejects_unknown_durability(tmp_path):
+        with pytest.raises(ValueError):
+            MyDB(str(tmp_path / "strings.pkl"), durability="sometimes")
+
+def describe_appendStrings():
+
+    @pytest.mark.parametrize("mode", ["snapshot", "log"])
+    def test_appends_a_batch_in_one_write(tmp_path, mode):
+        db = MyDB(str(tmp_path / "strings.db"), mode=mode)
+        db.saveString("a")
+
+        db.appendStrings(["b", "c"])
+
+        assert db.loadStrings() == ["a", "b", "c"]
+
+def describe_BufferedMyDB():
+
+    @pytest.fixture
+    def path(tmp_path):
+        return str(tmp_path / "strings.db")
+
+    def test_queues_strings_until_max_pending(mocker, path):
+        db = BufferedMyDB(path, maxPending=3, flushInterval=None)
+        append_strings = mocker.spy(MyDB, "appendStrings")
+
+        db.saveString("a")
+        db.saveString("b")
+        assert MyDB(path).loadStrings() == []
+
+        db.saveString("c")
+
+        append_strings.assert_called_once_with(db, ["a", "b", "c"])
+        assert MyDB(path).loadStrings() == ["a", "b", "c"]
+
+    def test_load_strings_includes_queued_strings(path):
+        db = BufferedMyDB(path, flushInterval=None)
+        db.saveStrings(["saved"])
+
+        db.saveString("queued")
+
+        assert db.loadStrings() == ["saved", "queued"]
+        assert MyDB(path).loadStrings() == ["saved"]
+
+    def test_flushes_after_the_interval(path):
+        db = BufferedMyDB(path, flushInterval=0.01)
+
+        db.saveString("a")
+
+        deadline = time.monotonic() + 5
+        while db.pending and time.monotonic() < deadline:
+            time.sleep(0.005)
+        assert MyDB(path).loadStrings() == ["a"]
+
+    def test_flushes_on_exit_from_the_with_block(path):
+        with BufferedMyDB(path, mode="log", flushInterval=None) as db:
+            db.saveString("a")
+            db.saveString("b")
+
+        assert MyDB(path, mode="log").loadStrings() == ["a", "b"]
+        assert db.stats == {"buffered": 2, "flushes": 1}
+
+    def test_keeps_the_batch_when_a_flush_fails(mocker, path):
+        db = BufferedMyDB(path, flushInterval=None)
+        db.saveString("a")
+        mocker.patch.object(MyDB, "appendStrings", side_effect=OSError("disk full"))
+
+        with pytest.raises(OSError):
+            db.flush()
+
+        assert db.pending == ["a"]
+
+    def test_rejects_non_strings_before_queueing_them(path):
+        db = BufferedMyDB(path, flushInterval=None)
+
+        with pytest.raises(TypeError):
+            db.saveString(1)
+
+        assert db.pending == []
+
+    def test_a_direct_append_does_not_deadlock_with_a_flush(path):
+        db = BufferedMyDB(path, flushInterval=None)
+        db.saveString("queued")
+        flushing = threading.Event()
+
+        #a flush holds pendingLock and is about to take the file lock
+        def flush():
+            with db.pendingLock:
+                flushing.set()
+                time.sleep(0.1)
+                db.flush()
+
+        flusher = threading.Thread(target=flush, daemon=True)
+        appender = threading.Thread(target=db.appendStrings, args=(["direct"],), daemon=True)
+        flusher.start()
+        flushing.wait()
+        appender.start()
+        flusher.join(5)
+        appender.join(5)
+
+        assert not flusher.is_alive() and not appender.is_alive()
+        assert MyDB(path).loadStrings() == ["queued", "direct"]
+
+    def test_flushes_unclosed_instances_at_exit(path):
+        db = BufferedMyDB(path, flushInterval=None)
+        db.saveString("a")
+
+        mydb.closeOpenBuffers()
+
+        assert MyDB(path).loadStrings() == ["a"]
+
+    def test_can_be_collected_without_being_closed(path):
+        db = BufferedMyDB(path, flushInterval=None)
+        db.saveString("a")
+        db.flush()
+        collected = weakref.ref(db)
+
+        del db
+        gc.collect()
+
+        assert collected() is None
@@ -0,0 +1,146 @@
+import asyncio
+import http.client
+import re
+import threading
+import pytest
+import bench_squirrel_server
+from squirrel_async_server import AsyncSquirrelServer
+from squirrel_db import SquirrelDB, LRUCache
+from squirrel_server import SquirrelServerHandler
+
+class FakeStreamWriter():
+    #collects everything the server writes back to the client
+    def __init__(self):
+        self.data = b''
+        self.writes = 0
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+        self.writes += 1
+
+    async def drain(self):
+        return
+
+    def get_extra_info(self, name):
+        return ('127.0.0.1', 80)
+
+    def close(self):
+        self.closed = True
+
+def make_request(method, path, body=None):
+    headers = ''
+    if body:
+        headers = 'Content-Length: {}\r\n'.format(len(body))
+    return bytes('{} {} HTTP/1.0\r\n{}\r\n{}'.format(method, path, headers, body or ''), 'utf-8')
+
+def statuses(data):
+    return [int(code) for code in re.findall(rb'HTTP/1\.[01] (\d{3}) ', data)]
+
+@pytest.fixture
+def server():
+    server = AsyncSquirrelServer(dbWorkers=2)
+    yield server
+    server.close()
+
+#feeds raw bytes through one client connection and returns what was written back
+@pytest.fixture
+def serve(server):
+    def serve(rawRequests):
+        async def connect():
+            reader = asyncio.StreamReader()
+            reader.feed_data(rawRequests)
+            reader.feed_eof()
+            writer = FakeStreamWriter()
+            await server.handleConnection(reader, writer)
+            return writer
+        return asyncio.run(connect())
+    return serve
+
+@pytest.fixture(autouse=True)
+def fresh_response_cache(mocker):
+    return mocker.patch.object(SquirrelServerHandler, 'responseCache', LRUCache())
+
+@pytest.fixture(autouse=True)
+def mock_db_init(mocker):
+    return mocker.patch.object(SquirrelDB, '__init__', return_value=None)
+
+def describe_AsyncSquirrelServer():
+
+    #the behaviours both engines share are run against this one too, see
+    #describe_both_engines and describe_persistent_connections in test_squirrel_server.py
+    def describe_executor():
+
+        def it_runs_db_calls_on_the_executor(mocker, serve):
+            threadNames = []
+            mocker.patch.object(SquirrelDB, 'getSquirrels', side_effect=lambda: threadNames.append(threading.current_thread().name) or [])
+
+            serve(make_request('GET', '/squirrels'))
+
+            assert threadNames[0].startswith('squirrel-db')
+
+    def describe_connections():
+
+        def it_closes_http_1_0_connections_after_one_response(mocker, serve):
+            mocker.patch.object(SquirrelDB, 'getSquirrels', return_value=[])
+
+            writer = serve(make_request('GET', '/squirrels') + make_request('GET', '/squirrels'))
+
+            assert statuses(writer.data) == [200]
+            assert writer.closed
+
+    def describe_request_bodies():
+
+        def it_answers_413_without_buffering_an_oversized_body(mocker, serve):
+            mocker.patch.object(SquirrelServerHandler, 'maxBodySize', 8)
+            mock_create_squirrel = mocker.patch.object(SquirrelDB, 'createSquirrel', return_value=None)
+
+            #the declared body never arrives, so waiting for it would mean no answer at all
+            writer = serve(b'POST /squirrels HTTP/1.1\r\nHost: test\r\nContent-Length: 1000\r\n\r\nname=Chippy&size=small')
+
+            assert statuses(writer.data) == [413]
+            assert b'Connection: close' in writer.data
+            mock_create_squirrel.assert_not_called()
+
+    def describe_streaming():
+
+        def it_writes_each_chunk_as_it_is_produced(mocker, serve):
+            squirrels = [{'id': i, 'name': 'S', 'size': 'small'} for i in range(1, 6)]
+            mocker.patch.object(SquirrelServerHandler, 'streamChunkSize', 2)
+            mocker.patch.object(SquirrelDB, 'getSquirrelsPage', side_effect=lambda afterId, limit: [s for s in squirrels if s['id'] > afterId][:limit])
+            mocker.patch.object(SquirrelDB, 'getSquirrels', return_value=[])
+
+            writer = serve(b'GET /squirrels?stream=ndjson HTTP/1.1\r\nHost: test\r\n\r\n'
+                           b'GET /squirrels HTTP/1.1\r\nHost: test\r\n\r\n')
+
+            assert statuses(writer.data) == [200, 200]
+            assert writer.writes > 3
+            assert writer.data.count(b'"name": "S"') == 5
+
+    def describe_command_line():
+
+        #the real script in its own process, so it runs as __main__
+        @pytest.fixture
+        def start_script(tmp_path):
+            processes = []
+            def start(*serverArgs):
+                path = str(tmp_path / 'squirrels.db')
+                bench_squirrel_server.makeDatabase(path, 1)
+                port = bench_squirrel_server.freePort('127.0.0.1')
+                processes.append(bench_squirrel_server.startServer(path, '127.0.0.1', port, ['--engine', 'asyncio'] + list(serverArgs)))
+                return http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            yield start
+            for process in processes:
+                bench_squirrel_server.stopServer(process)
+
+        def it_serves_with_the_handler_settings_from_the_command_line(start_script):
+            connection = start_script('--metrics', '--max-body-size', '10')
+
+            connection.request('GET', '/_metrics')
+            metrics = connection.getresponse()
+            metrics.read()
+            connection.request('POST', '/squirrels', body='name=Chippy&size=small')
+            created = connection.getresponse()
+            created.read()
+
+            assert (metrics.status, created.status) == (200, 413)
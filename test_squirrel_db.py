@@ -0,0 +1,630 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+import pytest
+import squirrel_db
+from squirrel_db import SquirrelDB, SquirrelConnectionPool, PoolTimeout, LRUCache, MISSING, squirrelsVersion, GroupCommitWriter, Squirrel, toJSON
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "squirrel_db.db")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE squirrels (id INTEGER PRIMARY KEY, name TEXT, size TEXT)")
+    connection.commit()
+    connection.close()
+    return path
+
+@pytest.fixture
+def pool(db_path):
+    pool = SquirrelConnectionPool(db_path, maxSize=2, timeout=0.2)
+    yield pool
+    pool.close()
+
+def describe_SquirrelConnectionPool():
+
+    def describe_acquire():
+
+        def it_reuses_the_same_connection_within_a_thread(pool):
+            first = pool.acquire()
+            pool.release(first)
+            second = pool.acquire()
+            pool.release(second)
+
+            assert first is second
+            stats = pool.getStats()
+            assert stats["opens"] == 1
+            assert stats["hits"] == 1
+            assert stats["reuses"] == 1
+
+        def it_never_opens_more_than_max_size(pool):
+            first = pool.acquire()
+            second = pool.acquire()
+
+            with pytest.raises(PoolTimeout):
+                pool.acquire()
+
+            assert pool.getStats()["opens"] == 2
+            assert pool.getStats()["timeouts"] == 1
+            pool.release(first)
+            pool.release(second)
+
+        def it_waits_for_a_released_connection(pool):
+            first = pool.acquire()
+            second = pool.acquire()
+            acquired = []
+            waiter = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+
+            waiter.start()
+            while pool.getStats()["waits"] == 0:
+                time.sleep(0.001)
+            pool.release(first)
+            waiter.join(1)
+
+            assert acquired == [first]
+            assert pool.getStats()["waits"] == 1
+            pool.release(second)
+            pool.release(first)
+
+        def it_replaces_a_connection_that_fails_its_health_check(db_path):
+            pool = SquirrelConnectionPool(db_path, maxSize=1, healthCheckInterval=0)
+            broken = pool.acquire()
+            pool.release(broken)
+            broken.close()
+
+            replacement = pool.acquire()
+
+            assert replacement is not broken
+            assert pool.getStats()["discards"] == 1
+            assert replacement.execute("SELECT 1").fetchone() == {"1": 1}
+            pool.release(replacement)
+            pool.close()
+
+    def describe_pragmas():
+
+        def it_applies_per_connection_pragmas(db_path):
+            pool = SquirrelConnectionPool(db_path, pragmas={"synchronous": "off", "cache_size": -1234, "temp_store": "memory"})
+
+            with pool.connection() as connection:
+                settings = squirrel_db.readPragmas(connection)
+
+            assert settings["synchronous"] == "off"
+            assert settings["cache_size"] == -1234
+            assert settings["temp_store"] == "memory"
+            pool.close()
+
+        def it_rejects_unknown_pragmas_and_unsafe_values(db_path):
+            with pytest.raises(ValueError):
+                SquirrelConnectionPool(db_path, pragmas={"writable_schema": 1})
+            with pytest.raises(ValueError):
+                SquirrelConnectionPool(db_path, pragmas={"cache_size": "1; DROP TABLE squirrels"})
+
+    def describe_statement_cache():
+
+        def it_prewarms_the_fixed_reads_so_the_first_lookup_hits(pool):
+            db = SquirrelDB(pool, cache=LRUCache(maxSize=0))
+
+            db.getSquirrel(1)
+            db.getSquirrel(2)
+
+            stats = pool.getStatementStats()
+            assert stats["hits"] == 2
+            assert stats["misses"] == len(squirrel_db.PREWARM_STATEMENTS)
+
+        def it_counts_evictions_from_a_small_cache_as_misses(db_path):
+            pool = SquirrelConnectionPool(db_path, cachedStatements=1, prewarm=False)
+            with pool.connection() as connection:
+                for _ in range(2):
+                    connection.execute("SELECT 1").fetchone()
+                    connection.cursor().execute("SELECT 2").fetchone()
+
+            assert pool.getStatementStats()["hits"] == 0
+            assert pool.getStatementStats()["misses"] == 4
+            pool.close()
+
+        def it_keeps_the_counts_of_closed_connections(db_path):
+            pool = SquirrelConnectionPool(db_path, prewarm=False)
+            with pool.connection() as connection:
+                connection.execute("SELECT 1")
+                connection.execute("SELECT 1")
+
+            pool.close()
+
+            assert pool.getStatementStats()["hits"] == 1
+            assert pool.getStatementStats()["hitRate"] == 0.5
+
+    def describe_hooks():
+
+        def it_logs_statements_slower_than_the_threshold_with_their_parameters(db_path, caplog):
+            pool = SquirrelConnectionPool(db_path, prewarm=False, slowQueryMs=0)
+            db = SquirrelDB(pool, cache=LRUCache(maxSize=0))
+
+            with caplog.at_level(logging.WARNING, logger="squirrel_db.slow"):
+                db.getSquirrel(7)
+                db.createSquirrels([("Chippy", "small")] * 3)
+
+            assert "FROM squirrels WHERE id = ? (7,)" in caplog.text
+            assert "INSERT INTO squirrels (name, size) VALUES (?, ?) (executemany)" in caplog.text
+            assert pool.getStatementStats()["slowQueries"] >= 2
+            pool.close()
+
+        def it_stays_quiet_under_the_threshold(db_path, caplog):
+            pool = SquirrelConnectionPool(db_path, prewarm=False, slowQueryMs=60000)
+            db = SquirrelDB(pool, cache=LRUCache(maxSize=0))
+
+            with caplog.at_level(logging.WARNING, logger="squirrel_db.slow"):
+                db.createSquirrel("Chippy", "small")
+                assert db.getSquirrels() == [{"id": 1, "name": "Chippy", "size": "small"}]
+
+            assert caplog.records == []
+            assert pool.getStatementStats()["slowQueries"] == 0
+            pool.close()
+
+        def it_hands_trace_and_progress_callbacks_to_sqlite(db_path):
+            statements = []
+            steps = []
+            pool = SquirrelConnectionPool(db_path, prewarm=False, traceCallback=statements.append,
+                                          progressHandler=lambda: steps.append(1) or 0, progressInterval=1)
+
+            SquirrelDB(pool, cache=LRUCache(maxSize=0)).getSquirrels()
+
+            assert squirrel_db.SELECT_ALL_SQL in statements
+            assert steps
+            pool.close()
+
+    def describe_read_only():
+
+        def it_refuses_writes(db_path):
+            readers = SquirrelConnectionPool(db_path, readOnly=True)
+            with readers.connection() as connection:
+                with pytest.raises(sqlite3.OperationalError, match="readonly"):
+                    connection.execute("INSERT INTO squirrels (name, size) VALUES ('Chippy', 'small')")
+            readers.close()
+
+        def it_routes_reads_to_the_read_pool_and_writes_to_the_writer(db_path):
+            writer = SquirrelConnectionPool(db_path, maxSize=1, pragmas={"journal_mode": "wal"})
+            readers = SquirrelConnectionPool(db_path, maxSize=2, readOnly=True)
+            db = SquirrelDB(writer, cache=LRUCache(maxSize=0), readPool=readers)
+
+            db.createSquirrel("Chippy", "small")
+            # read-your-writes: the write has committed before createSquirrel returns
+            assert db.getSquirrels() == [{"id": 1, "name": "Chippy", "size": "small"}]
+            assert db.getSquirrel(1)["name"] == "Chippy"
+            db.updateSquirrel(1, "Chippy", "large")
+            assert db.findSquirrels(size="large") == [{"id": 1, "name": "Chippy", "size": "large"}]
+
+            assert writer.getStats()["acquires"] == 2
+            assert readers.getStats()["acquires"] == 3
+            writer.close()
+            readers.close()
+
+    def describe_release():
+
+        def it_rolls_back_an_open_transaction(pool):
+            with pool.connection() as connection:
+                connection.execute("INSERT INTO squirrels (name, size) VALUES ('Chippy', 'small')")
+
+            with pool.connection() as connection:
+                assert connection.execute("SELECT COUNT(*) AS n FROM squirrels").fetchone() == {"n": 0}
+
+@pytest.fixture
+def cache():
+    return LRUCache(maxSize=16, ttl=60)
+
+def describe_LRUCache():
+
+    def it_returns_missing_for_unknown_keys(cache):
+        assert cache.get("nope") is MISSING
+        assert cache.getStats()["misses"] == 1
+
+    def it_evicts_the_least_recently_used_entry():
+        cache = LRUCache(maxSize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+
+        cache.put("c", 3)
+
+        assert cache.get("b") is MISSING
+        assert cache.get("a") == 1
+        assert cache.getStats()["evictions"] == 1
+
+    def it_expires_entries_after_the_ttl(mocker, cache):
+        clock = mocker.patch("squirrel_db.time.monotonic", return_value=100.0)
+        cache.put("a", 1)
+
+        clock.return_value = 161.0
+
+        assert cache.get("a") is MISSING
+        assert cache.getStats()["expirations"] == 1
+
+    def it_skips_a_put_that_raced_with_an_invalidation(cache):
+        generation = cache.generation
+        cache.invalidate("a")
+
+        cache.put("a", "stale", generation)
+
+        assert cache.get("a") is MISSING
+
+    def it_stores_nothing_when_disabled():
+        cache = LRUCache(maxSize=0)
+        cache.put("a", 1)
+        assert cache.get("a") is MISSING
+
+def describe_Squirrel():
+
+    def it_compares_equal_to_the_matching_dict():
+        squirrel = Squirrel(1, "Chippy", "small")
+
+        assert squirrel == {"id": 1, "name": "Chippy", "size": "small"}
+        assert squirrel != {"id": 2, "name": "Chippy", "size": "small"}
+        assert squirrel["id"] == 1
+        with pytest.raises(KeyError):
+            squirrel["color"]
+
+    def it_encodes_exactly_like_json_dumps_of_the_dict():
+        squirrels = [Squirrel(1, "Chippy", "small"), Squirrel(2, 'Say "nuts"\n\u00e9\U0001f43f', None), Squirrel(3, "", 2.5)]
+
+        for squirrel in squirrels:
+            assert toJSON(squirrel) == json.dumps(squirrel.toDict())
+        assert toJSON(squirrels) == json.dumps([squirrel.toDict() for squirrel in squirrels])
+        assert toJSON([]) == "[]"
+        assert toJSON({"created": [1]}) == json.dumps({"created": [1]})
+
+def query_plan(pool, **filters):
+    sql, data = squirrel_db.squirrelsQuery(**filters)
+    with pool.connection() as connection:
+        return " | ".join(row["detail"] for row in connection.execute("EXPLAIN QUERY PLAN " + sql, data))
+
+def describe_SquirrelDB():
+
+    @pytest.fixture
+    def db(pool, cache):
+        return SquirrelDB(pool, cache)
+
+    def it_creates_and_reads_squirrels_through_the_pool(pool, db):
+
+        db.createSquirrel("Chippy", "small")
+        db.createSquirrel("Fluffy", "large")
+
+        assert db.getSquirrels() == [
+            {"id": 1, "name": "Chippy", "size": "small"},
+            {"id": 2, "name": "Fluffy", "size": "large"},
+        ]
+        assert db.getSquirrel(2) == {"id": 2, "name": "Fluffy", "size": "large"}
+        assert pool.getStats()["opens"] == 1
+
+    def it_returns_squirrel_records_and_dicts_for_other_queries(pool, db):
+        db.createSquirrel("Chippy", "small")
+
+        assert type(db.getSquirrel(1)) is Squirrel
+        assert all(type(squirrel) is Squirrel for squirrel in db.getSquirrelsPage())
+        with pool.connection() as connection:
+            assert connection.execute("SELECT COUNT(*) AS n FROM squirrels").fetchone() == {"n": 1}
+
+    def it_updates_and_deletes_squirrels(db):
+        db.createSquirrel("Chippy", "small")
+
+        db.updateSquirrel(1, "Chippy", "large")
+        assert db.getSquirrel(1) == {"id": 1, "name": "Chippy", "size": "large"}
+
+        db.deleteSquirrel(1)
+        assert db.getSquirrel(1) is None
+
+    def it_serves_repeated_reads_from_the_cache(pool, cache, db):
+        db.createSquirrel("Chippy", "small")
+        db.getSquirrel("1")
+        db.getSquirrels()
+        acquires = pool.getStats()["acquires"]
+
+        assert db.getSquirrel(1) == {"id": 1, "name": "Chippy", "size": "small"}
+        assert db.getSquirrels() == [{"id": 1, "name": "Chippy", "size": "small"}]
+        assert pool.getStats()["acquires"] == acquires
+        assert cache.getStats()["hits"] == 2
+
+    def it_invalidates_only_the_written_squirrel_and_the_list(db, cache):
+        db.createSquirrel("Chippy", "small")
+        db.createSquirrel("Fluffy", "large")
+        db.getSquirrel(1)
+        db.getSquirrel(2)
+        db.getSquirrels()
+
+        db.updateSquirrel("2", "Fluffy", "small")
+
+        assert cache.get(("squirrel", 1)) == {"id": 1, "name": "Chippy", "size": "small"}
+        assert cache.get(("squirrel", 2)) is MISSING
+        assert cache.get("squirrels") is MISSING
+        assert db.getSquirrel(2) == {"id": 2, "name": "Fluffy", "size": "small"}
+
+    def it_drops_a_deleted_squirrel_from_the_cache(db):
+        db.createSquirrel("Chippy", "small")
+        db.getSquirrel(1)
+
+        db.deleteSquirrel(1)
+
+        assert db.getSquirrel(1) is None
+        assert db.getSquirrels() == []
+
+    def it_bumps_the_table_version_on_every_write(db):
+        before = squirrelsVersion.current()
+        db.createSquirrel("Chippy", "small")
+        afterCreate = squirrelsVersion.current()
+        db.getSquirrels()
+
+        assert squirrelsVersion.current() == afterCreate != before
+        db.updateSquirrel(1, "Chippy", "large")
+        db.deleteSquirrel(1)
+        assert squirrelsVersion.value == int(afterCreate.split("-")[1]) + 2
+
+    def it_drops_cached_rows_before_the_new_version_is_visible(db, cache, mocker):
+        db.createSquirrel("Chippy", "small")
+        db.applyBulk([("create", "Fluffy", "large")])
+        db.getSquirrels()
+        cachedAtBump = []
+        mocker.patch.object(squirrelsVersion, 'bump', side_effect=lambda: cachedAtBump.append(cache.get("squirrels")))
+
+        db.updateSquirrel(1, "Chippy", "large")
+        db.getSquirrels()
+        db.applyBulk([("delete", 2)])
+
+        assert cachedAtBump == [MISSING, MISSING]
+
+    def it_reads_keyset_pages(db):
+        for name in ["A", "B", "C", "D", "E"]:
+            db.createSquirrel(name, "small")
+
+        assert [s["id"] for s in db.getSquirrelsPage(0, 2)] == [1, 2]
+        assert [s["id"] for s in db.getSquirrelsPage(3, 10)] == [4, 5]
+        assert db.getSquirrelsPage(5, 10) == []
+
+    def it_iterates_the_table_in_chunks(db):
+        for name in ["A", "B", "C", "D", "E"]:
+            db.createSquirrel(name, "small")
+
+        chunks = list(db.iterSquirrels(2))
+
+        assert [[s["name"] for s in chunk] for chunk in chunks] == [["A", "B"], ["C", "D"], ["E"]]
+
+    def describe_findSquirrels():
+
+        @pytest.fixture
+        def filled_db(db):
+            db.createSquirrels([("Chippy", "small"), ("Chipper", "large"), ("Fluffy", "small"), ("Chip", "small"), ("Dale", "medium")])
+            return db
+
+        @pytest.fixture
+        def indexed_pool(pool, db_path):
+            squirrel_db.migrate(db_path)
+            return pool
+
+        def it_filters_by_name_size_and_name_prefix(filled_db):
+            assert [s.id for s in filled_db.findSquirrels(name="Chippy")] == [1]
+            assert [s.id for s in filled_db.findSquirrels(size="small")] == [1, 3, 4]
+            assert [s.id for s in filled_db.findSquirrels(namePrefix="Chip")] == [1, 2, 4]
+            assert [s.id for s in filled_db.findSquirrels(namePrefix="Chip", size="small", afterId=1, limit=1)] == [4]
+            assert filled_db.findSquirrels(namePrefix="Chipz") == []
+
+        def it_streams_filtered_chunks(filled_db):
+            assert [[s.id for s in chunk] for chunk in filled_db.iterSquirrels(2, size="small")] == [[1, 3], [4]]
+
+        def it_looks_up_names_and_sizes_through_their_indexes(indexed_pool):
+            name_plan = query_plan(indexed_pool, name="Chippy", afterId=5, limit=10)
+            size_plan = query_plan(indexed_pool, size="small")
+
+            assert "USING INDEX squirrels_name (name=? AND rowid>?)" in name_plan
+            assert "USING INDEX squirrels_size (size=? AND rowid>?)" in size_plan
+            assert "TEMP B-TREE" not in name_plan + size_plan
+
+        def it_turns_a_name_prefix_into_an_index_range(indexed_pool):
+            plan = query_plan(indexed_pool, namePrefix="Chip")
+
+            assert "USING INDEX squirrels_name (name>? AND name<?)" in plan
+
+        def it_bounds_prefixes_ending_in_the_last_code_points():
+            assert squirrel_db.prefixUpperBound("ab") == "ac"
+            assert squirrel_db.prefixUpperBound("a\U0010ffff") == "b"
+            assert squirrel_db.prefixUpperBound("a\ud7ff") == "a\ue000"
+            assert squirrel_db.prefixUpperBound("\U0010ffff") is None
+
+    def describe_applyBulk():
+
+        def it_applies_mixed_operations_in_one_commit(db, pool):
+            db.createSquirrel("Chippy", "small")
+            statements = []
+            with pool.connection() as connection:
+                connection.set_trace_callback(statements.append)
+
+            results = db.applyBulk([
+                ("create", "A", "small"),
+                ("create", "B", "large"),
+                ("update", "1", "Chippy", "large"),
+                ("update", 99, "Ghost", "small"),
+                ("delete", 2),
+                ("delete", 2),
+            ])
+
+            assert results == [2, 3, True, False, True, False]
+            assert statements.count("COMMIT") == 1
+            assert db.getSquirrels() == [
+                {"id": 1, "name": "Chippy", "size": "large"},
+                {"id": 3, "name": "B", "size": "large"},
+            ]
+
+        def it_does_not_take_a_fractional_id_for_a_whole_one(db, cache, mocker):
+            db.createSquirrel("Chippy", "small")
+            invalidate = mocker.spy(cache, "invalidate")
+
+            assert db.applyBulk([("update", 1.5, "Ghost", "large")]) == [False]
+            assert squirrel_db.cacheKey(1) not in invalidate.call_args.args
+            assert db.getSquirrel(1)["size"] == "small"
+
+        def it_rolls_everything_back_when_a_statement_fails(db, pool):
+            with pytest.raises(ValueError):
+                db.applyBulk([("create", "A", "small"), ("explode",)])
+
+            assert db.getSquirrels() == []
+            assert pool.getStats()["idle"] == 1
+
+        def it_invalidates_cached_squirrels(db, cache):
+            db.createSquirrel("Chippy", "small")
+            db.getSquirrel(1)
+            db.getSquirrels()
+
+            db.updateSquirrels([(1, "Chippy", "large")])
+
+            assert db.getSquirrel(1)["size"] == "large"
+            assert db.getSquirrels()[0]["size"] == "large"
+
+        def it_creates_many_squirrels_and_returns_their_ids(db):
+            assert db.createSquirrels([("S{}".format(i), "small") for i in range(1000)]) == list(range(1, 1001))
+            assert db.deleteSquirrels([1, 1000, 5000]) == [True, True, False]
+
+def describe_GroupCommitWriter():
+
+    @pytest.fixture
+    def writer(db_path):
+        pool = SquirrelConnectionPool(db_path, maxSize=4)
+        writer = GroupCommitWriter(pool, window=0.05, maxBatch=64)
+        yield writer
+        writer.stop()
+        pool.close()
+
+    def it_commits_concurrent_writes_together(writer, cache):
+        db = SquirrelDB(writer.pool, cache, writer)
+        threads = [threading.Thread(target=db.createSquirrel, args=("S{}".format(i), "small")) for i in range(20)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        assert len(db.getSquirrels()) == 20
+        stats = writer.getStats()
+        assert stats["writes"] == 20
+        assert stats["batches"] < 20
+
+    def it_fails_only_the_write_that_failed(writer, cache):
+        db = SquirrelDB(writer.pool, cache, writer)
+        errors = []
+        def badWrite():
+            try:
+                writer.submit("INSERT INTO nowhere (name) VALUES (?)", ["x"])
+            except sqlite3.Error as error:
+                errors.append(error)
+        threads = [threading.Thread(target=badWrite)] + [threading.Thread(target=db.createSquirrel, args=("S", "small")) for i in range(3)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        assert len(errors) == 1
+        assert len(db.getSquirrels()) == 3
+        assert writer.getStats()["failures"] == 1
+
+    def it_reports_rowcounts_to_the_caller(writer):
+        writer.submit("INSERT INTO squirrels (name, size) VALUES (?, ?)", ["Chippy", "small"])
+        assert writer.submit("UPDATE squirrels SET size = ? WHERE id = ?", ["large", 1]) == 1
+        assert writer.submit("DELETE FROM squirrels WHERE id = ?", [2]) == 0
+
+def describe_configure():
+
+    @pytest.fixture(autouse=True)
+    def restore_settings():
+        saved = dict(squirrel_db.settings)
+        yield
+        squirrel_db.settings.update(saved)
+        squirrel_db.resetPool()
+
+    def it_points_the_default_pool_at_the_configured_database(db_path):
+        squirrel_db.configure(db_path, "balanced", {"cache_size": -4096}, poolSize=3, cachedStatements=64)
+
+        pool = squirrel_db.getPool()
+
+        assert pool.cachedStatements == 64
+        assert pool.path == db_path
+        assert pool.maxSize == 3
+        assert pool.pragmas["synchronous"] == "normal"
+        assert pool.pragmas["cache_size"] == -4096
+
+    def it_gives_writes_one_connection_when_readers_are_configured(db_path):
+        squirrel_db.configure(db_path, "balanced", poolSize=8, readers=2)
+
+        assert squirrel_db.getPool().maxSize == 1
+        assert not squirrel_db.getPool().readOnly
+        assert squirrel_db.getReadPool().maxSize == 2
+        assert squirrel_db.getReadPool().readOnly
+        assert SquirrelDB(cache=LRUCache(maxSize=0)).readPool is squirrel_db.getReadPool()
+
+    def it_reports_the_effective_settings_at_startup(db_path):
+        squirrel_db.configure(db_path, "durable")
+
+        effective, mismatches = squirrel_db.applyProfile()
+
+        assert effective["journal_mode"] == "wal"
+        assert effective["synchronous"] == "full"
+        assert effective["busy_timeout"] == 5000
+        assert mismatches == {}
+
+    def it_rejects_unknown_profiles():
+        with pytest.raises(ValueError):
+            squirrel_db.configure(profile="reckless")
+
+def schema_of(path):
+    connection = sqlite3.connect(path)
+    try:
+        names = [row[0] for row in connection.execute("SELECT name FROM sqlite_master ORDER BY name")]
+        return names, connection.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        connection.close()
+
+def describe_migrate():
+
+    def it_creates_a_fresh_database(tmp_path):
+        path = str(tmp_path / "fresh.db")
+
+        assert squirrel_db.migrate(path) == (0, squirrel_db.SCHEMA_VERSION)
+
+        assert schema_of(path) == (["squirrels", "squirrels_name", "squirrels_size"], squirrel_db.SCHEMA_VERSION)
+
+    def it_upgrades_an_unversioned_database_in_place(db_path):
+        connection = sqlite3.connect(db_path)
+        connection.execute("INSERT INTO squirrels (name, size) VALUES ('Chippy', 'small')")
+        connection.commit()
+        connection.close()
+
+        squirrel_db.migrate(db_path)
+
+        connection = sqlite3.connect(db_path)
+        assert connection.execute("SELECT name, size FROM squirrels").fetchall() == [("Chippy", "small")]
+        connection.close()
+        assert schema_of(db_path)[1] == squirrel_db.SCHEMA_VERSION
+
+    def it_runs_only_the_missing_steps(mocker, db_path):
+        squirrel_db.migrate(db_path)
+        mocker.patch.object(squirrel_db, "MIGRATIONS", squirrel_db.MIGRATIONS + ((99, ("CREATE TABLE extra (id INTEGER)",)),))
+        mocker.patch.object(squirrel_db, "SCHEMA_VERSION", 99)
+
+        assert squirrel_db.migrate(db_path) == (squirrel_db.MIGRATIONS[-2][0], 99)
+        assert squirrel_db.migrate(db_path) == (99, 99)
+        assert "extra" in schema_of(db_path)[0]
+
+    def it_rolls_back_a_failing_step(mocker, db_path):
+        squirrel_db.migrate(db_path)
+        version = squirrel_db.SCHEMA_VERSION
+        mocker.patch.object(squirrel_db, "MIGRATIONS", squirrel_db.MIGRATIONS + ((99, ("CREATE TABLE half (id INTEGER)", "NOT SQL")),))
+        mocker.patch.object(squirrel_db, "SCHEMA_VERSION", 99)
+
+        with pytest.raises(sqlite3.OperationalError):
+            squirrel_db.migrate(db_path)
+
+        assert schema_of(db_path) == (["squirrels", "squirrels_name", "squirrels_size"], version)
+
+    def it_refuses_a_database_from_newer_code(db_path):
+        connection = sqlite3.connect(db_path)
+        connection.execute("PRAGMA user_version = 1000")
+        connection.close()
+
+        with pytest.raises(RuntimeError):
+            squirrel_db.migrate(db_path)
@@ -0,0 +1,114 @@
+import io
+import pstats
+import time
+from squirrel_metrics import RequestMetrics, RequestProfiler, DeferredWriter, TimedDB, AsyncLog, renderStats
+
+def describe_RequestMetrics():
+
+    def it_renders_cumulative_latency_buckets():
+        metrics = RequestMetrics(buckets=(0.01, 0.1))
+        metrics.record('GET', '/squirrels', '200', 0.005, {'db': 0.002, 'encode': 0.001}, 120)
+        metrics.record('GET', '/squirrels', '200', 0.05, {'db': 0.02, 'encode': 0.01}, 80)
+        metrics.record('GET', '/squirrels', '304', 0.5, {'db': 0.0, 'encode': 0.0}, 40)
+
+        lines = metrics.render()
+
+        assert 'squirrel_http_request_duration_seconds_bucket{method="GET",route="/squirrels",le="0.01"} 1' in lines
+        assert 'squirrel_http_request_duration_seconds_bucket{method="GET",route="/squirrels",le="0.1"} 2' in lines
+        assert 'squirrel_http_request_duration_seconds_bucket{method="GET",route="/squirrels",le="+Inf"} 3' in lines
+        assert 'squirrel_http_request_duration_seconds_count{method="GET",route="/squirrels"} 3' in lines
+        assert 'squirrel_http_requests_total{method="GET",route="/squirrels",status="304"} 1' in lines
+        assert 'squirrel_http_stage_seconds_total{route="/squirrels",stage="db"} 0.022000' in lines
+        assert 'squirrel_http_response_bytes_total{route="/squirrels"} 240' in lines
+
+    def it_escapes_label_values_and_skips_non_numeric_stats():
+        lines = renderStats('squirrel_cache', {'hitRate': 0.5, 'name': 'rows'}, {'cache': 'a"b'})
+
+        assert lines == ['# TYPE squirrel_cache_hit_rate gauge', 'squirrel_cache_hit_rate{cache="a\\"b"} 0.5']
+
+def describe_DeferredWriter():
+
+    def it_holds_the_last_write_until_flushed():
+        out = io.BytesIO()
+        writer = DeferredWriter(out)
+
+        writer.write(b'head')
+        writer.write(b'body')
+        assert out.getvalue() == b'head'
+
+        writer.flush()
+        assert out.getvalue() == b'headbody'
+
+def describe_TimedDB():
+
+    def it_charges_calls_and_generator_steps_to_db(mocker):
+        def slowChunks():
+            for chunk in [[1], [2]]:
+                time.sleep(0.01)
+                yield chunk
+        db = mocker.Mock()
+        db.getSquirrel.side_effect = lambda squirrelId: time.sleep(0.01) or 'squirrel'
+        db.iterSquirrels.side_effect = lambda chunkSize: slowChunks()
+        timings = {'db': 0.0}
+        timed = TimedDB(db, timings)
+
+        assert timed.getSquirrel(1) == 'squirrel'
+        assert list(timed.iterSquirrels(500)) == [[1], [2]]
+
+        assert timings['db'] >= 0.03
+
+def describe_AsyncLog():
+
+    def it_writes_queued_lines_on_close():
+        stream = io.StringIO()
+        log = AsyncLog(stream)
+
+        log.write('one\n')
+        log.write('two\n')
+        log.close()
+
+        assert stream.getvalue() == 'one\ntwo\n'
+
+    def it_counts_lines_dropped_when_the_queue_is_full(mocker):
+        log = AsyncLog(io.StringIO(), maxPending=1)
+        mocker.patch.object(AsyncLog, 'run')
+
+        log.write('one\n')
+        log.write('two\n')
+
+        assert log.getStats() == {'pending': 1, 'dropped': 1}
+
+def sample_work():
+    return sum(range(1000))
+
+def describe_RequestProfiler():
+
+    def it_profiles_one_request_in_every_n():
+        profiler = RequestProfiler(every=2)
+
+        for _ in range(4):
+            profile = profiler.start()
+            sample_work()
+            if profile is not None:
+                profiler.stop(profile)
+
+        report = profiler.report()
+        assert report.startswith('2 requests profiled of 4 seen')
+        assert 'sample_work' in report
+
+    def it_profiles_one_request_at_a_time():
+        profiler = RequestProfiler(every=1)
+
+        first = profiler.start()
+        assert profiler.start() is None
+        profiler.stop(first)
+
+        assert profiler.samples == 1
+
+    def it_dumps_stats_pstats_can_load(tmp_path):
+        profiler = RequestProfiler(every=1)
+        profiler.stop(profiler.start())
+        path = tmp_path / 'requests.prof'
+        path.write_bytes(profiler.dump())
+
+        assert pstats.Stats(str(path)).total_calls >= 0
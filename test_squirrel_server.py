@@ -1,8 +1,17 @@
+import asyncio
+import http.client
 import io
 import json
+import re
+import socket
+import threading
+import time
 import pytest
-from squirrel_server import SquirrelServerHandler
-from squirrel_db import SquirrelDB
+from unittest.mock import call
+from squirrel_async_server import AsyncSquirrelServer
+from squirrel_server import SquirrelServerHandler, ThreadPoolHTTPServer, makeServer, JSON_DECODERS, configureRequestBodies
+from squirrel_db import SquirrelDB, LRUCache, squirrelsVersion
+from squirrel_metrics import RequestMetrics, RequestProfiler, AsyncLog
 
 #
 
@@ -12,20 +21,31 @@ from squirrel_db import SquirrelDB
 # it will not skip 'peers' of other todos, only children.
 todo = pytest.mark.skip(reason='TODO: pending spec')
 
+#kept before any patching so socket tests can put the real one back
+real_end_headers = SquirrelServerHandler.end_headers
+
 class FakeRequest():
     #helps us test http
     #tests a mock file
     #this is an output
     #creates a write file
-    def __init__(self, mock_wfile, method, path, body=None):
+    def __init__(self, mock_wfile, method, path, body=None, headers=None):
         self._mock_wfile = mock_wfile
         self._method = method
         self._path = path
         self._body = body
+        self._headers = headers or {}
 
     def sendall(self, x):
         return
 
+    #the handler sets an idle timeout and TCP_NODELAY on the socket
+    def settimeout(self, timeout):
+        return
+
+    def setsockopt(self, *args):
+        return
+
     #this is not a 'makefile' like in c++ instead it 'makes' a response file
     #this produces a response/body of the http server
     #written by DJ, don't change haha
@@ -38,6 +58,8 @@ class FakeRequest():
             else:
                 headers = ''
                 body = ''
+            for name, value in self._headers.items():
+                headers += '{}: {}\r\n'.format(name, value)
             request = bytes('{} {} HTTP/1.0\r\n{}\r\n{}'.format(self._method, self._path, headers, body), 'utf-8')
             return io.BytesIO(request)
         elif args[0] == 'wb':
@@ -102,6 +124,16 @@ def patch_wbufsize(mocker):
     mocker.patch.object(SquirrelServerHandler, 'wbufsize', 1)
     mocker.patch.object(SquirrelServerHandler, 'end_headers')
 
+#encoded bodies are cached across requests, every test starts with none
+@pytest.fixture(autouse=True)
+def fresh_response_cache(mocker):
+    return mocker.patch.object(SquirrelServerHandler, 'responseCache', LRUCache())
+
+#the ETag the server hands out for the current table version
+@pytest.fixture
+def current_etag():
+    return '"squirrels-{}"'.format(squirrelsVersion.current())
+
 
 # Fake Requests
 @pytest.fixture
@@ -176,6 +208,10 @@ def mock_response_methods(mocker):
 def mock_handle404(mocker):
     return mocker.patch.object(SquirrelServerHandler, "handle404")
 
+#everything a handler wrote to its (mock) wfile, in order
+def written_body(response):
+    return b''.join(args[0] for args, kwargs in response.wfile.write.call_args_list)
+
 #tests begin here. Your tests should look wildly different. 
 # you should begin testing where it makes sense to you.
 
@@ -212,10 +248,10 @@ def describe_SquirrelServerHandler():
             mock_send_response.assert_called_once_with(200)
 
         #look at these examples. They use fixtures. What fixtures should you use?
-        def it_sends_json_content_type_header(fake_get_squirrels_request, dummy_client, dummy_server, mock_db_get_squirrels, mock_response_methods):
+        def it_sends_json_content_type_header(fake_get_squirrels_request, dummy_client, dummy_server, mock_db_get_squirrels, mock_response_methods, current_etag):
             mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
             SquirrelServerHandler(fake_get_squirrels_request, dummy_client, dummy_server)
-            mock_send_header.assert_called_once_with("Content-Type", "application/json")
+            assert mock_send_header.call_args_list == [call("Content-Type", "application/json"), call("Content-Length", "12"), call("ETag", current_etag)]
 
         def it_calls_end_headers(fake_get_squirrels_request, dummy_client, dummy_server, mock_db_get_squirrels, mock_response_methods):
             mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
@@ -239,6 +275,161 @@ def describe_SquirrelServerHandler():
             # why that? look again at mock_db_get_squirrels
             response.wfile.write.assert_called_once_with(bytes(json.dumps(['squirrel']), "utf-8"))
 
+    def describe_conditional_requests():
+
+        def it_answers_304_without_touching_the_db(mocker, dummy_client, dummy_server, mock_db_get_squirrels, mock_response_methods, current_etag):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+            request = FakeRequest(mocker.Mock(), 'GET', '/squirrels', headers={'If-None-Match': current_etag})
+
+            response = SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            mock_send_response.assert_called_once_with(304)
+            mock_send_header.assert_called_once_with("ETag", current_etag)
+            mock_db_get_squirrels.assert_not_called()
+            response.wfile.write.assert_not_called()
+
+        def it_answers_304_for_a_single_squirrel(mocker, dummy_client, dummy_server, mock_db_get_squirrel, mock_response_methods, current_etag):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+            request = FakeRequest(mocker.Mock(), 'GET', '/squirrels/1', headers={'If-None-Match': '"other", ' + current_etag})
+
+            SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            mock_send_response.assert_called_once_with(304)
+            mock_db_get_squirrel.assert_not_called()
+
+        def it_answers_a_wildcard_only_for_a_squirrel_that_exists(mocker, dummy_client, dummy_server, mock_db_init, mock_response_methods):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+            mocker.patch.object(SquirrelDB, 'getSquirrel', side_effect=lambda squirrelId: 'squirrel' if squirrelId == '1' else None)
+            mock_handle404 = mocker.patch.object(SquirrelServerHandler, 'handle404')
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels/1', headers={'If-None-Match': '*'}), dummy_client, dummy_server)
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels/999', headers={'If-None-Match': '*'}), dummy_client, dummy_server)
+
+            mock_send_response.assert_called_once_with(304)
+            mock_handle404.assert_called_once()
+
+        def it_sends_the_full_body_for_a_stale_etag(mocker, dummy_client, dummy_server, mock_db_get_squirrels, mock_response_methods):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+            request = FakeRequest(mocker.Mock(), 'GET', '/squirrels', headers={'If-None-Match': '"squirrels-old"'})
+
+            SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            mock_send_response.assert_called_once_with(200)
+            mock_db_get_squirrels.assert_called_once()
+
+        def it_reuses_the_encoded_body_until_the_table_changes(mocker, dummy_client, dummy_server, mock_db_get_squirrels):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels'), dummy_client, dummy_server)
+            response = SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels'), dummy_client, dummy_server)
+
+            mock_db_get_squirrels.assert_called_once()
+            response.wfile.write.assert_called_once_with(bytes(json.dumps(['squirrel']), "utf-8"))
+
+            squirrelsVersion.bump()
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels'), dummy_client, dummy_server)
+
+            assert mock_db_get_squirrels.call_count == 2
+
+    def describe_paginated_squirrels():
+
+        @pytest.fixture
+        def mock_db_get_squirrels_page(mocker, mock_db_init):
+            return mocker.patch.object(SquirrelDB, 'getSquirrelsPage', return_value=[{'id': 6, 'name': 'A', 'size': 's'}, {'id': 7, 'name': 'B', 'size': 'm'}])
+
+        def it_queries_one_keyset_page(mocker, dummy_client, dummy_server, mock_db_get_squirrels_page):
+            request = FakeRequest(mocker.Mock(), 'GET', '/squirrels?limit=2&after_id=5')
+
+            response = SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            mock_db_get_squirrels_page.assert_called_once_with(5, 2)
+            response.wfile.write.assert_called_once_with(bytes(json.dumps(mock_db_get_squirrels_page.return_value), "utf-8"))
+
+        def it_links_to_the_next_page_when_the_page_is_full(mocker, dummy_client, dummy_server, mock_db_get_squirrels_page, mock_response_methods):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels?limit=2'), dummy_client, dummy_server)
+
+            mock_send_header.assert_any_call("Link", '</squirrels?limit=2&after_id=7>; rel="next"')
+
+        def it_has_no_next_link_on_the_last_page(mocker, dummy_client, dummy_server, mock_db_get_squirrels_page, mock_response_methods):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels?limit=3'), dummy_client, dummy_server)
+
+            assert "Link" not in [args[0] for args, kwargs in mock_send_header.call_args_list]
+
+        def it_caps_the_page_size(mocker, dummy_client, dummy_server, mock_db_get_squirrels_page):
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels?limit=50000'), dummy_client, dummy_server)
+            mock_db_get_squirrels_page.assert_called_once_with(0, SquirrelServerHandler.maxPageSize)
+
+        @pytest.mark.parametrize('query', ['limit=zero', 'limit=2&after_id=100000000000000000000000', 'limit=100000000000000000000000'])
+        def it_returns_400_for_a_bad_limit_or_after_id(mocker, dummy_client, dummy_server, mock_db_get_squirrels_page, mock_response_methods, query):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels?' + query), dummy_client, dummy_server)
+
+            mock_send_response.assert_called_once_with(400)
+            mock_db_get_squirrels_page.assert_not_called()
+
+    def describe_filtered_squirrels():
+
+        @pytest.fixture
+        def mock_db_find_squirrels(mocker, mock_db_init):
+            return mocker.patch.object(SquirrelDB, 'findSquirrels', return_value=[{'id': 3, 'name': 'Chippy', 'size': 'small'}, {'id': 9, 'name': 'Chipper', 'size': 'small'}])
+
+        def it_passes_the_filters_to_find_squirrels(mocker, dummy_client, dummy_server, mock_db_find_squirrels):
+            mock_get_squirrels = mocker.patch.object(SquirrelDB, 'getSquirrels')
+
+            response = SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels?name_prefix=Chip&size=small'), dummy_client, dummy_server)
+
+            mock_db_find_squirrels.assert_called_once_with(afterId=0, limit=None, namePrefix='Chip', size='small')
+            mock_get_squirrels.assert_not_called()
+            response.wfile.write.assert_called_once_with(bytes(json.dumps(mock_db_find_squirrels.return_value), "utf-8"))
+
+        def it_keeps_the_filters_in_the_next_page_link(mocker, dummy_client, dummy_server, mock_db_find_squirrels, mock_response_methods):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels?name=Chippy&limit=2&after_id=1'), dummy_client, dummy_server)
+
+            mock_db_find_squirrels.assert_called_once_with(afterId=1, limit=2, name='Chippy')
+            mock_send_header.assert_any_call("Link", '</squirrels?name=Chippy&limit=2&after_id=9>; rel="next"')
+
+        def it_streams_only_matching_squirrels(mocker, dummy_client, dummy_server, mock_db_find_squirrels):
+            mock_db_find_squirrels.return_value = [{'id': 3, 'name': 'Chippy', 'size': 'small'}]
+
+            response = SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels?stream=ndjson&size=small'), dummy_client, dummy_server)
+
+            mock_db_find_squirrels.assert_called_once_with(afterId=0, limit=SquirrelServerHandler.streamChunkSize, size='small')
+            assert written_body(response) == b'{"id": 3, "name": "Chippy", "size": "small"}\n'
+
+    def describe_streaming_squirrels():
+
+        @pytest.fixture
+        def squirrels():
+            return [{'id': i, 'name': 'Squirrel{}'.format(i), 'size': 'small'} for i in range(1, 6)]
+
+        @pytest.fixture
+        def mock_db_pages(mocker, mock_db_init, squirrels):
+            mocker.patch.object(SquirrelServerHandler, 'streamChunkSize', 2)
+            return mocker.patch.object(SquirrelDB, 'getSquirrelsPage', side_effect=lambda afterId, limit: [s for s in squirrels if s['id'] > afterId][:limit])
+
+        def it_streams_the_same_json_as_the_full_list(mocker, dummy_client, dummy_server, mock_db_pages, squirrels):
+            response = SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels?stream=1'), dummy_client, dummy_server)
+
+            assert written_body(response) == bytes(json.dumps(squirrels), "utf-8")
+            assert mock_db_pages.call_count == 3
+
+        def it_streams_ndjson_when_asked_for_it(mocker, dummy_client, dummy_server, mock_db_pages, squirrels):
+            request = FakeRequest(mocker.Mock(), 'GET', '/squirrels', headers={'Accept': 'application/x-ndjson'})
+
+            response = SquirrelServerHandler(request, dummy_client, dummy_server)
+
+            assert [json.loads(line) for line in written_body(response).splitlines()] == squirrels
+
+        def it_streams_an_empty_array(mocker, dummy_client, dummy_server, mock_db_init):
+            mocker.patch.object(SquirrelDB, 'getSquirrelsPage', return_value=[])
+            response = SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels?stream=json'), dummy_client, dummy_server)
+            assert written_body(response) == b'[]'
+
     def describe_retrieve_single_squirrel_functionality():
 
         def it_queries_db_for_squirrel_by_id(mocker, dummy_client, dummy_server):
@@ -253,10 +444,10 @@ def describe_SquirrelServerHandler():
             SquirrelServerHandler(fake_get_squirrel_by_id_request, dummy_client, dummy_server)
             mock_send_response.assert_called_once_with(200)
 
-        def it_sends_json_content_type_header_when_squirrel_found(fake_get_squirrel_by_id_request, dummy_client, dummy_server, mock_db_get_squirrel, mock_response_methods):
+        def it_sends_json_content_type_header_when_squirrel_found(fake_get_squirrel_by_id_request, dummy_client, dummy_server, mock_db_get_squirrel, mock_response_methods, current_etag):
             mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
             SquirrelServerHandler(fake_get_squirrel_by_id_request, dummy_client, dummy_server)
-            mock_send_header.assert_called_once_with("Content-Type", "application/json")
+            assert mock_send_header.call_args_list == [call("Content-Type", "application/json"), call("Content-Length", "10"), call("ETag", current_etag)]
 
         def it_calls_handle404_when_squirrel_not_found(fake_get_squirrel_by_id_request, dummy_client, dummy_server, mock_db_get_squirrel_not_found, mock_handle404):
             SquirrelServerHandler(fake_get_squirrel_by_id_request, dummy_client, dummy_server)
@@ -286,11 +477,68 @@ def describe_SquirrelServerHandler():
             SquirrelServerHandler(fake_create_squirrel_request, dummy_client, dummy_server)
             mock_send_response.assert_called_once_with(201)
 
+        def it_sends_an_empty_content_length(fake_create_squirrel_request, dummy_client, dummy_server, mock_db_create_squirrel, mock_response_methods):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+            SquirrelServerHandler(fake_create_squirrel_request, dummy_client, dummy_server)
+            mock_send_header.assert_called_once_with("Content-Length", "0")
+
         def it_calls_end_headers(fake_create_squirrel_request, dummy_client, dummy_server, mock_db_create_squirrel, mock_response_methods):
             mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
             SquirrelServerHandler(fake_create_squirrel_request, dummy_client, dummy_server)
             mock_end_headers.assert_called_once()
 
+    def describe_bulk_operations():
+
+        @pytest.fixture
+        def mock_db_apply_bulk(mocker, mock_db_init):
+            return mocker.patch.object(SquirrelDB, 'applyBulk', side_effect=lambda operations: [
+                7 if operation[0] == 'create' else operation[1] != 99 for operation in operations])
+
+        def it_applies_a_json_array_of_operations_in_one_call(mocker, dummy_client, dummy_server, mock_db_apply_bulk):
+            body = json.dumps([
+                {'op': 'create', 'name': 'Chippy', 'size': 'small'},
+                {'op': 'update', 'id': 1, 'name': 'Chippy', 'size': 'large'},
+                {'op': 'delete', 'id': 99},
+            ])
+
+            response = SquirrelServerHandler(FakeRequest(mocker.Mock(), 'POST', '/squirrels/_bulk', body=body), dummy_client, dummy_server)
+
+            mock_db_apply_bulk.assert_called_once_with([('create', 'Chippy', 'small'), ('update', 1, 'Chippy', 'large'), ('delete', 99)])
+            assert json.loads(written_body(response)) == [
+                {'index': 0, 'status': 201, 'id': 7},
+                {'index': 1, 'status': 204, 'id': 1},
+                {'index': 2, 'status': 404, 'id': 99},
+            ]
+
+        def it_accepts_ndjson_and_reports_invalid_items(mocker, dummy_client, dummy_server, mock_db_apply_bulk, mock_response_methods):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+            body = ('{"op": "create", "name": "Chippy"}\n{"op": "delete", "id": 3}\n{"op": "fly"}\n{"op": "update", "id": [1], "name": "x", "size": "small"}\n'
+                    '{"op": "update", "id": 1.5, "name": "x", "size": "small"}\n{"op": "delete", "id": "12"}\n{"op": "delete", "id": "1e3"}\n'
+                    '{"op": "delete", "id": 9223372036854775808}\n')
+
+            response = SquirrelServerHandler(FakeRequest(mocker.Mock(), 'POST', '/squirrels/_bulk', body=body), dummy_client, dummy_server)
+
+            mock_send_response.assert_called_once_with(200)
+            mock_db_apply_bulk.assert_called_once_with([('delete', 3), ('delete', 12)])
+            assert json.loads(written_body(response)) == [
+                {'index': 0, 'status': 400, 'error': 'missing size'},
+                {'index': 1, 'status': 204, 'id': 3},
+                {'index': 2, 'status': 400, 'error': 'op must be create, update or delete'},
+                {'index': 3, 'status': 400, 'error': 'id must be a string or a number'},
+                {'index': 4, 'status': 400, 'error': 'id must be a 64-bit integer'},
+                {'index': 5, 'status': 204, 'id': 12},
+                {'index': 6, 'status': 400, 'error': 'id must be a 64-bit integer'},
+                {'index': 7, 'status': 400, 'error': 'id is out of range'},
+            ]
+
+        def it_returns_400_for_a_malformed_body(mocker, dummy_client, dummy_server, mock_db_apply_bulk, mock_response_methods):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'POST', '/squirrels/_bulk', body='[{"op": '), dummy_client, dummy_server)
+
+            mock_send_response.assert_called_once_with(400)
+            mock_db_apply_bulk.assert_not_called()
+
     def describe_post_with_id():
 
         def it_calls_handle404_for_post_with_id(fake_post_with_id_request, dummy_client, dummy_server, mock_handle404):
@@ -326,6 +574,11 @@ def describe_SquirrelServerHandler():
             SquirrelServerHandler(fake_update_squirrel_request, dummy_client, dummy_server)
             mock_send_response.assert_called_once_with(204)
 
+        def it_sends_no_content_length_with_204(fake_update_squirrel_request, dummy_client, dummy_server, mock_db_get_squirrel, mock_db_update_squirrel, mock_response_methods):
+            mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
+            SquirrelServerHandler(fake_update_squirrel_request, dummy_client, dummy_server)
+            mock_send_header.assert_not_called()
+
         def it_calls_end_headers_when_squirrel_updated(fake_update_squirrel_request, dummy_client, dummy_server, mock_db_get_squirrel, mock_db_update_squirrel, mock_response_methods):
             mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
             SquirrelServerHandler(fake_update_squirrel_request, dummy_client, dummy_server)
@@ -335,6 +588,79 @@ def describe_SquirrelServerHandler():
             SquirrelServerHandler(fake_update_squirrel_request, dummy_client, dummy_server)
             mock_handle404.assert_called_once()
 
+    def describe_request_bodies():
+
+        @pytest.fixture(params=sorted(JSON_DECODERS))
+        def decoder(request, mocker):
+            mocker.patch.object(SquirrelServerHandler, 'decodeJSON', staticmethod(JSON_DECODERS[request.param]))
+
+        def it_creates_a_squirrel_from_a_json_body(mocker, dummy_client, dummy_server, mock_db_create_squirrel, decoder):
+            body = json.dumps({'name': 'Chippy', 'size': 'small'})
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'POST', '/squirrels', body=body, headers={'Content-Type': 'application/json'}), dummy_client, dummy_server)
+            mock_db_create_squirrel.assert_called_once_with('Chippy', 'small')
+
+        def it_updates_a_squirrel_from_a_json_body(mocker, dummy_client, dummy_server, mock_db_get_squirrel, mock_db_update_squirrel, decoder):
+            body = json.dumps({'name': 'Updated', 'size': 'large'})
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'PUT', '/squirrels/1', body=body, headers={'Content-Type': 'application/json; charset=utf-8'}), dummy_client, dummy_server)
+            mock_db_update_squirrel.assert_called_once_with('1', 'Updated', 'large')
+
+        def it_accepts_the_widest_integer_sqlite_stores(mocker, dummy_client, dummy_server, mock_db_create_squirrel, decoder):
+            body = '{"name": "Chippy", "size": 9223372036854775807}'
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'POST', '/squirrels', body=body, headers={'Content-Type': 'application/json'}), dummy_client, dummy_server)
+            mock_db_create_squirrel.assert_called_once_with('Chippy', 9223372036854775807)
+
+        def it_uses_the_configured_decoder(mocker, dummy_client, dummy_server, mock_db_create_squirrel):
+            decode = mocker.Mock(return_value={'name': 'Chippy', 'size': 'small'})
+            mocker.patch.object(SquirrelServerHandler, 'decodeJSON', staticmethod(decode))
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'POST', '/squirrels', body='{}', headers={'Content-Type': 'application/json'}), dummy_client, dummy_server)
+            decode.assert_called_once_with(b'{}')
+
+        def it_rejects_an_unknown_decoder():
+            with pytest.raises(ValueError):
+                configureRequestBodies(jsonDecoder='nope')
+
+        @pytest.mark.parametrize('body, message', [
+            ('{"name": ', b'malformed JSON'),
+            ('["Chippy", "small"]', b'body must be a JSON object'),
+            ('{"name": "Chippy"}', b'missing size'),
+            ('{"name": {"x": 1}, "size": "small"}', b'name must be a string or a number'),
+            ('{"name": "Chippy", "size": true}', b'size must be a string or a number'),
+            ('{"name": "Chippy", "size": 9223372036854775808}', b'size is out of range'),
+            ('{"name": 18446744073709551615, "size": "small"}', b'name is out of range'),
+        ])
+        def it_returns_400_for_a_bad_json_body(mocker, dummy_client, dummy_server, mock_db_create_squirrel, decoder, body, message):
+            response = SquirrelServerHandler(FakeRequest(mocker.Mock(), 'POST', '/squirrels', body=body, headers={'Content-Type': 'application/json'}), dummy_client, dummy_server)
+            assert written_body(response).startswith(b'400 ')
+            assert message in written_body(response)
+            mock_db_create_squirrel.assert_not_called()
+
+        def it_returns_400_for_a_form_missing_a_field(mocker, dummy_client, dummy_server, mock_db_create_squirrel):
+            response = SquirrelServerHandler(FakeRequest(mocker.Mock(), 'POST', '/squirrels', body='name=Chippy'), dummy_client, dummy_server)
+            assert written_body(response).startswith(b'400 ')
+            mock_db_create_squirrel.assert_not_called()
+
+        def it_returns_411_without_a_content_length(mocker, dummy_client, dummy_server, mock_db_create_squirrel):
+            response = SquirrelServerHandler(FakeRequest(mocker.Mock(), 'POST', '/squirrels'), dummy_client, dummy_server)
+            assert written_body(response).startswith(b'411 ')
+            mock_db_create_squirrel.assert_not_called()
+
+        def it_returns_413_without_reading_a_body_over_the_limit(mocker, dummy_client, dummy_server, mock_db_create_squirrel):
+            mocker.patch.object(SquirrelServerHandler, 'maxBodySize', 10)
+            read = mocker.spy(SquirrelServerHandler, 'readExactly')
+
+            response = SquirrelServerHandler(FakeRequest(mocker.Mock(), 'POST', '/squirrels', body='name=Chippy&size=small'), dummy_client, dummy_server)
+
+            assert written_body(response).startswith(b'413 ')
+            read.assert_not_called()
+            mock_db_create_squirrel.assert_not_called()
+
+        def it_allows_bulk_bodies_up_to_their_own_limit(mocker, dummy_client, dummy_server, mock_db_init):
+            mocker.patch.object(SquirrelServerHandler, 'maxBodySize', 10)
+            mock_apply_bulk = mocker.patch.object(SquirrelDB, 'applyBulk', return_value=[True])
+            body = '{"op": "delete", "id": 3}'
+            SquirrelServerHandler(FakeRequest(mocker.Mock(), 'POST', '/squirrels/_bulk', body=body, headers={'Content-Type': 'application/x-ndjson'}), dummy_client, dummy_server)
+            mock_apply_bulk.assert_called_once_with([('delete', 3)])
+
     def describe_put_without_id():
 
         def it_calls_handle404_for_put_without_id(fake_put_no_id_request, dummy_client, dummy_server, mock_handle404):
@@ -405,7 +731,7 @@ def describe_SquirrelServerHandler():
             fake_404_request = FakeRequest(mocker.Mock(), 'GET', '/invalid')
 
             SquirrelServerHandler(fake_404_request, dummy_client, dummy_server)
-            mock_send_header.assert_called_once_with("Content-Type", "text/plain")
+            assert mock_send_header.call_args_list == [call("Content-Type", "text/plain"), call("Content-Length", "13")]
 
         def it_calls_end_headers(mocker, dummy_client, dummy_server, mock_response_methods):
             mock_send_response, mock_send_header, mock_end_headers = mock_response_methods
@@ -419,3 +745,482 @@ def describe_SquirrelServerHandler():
 
             response = SquirrelServerHandler(fake_404_request, dummy_client, dummy_server)
             response.wfile.write.assert_called_once_with(bytes("404 Not Found", "utf-8"))
+
+#real sockets need the real headers and buffering, undo the autouse patch
+def use_real_responses(mocker):
+    mocker.patch.object(SquirrelServerHandler, 'end_headers', real_end_headers)
+    mocker.patch.object(SquirrelServerHandler, 'wbufsize', -1)
+    mocker.patch.object(SquirrelDB, '__init__', return_value=None)
+
+@pytest.fixture
+def start_server(mocker):
+    servers = []
+    def start(workers, queueSize):
+        use_real_responses(mocker)
+        server = ThreadPoolHTTPServer(('127.0.0.1', 0), SquirrelServerHandler, workers, queueSize)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+#connections still open would otherwise be torn down after their loop is gone
+async def stop_async_server(server):
+    server.close()
+    connections = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in connections:
+        task.cancel()
+    await asyncio.gather(*connections, return_exceptions=True)
+
+#runs the asyncio engine on its own loop thread and hands back its address
+@pytest.fixture
+def start_async_server(mocker):
+    started = []
+    def start():
+        use_real_responses(mocker)
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        server = AsyncSquirrelServer(port=0, dbWorkers=2)
+        asyncio.run_coroutine_threadsafe(server.start(), loop).result(5)
+        started.append((loop, thread, server))
+        return server.server.sockets[0].getsockname()[:2]
+    yield start
+    for loop, thread, server in started:
+        asyncio.run_coroutine_threadsafe(stop_async_server(server), loop).result(5)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(5)
+        loop.close()
+
+#sends one real GET over a socket and hands back (status, body)
+def http_get(server, path):
+    connection = http.client.HTTPConnection(*server.server_address, timeout=5)
+    connection.request('GET', path)
+    response = connection.getresponse()
+    result = (response.status, response.read())
+    connection.close()
+    return result
+
+def describe_ThreadPoolHTTPServer():
+
+    def it_serves_requests_on_worker_threads(mocker, start_server):
+        threadNames = []
+        mocker.patch.object(SquirrelDB, 'getSquirrels', side_effect=lambda: threadNames.append(threading.current_thread().name) or ['squirrel'])
+        server = start_server(2, 4)
+
+        assert http_get(server, '/squirrels') == (200, bytes(json.dumps(['squirrel']), "utf-8"))
+        assert threadNames[0] != threading.current_thread().name
+        assert len(server.workers) == 2
+
+    def it_rejects_with_503_once_the_queue_is_full(mocker, start_server):
+        started = threading.Event()
+        release = threading.Event()
+        def slowGetSquirrels():
+            started.set()
+            release.wait(5)
+            return ['squirrel']
+        mocker.patch.object(SquirrelDB, 'getSquirrels', side_effect=slowGetSquirrels)
+        server = start_server(1, 1)
+        results = []
+        busy = threading.Thread(target=lambda: results.append(http_get(server, '/squirrels')))
+        busy.start()
+        started.wait(5)
+        queued = threading.Thread(target=lambda: results.append(http_get(server, '/squirrels')))
+        queued.start()
+        while server.pending.qsize() == 0:
+            time.sleep(0.001)
+
+        status, body = http_get(server, '/squirrels')
+
+        release.set()
+        busy.join(5)
+        queued.join(5)
+        assert status == 503
+        assert [result[0] for result in results] == [200, 200]
+
+    def it_does_not_let_idle_keep_alive_connections_hold_the_workers(mocker, start_server):
+        mocker.patch.object(SquirrelDB, 'getSquirrels', return_value=[])
+        server = start_server(2, 4)
+        idle = []
+        for _ in range(2):
+            connection = http.client.HTTPConnection(*server.server_address, timeout=5)
+            connection.request('GET', '/squirrels')
+            connection.getresponse().read()
+            idle.append(connection)
+
+        started = time.monotonic()
+        status, body = http_get(server, '/squirrels')
+
+        assert status == 200
+        assert time.monotonic() - started < server.idleTimeout + 1
+        for connection in idle:
+            connection.close()
+
+    def it_keeps_busy_connections_while_idle_workers_are_free(mocker, start_server):
+        mocker.patch.object(SquirrelDB, 'getSquirrels', return_value=[])
+        server = start_server(8, 64)
+        failures = []
+        def client():
+            try:
+                #reconnecting keeps putting connections in the queue for a moment
+                for _ in range(10):
+                    connection = http.client.HTTPConnection(*server.server_address, timeout=5)
+                    for _ in range(5):
+                        connection.request('GET', '/squirrels')
+                        connection.getresponse().read()
+                    connection.close()
+            except (http.client.HTTPException, OSError) as error:
+                failures.append(error)
+        clients = [threading.Thread(target=client) for _ in range(4)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join(30)
+
+        assert failures == []
+
+def describe_makeServer():
+
+    def it_closes_every_connection_in_single_mode(mocker):
+        use_real_responses(mocker)
+        mocker.patch.object(SquirrelDB, 'getSquirrels', return_value=[])
+        server = makeServer('127.0.0.1', 0, mode='single')
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            connection = http.client.HTTPConnection(*server.server_address, timeout=5)
+            connection.request('GET', '/squirrels')
+            response = connection.getresponse()
+            response.read()
+
+            assert response.status == 200
+            assert response.getheader('Connection') == 'close'
+            connection.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+#http.client reads through sock.makefile and closes it after each body,
+#so share one buffered file that stays open or pipelined bytes get lost
+class UnclosableReader(io.BufferedReader):
+    def close(self):
+        return
+
+class SharedFileSocket():
+    def __init__(self, sock):
+        self._file = UnclosableReader(socket.SocketIO(sock, 'rb'))
+
+    def makefile(self, *args, **kwargs):
+        return self._file
+
+#sends raw bytes and reads one response back, headers and all
+def exchange(sock, request):
+    sock.sendall(request)
+    response = http.client.HTTPResponse(SharedFileSocket(sock))
+    response.begin()
+    response.body = response.read()
+    return response
+
+#reads n raw HTTP/1.1 responses off one socket as (status, Connection, body)
+def read_responses(sock, n):
+    shared = SharedFileSocket(sock)
+    responses = []
+    for _ in range(n):
+        response = http.client.HTTPResponse(shared)
+        response.begin()
+        responses.append((response.status, response.getheader('Connection'), response.read()))
+    return responses
+
+#a socket connected to either engine, so both are held to the same behaviour
+@pytest.fixture(params=['threadpool', 'asyncio'])
+def client(request, start_server, start_async_server, mocker):
+    mocker.patch.object(SquirrelDB, 'getSquirrel', return_value={'id': 1, 'name': 'Chippy', 'size': 'small'})
+    if request.param == 'threadpool':
+        address = start_server(2, 4).server_address
+    else:
+        address = start_async_server()
+    sock = socket.create_connection(address, timeout=5)
+    yield sock
+    sock.close()
+
+def describe_both_engines():
+
+    def it_lists_the_squirrels_as_json(client, mocker):
+        mocker.patch.object(SquirrelDB, 'getSquirrels', return_value=['squirrel'])
+
+        response = exchange(client, b'GET /squirrels HTTP/1.1\r\nHost: test\r\n\r\n')
+
+        assert response.status == 200
+        assert response.getheader('Content-Type') == 'application/json'
+        assert response.body == b'["squirrel"]'
+
+    def it_retrieves_one_squirrel(client):
+        response = exchange(client, b'GET /squirrels/1 HTTP/1.1\r\nHost: test\r\n\r\n')
+
+        SquirrelDB.getSquirrel.assert_called_once_with('1')
+        assert response.status == 200
+        assert json.loads(response.body) == {'id': 1, 'name': 'Chippy', 'size': 'small'}
+
+    def it_creates_a_squirrel(client, mocker):
+        mock_create_squirrel = mocker.patch.object(SquirrelDB, 'createSquirrel', return_value=None)
+
+        response = exchange(client, b'POST /squirrels HTTP/1.1\r\nHost: test\r\nContent-Length: 22\r\n\r\nname=Chippy&size=small')
+
+        assert response.status == 201
+        mock_create_squirrel.assert_called_once_with('Chippy', 'small')
+
+    def it_updates_a_squirrel(client, mocker):
+        mock_update_squirrel = mocker.patch.object(SquirrelDB, 'updateSquirrel', return_value=None)
+
+        response = exchange(client, b'PUT /squirrels/1 HTTP/1.1\r\nHost: test\r\nContent-Length: 23\r\n\r\nname=Updated&size=large')
+
+        assert response.status == 204
+        mock_update_squirrel.assert_called_once_with('1', 'Updated', 'large')
+
+    def it_deletes_a_squirrel(client, mocker):
+        mock_delete_squirrel = mocker.patch.object(SquirrelDB, 'deleteSquirrel', return_value=None)
+
+        response = exchange(client, b'DELETE /squirrels/1 HTTP/1.1\r\nHost: test\r\n\r\n')
+
+        assert response.status == 204
+        mock_delete_squirrel.assert_called_once_with('1')
+
+    @pytest.mark.parametrize('request_line', [
+        b'GET /invalid', b'POST /squirrels/1', b'PUT /squirrels', b'DELETE /squirrels',
+    ])
+    def it_answers_404_for_an_unknown_route(client, request_line):
+        response = exchange(client, request_line + b' HTTP/1.1\r\nHost: test\r\nContent-Length: 0\r\n\r\n')
+
+        assert response.status == 404
+        assert response.getheader('Content-Type') == 'text/plain'
+        assert response.body == b'404 Not Found'
+
+    def it_answers_404_for_a_missing_squirrel(client, mocker):
+        mocker.patch.object(SquirrelDB, 'getSquirrel', return_value=None)
+        mock_update_squirrel = mocker.patch.object(SquirrelDB, 'updateSquirrel', return_value=None)
+
+        response = exchange(client, b'PUT /squirrels/1 HTTP/1.1\r\nHost: test\r\nContent-Length: 23\r\n\r\nname=Updated&size=large')
+
+        assert response.status == 404
+        mock_update_squirrel.assert_not_called()
+
+    def it_links_to_the_next_page(client, mocker):
+        mocker.patch.object(SquirrelDB, 'getSquirrelsPage', return_value=[{'id': 6, 'name': 'A', 'size': 's'}, {'id': 7, 'name': 'B', 'size': 'm'}])
+
+        response = exchange(client, b'GET /squirrels?limit=2&after_id=5 HTTP/1.1\r\nHost: test\r\n\r\n')
+
+        SquirrelDB.getSquirrelsPage.assert_called_once_with(5, 2)
+        assert response.getheader('Link') == '</squirrels?limit=2&after_id=7>; rel="next"'
+        assert [squirrel['id'] for squirrel in json.loads(response.body)] == [6, 7]
+
+    def it_answers_304_for_a_current_etag(client, mocker):
+        mock_get_squirrels = mocker.patch.object(SquirrelDB, 'getSquirrels', return_value=['squirrel'])
+        etag = exchange(client, b'GET /squirrels HTTP/1.1\r\nHost: test\r\n\r\n').getheader('ETag')
+
+        response = exchange(client, b'GET /squirrels HTTP/1.1\r\nHost: test\r\nIf-None-Match: %s\r\n\r\n' % etag.encode())
+
+        assert response.status == 304
+        assert response.getheader('ETag') == etag
+        assert response.body == b''
+        mock_get_squirrels.assert_called_once()
+
+    def it_applies_bulk_operations(client, mocker):
+        mock_apply_bulk = mocker.patch.object(SquirrelDB, 'applyBulk', return_value=[7, False])
+        body = b'{"op": "create", "name": "Chippy", "size": "small"}\n{"op": "delete", "id": 99}\n{"op": "fly"}\n'
+
+        response = exchange(client, b'POST /squirrels/_bulk HTTP/1.1\r\nHost: test\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body))
+
+        assert response.status == 200
+        mock_apply_bulk.assert_called_once_with([('create', 'Chippy', 'small'), ('delete', 99)])
+        assert json.loads(response.body) == [
+            {'index': 0, 'status': 201, 'id': 7},
+            {'index': 1, 'status': 404, 'id': 99},
+            {'index': 2, 'status': 400, 'error': 'op must be create, update or delete'},
+        ]
+
+    @pytest.mark.parametrize('stream', [b'1', b'ndjson'])
+    def it_streams_every_squirrel_and_keeps_the_connection(client, mocker, stream):
+        squirrels = [{'id': i, 'name': 'S', 'size': 'small'} for i in range(1, 6)]
+        mocker.patch.object(SquirrelServerHandler, 'streamChunkSize', 2)
+        mocker.patch.object(SquirrelDB, 'getSquirrelsPage', side_effect=lambda afterId, limit: [s for s in squirrels if s['id'] > afterId][:limit])
+
+        response = exchange(client, b'GET /squirrels?stream=%s HTTP/1.1\r\nHost: test\r\n\r\n' % stream)
+
+        assert response.getheader('Transfer-Encoding') == 'chunked'
+        if stream == b'ndjson':
+            assert [json.loads(line) for line in response.body.splitlines()] == squirrels
+        else:
+            assert json.loads(response.body) == squirrels
+        assert exchange(client, b'GET /squirrels/1 HTTP/1.1\r\nHost: test\r\n\r\n').status == 200
+
+def describe_persistent_connections():
+
+    def it_serves_several_requests_on_one_connection(client):
+        for _ in range(3):
+            client.sendall(b'GET /squirrels/1 HTTP/1.1\r\nHost: test\r\n\r\n')
+            [(status, connection, body)] = read_responses(client, 1)
+            assert status == 200
+            assert json.loads(body) == {'id': 1, 'name': 'Chippy', 'size': 'small'}
+
+    def it_answers_pipelined_requests_in_order(client, mocker):
+        mocker.patch.object(SquirrelDB, 'getSquirrels', return_value=['squirrel'])
+        client.sendall(b'GET /squirrels/1 HTTP/1.1\r\nHost: test\r\n\r\n'
+                       b'GET /invalid HTTP/1.1\r\nHost: test\r\n\r\n'
+                       b'GET /squirrels HTTP/1.1\r\nHost: test\r\n\r\n')
+
+        responses = read_responses(client, 3)
+
+        assert [status for status, connection, body in responses] == [200, 404, 200]
+        assert responses[2][2] == b'["squirrel"]'
+
+    def it_skips_the_unread_body_of_a_404(client, mocker):
+        mocker.patch.object(SquirrelDB, 'getSquirrel', return_value=None)
+        client.sendall(b'PUT /squirrels/9 HTTP/1.1\r\nHost: test\r\nContent-Length: 21\r\n\r\nname=Chippy&size=big'
+                       b'!DELETE /squirrels/9 HTTP/1.1\r\nHost: test\r\n\r\n')
+
+        responses = read_responses(client, 2)
+
+        assert [status for status, connection, body in responses] == [404, 404]
+
+    def it_reads_a_chunked_json_body(client, mocker):
+        mock_create_squirrel = mocker.patch.object(SquirrelDB, 'createSquirrel', return_value=None)
+        client.sendall(b'POST /squirrels HTTP/1.1\r\nHost: test\r\nContent-Type: application/json\r\nTransfer-Encoding: chunked\r\n\r\n'
+                       b'9\r\n{"name": \r\n1a\r\n"Chippy", "size": "small"}\r\n0\r\n\r\n'
+                       b'GET /squirrels/1 HTTP/1.1\r\nHost: test\r\n\r\n')
+
+        responses = read_responses(client, 2)
+
+        assert [status for status, connection, body in responses] == [201, 200]
+        mock_create_squirrel.assert_called_once_with('Chippy', 'small')
+
+    def it_closes_after_refusing_an_oversized_chunked_body(client, mocker):
+        mocker.patch.object(SquirrelServerHandler, 'maxBodySize', 16)
+        client.sendall(b'POST /squirrels HTTP/1.1\r\nHost: test\r\nTransfer-Encoding: chunked\r\n\r\n'
+                       b'20\r\n' + b'x' * 32 + b'\r\n0\r\n\r\n')
+
+        [(status, connection, body)] = read_responses(client, 1)
+
+        assert (status, connection) == (413, 'close')
+        assert client.recv(1) == b''
+
+    def it_skips_the_body_of_a_get(client, mocker):
+        body = b'GET /invalid HTTP/1.1\r\n\r\n'
+        client.sendall(b'GET /squirrels/1 HTTP/1.1\r\nHost: test\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body)
+                       + b'GET /squirrels/1 HTTP/1.1\r\nHost: test\r\n\r\n')
+
+        responses = read_responses(client, 2)
+
+        assert [status for status, connection, body in responses] == [200, 200]
+
+    def it_closes_after_max_requests_per_connection(client, mocker):
+        mocker.patch.object(SquirrelServerHandler, 'maxRequestsPerConnection', 2)
+        client.sendall(b'GET /squirrels/1 HTTP/1.1\r\nHost: test\r\n\r\n' * 2)
+
+        responses = read_responses(client, 2)
+
+        assert [connection for status, connection, body in responses] == [None, 'close']
+        assert client.recv(1) == b''
+
+    def it_streams_chunked_json_to_http_1_1_clients(client, mocker):
+        squirrels = [{'id': i, 'name': 'S', 'size': 'small'} for i in range(1, 4)]
+        mocker.patch.object(SquirrelServerHandler, 'streamChunkSize', 2)
+        mocker.patch.object(SquirrelDB, 'getSquirrelsPage', side_effect=lambda afterId, limit: [s for s in squirrels if s['id'] > afterId][:limit])
+        client.sendall(b'GET /squirrels?stream=1 HTTP/1.1\r\nHost: test\r\n\r\n'
+                       b'GET /squirrels/1 HTTP/1.1\r\nHost: test\r\n\r\n')
+
+        responses = read_responses(client, 2)
+
+        assert responses[0][0] == 200
+        assert json.loads(responses[0][2]) == squirrels
+        assert responses[1][0] == 200
+
+def describe_metrics():
+
+    @pytest.fixture
+    def metrics(mocker):
+        metrics = RequestMetrics()
+        mocker.patch.object(SquirrelServerHandler, 'metrics', metrics)
+        return metrics
+
+    def it_serves_request_counts_latency_and_stage_times(mocker, start_server, metrics):
+        mocker.patch.object(SquirrelDB, 'getSquirrel', side_effect=lambda squirrelId: {'id': 1, 'name': 'Chippy', 'size': 'small'} if squirrelId == '1' else None)
+        server = start_server(2, 4)
+
+        assert http_get(server, '/squirrels/1')[0] == 200
+        assert http_get(server, '/squirrels/2')[0] == 404
+        status, body = http_get(server, '/_metrics')
+
+        assert status == 200
+        text = body.decode('utf-8')
+        assert 'squirrel_http_requests_total{method="GET",route="/squirrels/{id}",status="200"} 1' in text
+        assert 'squirrel_http_request_duration_seconds_count{method="GET",route="/squirrels/{id}"} 2' in text
+        assert 'squirrel_http_request_duration_seconds_bucket{method="GET",route="/squirrels/{id}",le="+Inf"} 2' in text
+        assert 'squirrel_http_stage_seconds_total{route="/squirrels/{id}",stage="db"}' in text
+        assert re.search(r'squirrel_http_response_bytes_total\{route="/squirrels/\{id\}"\} [1-9]', text)
+        assert 'squirrel_db_pool_acquires{pool="write"}' in text
+
+    def it_is_not_found_when_metrics_are_off(start_server):
+        server = start_server(2, 4)
+
+        assert http_get(server, '/_metrics')[0] == 404
+
+def describe_profile():
+
+    def it_serves_the_profiled_requests(mocker, start_server):
+        mocker.patch.object(SquirrelServerHandler, 'profiler', RequestProfiler(every=1))
+        mocker.patch.object(SquirrelDB, 'getSquirrels', return_value=[])
+        server = start_server(2, 4)
+
+        http_get(server, '/squirrels')
+        status, body = http_get(server, '/_profile?sort=tottime&limit=200&reset=1')
+
+        assert status == 200
+        assert b'handleSquirrelsIndex' in body
+        assert http_get(server, '/_profile?sort=nonsense')[0] == 400
+        # counted again from the reset: the reset request itself and the 400
+        assert http_get(server, '/_profile')[1].startswith(b'2 requests profiled of 2 seen')
+
+    def it_folds_in_the_sample_before_the_client_has_its_response(mocker, start_server):
+        profiler = RequestProfiler(every=1)
+        #a slow stop would let the client see its response first if the order were wrong
+        stop = profiler.stop
+        mocker.patch.object(profiler, 'stop', side_effect=lambda profile: (time.sleep(0.2), stop(profile)))
+        mocker.patch.object(SquirrelServerHandler, 'profiler', profiler)
+        mocker.patch.object(SquirrelDB, 'getSquirrels', return_value=[{'id': i, 'name': 'x' * 100, 'size': 'small'} for i in range(200)])
+        server = start_server(2, 4)
+
+        http_get(server, '/squirrels')
+
+        assert profiler.samples == 1
+        assert not profiler.running.locked()
+
+    def it_is_not_found_when_profiling_is_off(start_server):
+        server = start_server(2, 4)
+
+        assert http_get(server, '/_profile')[0] == 404
+
+def describe_access_log():
+
+    def it_hands_lines_to_the_async_log(mocker, start_server):
+        stream = io.StringIO()
+        accessLog = AsyncLog(stream)
+        mocker.patch.object(SquirrelServerHandler, 'accessLog', accessLog)
+        mocker.patch.object(SquirrelDB, 'getSquirrels', return_value=[])
+        server = start_server(2, 4)
+
+        http_get(server, '/squirrels')
+        accessLog.close()
+
+        assert '"GET /squirrels HTTP/1.1" 200' in stream.getvalue()
+
+    def it_keeps_only_errors_when_request_lines_are_off(mocker, dummy_client, dummy_server, mock_db_get_squirrels):
+        accessLog = mocker.Mock()
+        mocker.patch.object(SquirrelServerHandler, 'accessLog', accessLog)
+        mocker.patch.object(SquirrelServerHandler, 'logRequests', False)
+
+        SquirrelServerHandler(FakeRequest(mocker.Mock(), 'GET', '/squirrels'), dummy_client, dummy_server)
+        SquirrelServerHandler(FakeRequest(mocker.Mock(), 'BREW', '/squirrels'), dummy_client, dummy_server)
+
+        assert accessLog.write.call_count == 1
+        assert 'Unsupported method' in accessLog.write.call_args[0][0]